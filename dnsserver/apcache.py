@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    AP-set fingerprint cache - remembers where sets of access points were
+    geolocated, so a tracker which hasn't moved doesn't cost an API call
+    every time it reports.
+
+    The fingerprint of a scan is the set of its strongest top_n BSSIDs
+    (48 bit ints). A stationary tracker sees nearly, but not exactly, the
+    same set each time, so lookup() answers from an entry whose
+    fingerprint has a Jaccard similarity of at least threshold with the
+    scan's, not only from an exact match.
+
+    Fingerprints are small (top_n BSSIDs), so rather than MinHash/LSH
+    the cache keeps an inverted index of BSSID -> entries: the
+    candidates for a scan are the entries sharing at least one BSSID
+    with it, and their similarity is computed exactly.
+
+    "Not found" answers are cached too (the API would give the same
+    answer for the same APs). Entries expire ttl seconds after they
+    were stored (lookup() ignores them, purge() deletes them), and the
+    least recently used entries are dropped when there are more than
+    max_entries.
+
+    The cache is a SQLite file, so it persists between runs; like a
+    sqlite3 connection, a FingerprintCache should only be used from one
+    thread.
+
+    Run this file to print cache statistics:
+
+        python3 apcache.py apcache.sqlite3
+"""
+
+import sqlite3
+import sys
+import time
+
+class FingerprintCache():
+    """
+        >>> cache = FingerprintCache(':memory:', ttl=3600)
+        >>> aps = [(0x0a0000000000 + n, -40 - n) for n in range(8)]
+        >>> cache.lookup(aps, now=0) is None
+        True
+        >>> cache.put(aps, (51.5, -0.1), now=0)
+        >>> cache.lookup(aps, now=10)
+        ((51.5, -0.1),)
+
+        A scan sharing five of its strongest six APs (Jaccard 5/7)
+
+        >>> cache.lookup(aps[:5] + [(0x0b0000000000, -30)], now=10)
+        ((51.5, -0.1),)
+
+        "Not found" answers are cached as None
+
+        >>> unknown = [(0x0c0000000000, -50), (0x0c0000000001, -60)]
+        >>> cache.lookup(unknown, now=10) is None
+        True
+        >>> cache.put(unknown, None, now=10)
+        >>> cache.lookup(unknown, now=20)
+        (None,)
+
+        Expired entries aren't used (but a less similar live one is)
+
+        >>> cache.put(aps[:5] + [(0x0b0000000000, -30)], (51.6, -0.2), now=3000)
+        >>> cache.lookup(aps, now=3601)
+        ((51.6, -0.2),)
+        >>> cache.lookup(aps, now=7000) is None
+        True
+        >>> cache.purge(now=7000)
+        3
+        >>> stats = cache.stats()
+        >>> stats['entries'], stats['exact_hits'], stats['similar_hits'], stats['expired']
+        (0, 2, 2, 3)
+        >>> cache.close()
+    """
+
+    def __init__(self, filename='apcache.sqlite3', top_n=6, threshold=0.6,
+            ttl=30*86400, max_entries=100000):
+        self.filename = filename
+        self.top_n = top_n
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entry(id INTEGER PRIMARY KEY,"
+            " fingerprint TEXT UNIQUE, size INTEGER, found INTEGER, lat, lon, created REAL, last_used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entry_ap(bssid INTEGER, entry_id INTEGER,"
+            " PRIMARY KEY(bssid, entry_id)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entry_ap_entry ON entry_ap(entry_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entry_last_used ON entry(last_used)")
+        self.db.commit()
+        self.lookups = 0
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def fingerprint(self, aps):
+        """
+            Sorted tuple of the strongest top_n BSSIDs in aps (list of
+            (bssid, rssi))
+        """
+        strongest = sorted(aps, key=lambda ap: ap[1], reverse=True)[:self.top_n]
+        return tuple(sorted(bssid for bssid, rssi in strongest))
+
+    def fingerprint_key(self, fingerprint):
+        return ','.join('%012x' % bssid for bssid in fingerprint)
+
+    def lookup(self, aps, now=None):
+        """
+            Cached answer for aps (list of (bssid, rssi)): (lat, lon), or
+            None if the location wasn't found - wrapped in a tuple (so
+            the result is (where,) on a hit), or None on a miss.
+        """
+        if now is None:
+            now = time.time()
+        self.lookups += 1
+        fingerprint = self.fingerprint(aps)
+        if not fingerprint:
+            return None
+        marks = ','.join('?' * len(fingerprint))
+        # Expired entries are skipped (and deleted by purge())
+        rows = self.db.execute("SELECT e.id, count(*), e.size, e.found, e.lat, e.lon"
+            " FROM entry_ap a JOIN entry e ON e.id = a.entry_id"
+            " WHERE a.bssid IN (%s) AND e.created >= ? GROUP BY a.entry_id" % marks,
+            fingerprint + (now - self.ttl,)).fetchall()
+        best = None
+        for entry_id, shared, size, found, lat, lon in rows:
+            similarity = shared / float(len(fingerprint) + size - shared)
+            if similarity >= self.threshold and (best is None or similarity > best[0]):
+                best = (similarity, entry_id, found, lat, lon)
+        if best is None:
+            return None
+        similarity, entry_id, found, lat, lon = best
+        # Committed with the next put(), commit() or close()
+        self.db.execute("UPDATE entry SET last_used=? WHERE id=?", (now, entry_id))
+        if similarity == 1.0:
+            self.exact_hits += 1
+        else:
+            self.similar_hits += 1
+        return ((lat, lon) if found else None,)
+
+    def put(self, aps, where, now=None):
+        """
+            Store the answer (where is (lat, lon) or None) for aps
+        """
+        if now is None:
+            now = time.time()
+        fingerprint = self.fingerprint(aps)
+        if not fingerprint:
+            return
+        key = self.fingerprint_key(fingerprint)
+        lat, lon = where if where is not None else (None, None)
+        with self.db:
+            old = self.db.execute("SELECT id FROM entry WHERE fingerprint=?", (key,)).fetchone()
+            if old is not None:
+                self.delete(old[0])
+            cur = self.db.execute("INSERT INTO entry (fingerprint, size, found, lat, lon, created, last_used)"
+                " VALUES (?,?,?,?,?,?,?)", (key, len(fingerprint), where is not None, lat, lon, now, now))
+            self.db.executemany("INSERT INTO entry_ap (bssid, entry_id) VALUES (?,?)",
+                [(bssid, cur.lastrowid) for bssid in fingerprint])
+            self.evict()
+
+    def delete(self, entry_id):
+        self.db.execute("DELETE FROM entry_ap WHERE entry_id=?", (entry_id,))
+        self.db.execute("DELETE FROM entry WHERE id=?", (entry_id,))
+
+    def evict(self):
+        count, = self.db.execute("SELECT count(*) FROM entry").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            for entry_id, in self.db.execute("SELECT id FROM entry ORDER BY last_used LIMIT ?",
+                    (excess,)).fetchall():
+                self.delete(entry_id)
+            self.evicted += excess
+
+    def purge(self, now=None):
+        """
+            Delete expired entries. Returns the number deleted.
+        """
+        if now is None:
+            now = time.time()
+        with self.db:
+            ids = self.db.execute("SELECT id FROM entry WHERE created < ?",
+                (now - self.ttl,)).fetchall()
+            for entry_id, in ids:
+                self.delete(entry_id)
+        self.expired += len(ids)
+        return len(ids)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def stats(self):
+        hits = self.exact_hits + self.similar_hits
+        return {
+            'entries': self.db.execute("SELECT count(*) FROM entry").fetchone()[0],
+            'lookups': self.lookups,
+            'exact_hits': self.exact_hits,
+            'similar_hits': self.similar_hits,
+            'hit_rate': hits / float(self.lookups) if self.lookups else 0.0,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            }
+
+def main():
+    for filename in sys.argv[1:]:
+        cache = FingerprintCache(filename)
+        print(filename, cache.stats())
+        cache.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Local BSSID location index - positions messages without the remote
+    geolocation API when their access points have been seen before.
+
+    build() learns a position for each BSSID from the messages which the
+    API has already located (status 'OK'): the RSSI-weighted centroid of
+    the positions of the messages it was seen in, with the weighted
+    spread of those positions (metres) as its uncertainty. Only APs seen
+    in at least min_observations messages are kept. The result is kept
+    in a SQLite file:
+
+        ap_location(bssid, lat, lon, spread, observations)
+
+    locate() positions a scan as the RSSI-weighted centroid of its known
+    APs (weighted down by their uncertainty). A least-squares fit of a
+    path loss model would need per-AP transmit power, which we don't
+    know, so the centroid is used. It returns None - fall back to the
+    API - unless at least min_aps of the scan's APs (and min_known of
+    them as a fraction) are known and the estimated accuracy is good
+    enough.
+
+    An AP seen in only a few places could be anywhere within its range
+    of them, so its uncertainty is at least ap_range / sqrt(observations)
+    however close together those places were.
+
+    Messages located here get status 'LOCAL' (and those answered from
+    the fingerprint cache 'CACHED') rather than 'OK', so they aren't
+    learned from (which would reinforce any error).
+
+    The index is loaded into memory; with NumPy (if installed) it is held
+    as sorted arrays and each lookup is vectorised, otherwise it is a
+    dict. Either way locate() costs well under a millisecond.
+
+    Run this file to (re)build the index:
+
+        python3 apindex.py --directory messages --index apindex.sqlite3
+"""
+
+import math
+import sqlite3
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from messagestore import MessageStore
+
+METRES_PER_DEGREE = 111320.0
+
+def rssi_weight(rssi):
+    """
+        Relative weight of an observation (linear amplitude - an AP 20dB
+        stronger counts 10x as much)
+    """
+    return 10 ** (rssi / 20.0)
+
+def build(store, filename='apindex.sqlite3', min_observations=2):
+    """
+        Learn BSSID positions from the messages in store (MessageStore)
+        located by the API, and write them to the index file (replacing
+        its contents). Returns the number of BSSIDs indexed.
+    """
+    sums = {}
+    for key in store.partitions():
+        db = store.connect(key)
+        db.create_function('rssi_weight', 1, rssi_weight)
+        rows = db.execute("SELECT bssid, count(*), sum(w), sum(w*lat), sum(w*lon),"
+            " sum(w*lat*lat), sum(w*lon*lon) FROM"
+            " (SELECT a.bssid, rssi_weight(a.rssi) AS w, m.lat, m.lon"
+            "  FROM ap a JOIN message m ON m.id = a.message_id"
+            "  WHERE m.status = 'OK' AND m.lat IS NOT NULL)"
+            " GROUP BY bssid")
+        for row in rows:
+            old = sums.get(row[0])
+            if old is None:
+                sums[row[0]] = list(row[1:])
+            else:
+                for n, value in enumerate(row[1:]):
+                    old[n] += value
+    index = sqlite3.connect(filename)
+    index.execute("CREATE TABLE IF NOT EXISTS ap_location(bssid INTEGER PRIMARY KEY,"
+        " lat REAL, lon REAL, spread REAL, observations INTEGER)")
+    entries = []
+    for bssid, (n, w, wlat, wlon, wlat2, wlon2) in sums.items():
+        if n < min_observations or w <= 0:
+            continue
+        lat = wlat / w
+        lon = wlon / w
+        var_lat = max(0.0, wlat2 / w - lat * lat)
+        var_lon = max(0.0, wlon2 / w - lon * lon)
+        spread = METRES_PER_DEGREE * math.sqrt(var_lat +
+            var_lon * math.cos(math.radians(lat)) ** 2)
+        entries.append((bssid, lat, lon, spread, n))
+    with index:
+        index.execute("DELETE FROM ap_location")
+        index.executemany("INSERT INTO ap_location VALUES (?,?,?,?,?)", entries)
+    index.close()
+    return len(entries)
+
+class BSSIDIndex():
+    """
+        >>> import os, tempfile
+        >>> from messagestore import COLUMNS
+        >>> directory = tempfile.mkdtemp()
+        >>> store = MessageStore(os.path.join(directory, 'messages'))
+        >>> t = 1.79e9
+        >>> def message(id, status, lat, lon):
+        ...     return (id, t, t, '', '', status, 'm', 's', lat, lon, None, 0, 2)
+        >>> store.insert([message('a', 'OK', 51.5000, -0.1000),
+        ...     message('b', 'OK', 51.5010, -0.1000),
+        ...     message('c', 'OK', 51.5005, -0.1010),
+        ...     message('d', 'CACHED', 52.0, 0.0)], COLUMNS,
+        ...     [(id, t, bssid, -60) for id in 'abcd' for bssid in (1, 2)] +
+        ...     [('a', t, 3, -60)])
+        4
+        >>> filename = os.path.join(directory, 'apindex.sqlite3')
+
+        APs 1 and 2 were in three messages located by the API (the cache
+        hit isn't learned from); AP 3 in only one
+
+        >>> build(store, filename)
+        2
+        >>> index = BSSIDIndex(filename)
+        >>> lat, lon, accuracy = index.locate([(1, -50), (2, -70)])
+        >>> round(lat, 4), round(lon, 4), round(accuracy)
+        (51.5005, -0.1003, 58)
+        >>> index.locate([(1, -50), (8, -70), (9, -70)]) is None
+        True
+        >>> store.close()
+    """
+
+    def __init__(self, filename='apindex.sqlite3', min_aps=2, min_known=0.5,
+            max_accuracy=200.0, ap_range=100.0):
+        """
+            min_aps         - min number of known APs in a scan
+            min_known       - min fraction of a scan's APs which are known
+            max_accuracy    - reject estimates less accurate than this (m)
+            ap_range        - typical range (m) of an AP: the uncertainty
+                              of an AP seen in n messages is at least
+                              ap_range / sqrt(n)
+        """
+        self.min_aps = min_aps
+        self.min_known = min_known
+        self.max_accuracy = max_accuracy
+        self.ap_range = ap_range
+        db = sqlite3.connect(filename)
+        db.execute("CREATE TABLE IF NOT EXISTS ap_location(bssid INTEGER PRIMARY KEY,"
+            " lat REAL, lon REAL, spread REAL, observations INTEGER)")
+        rows = [(bssid, lat, lon, max(spread, ap_range / math.sqrt(max(1, n))))
+            for bssid, lat, lon, spread, n in db.execute(
+                "SELECT bssid, lat, lon, spread, observations FROM ap_location"
+                " ORDER BY bssid")]
+        db.close()
+        if numpy is not None:
+            self.bssids = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+            self.lats = numpy.array([r[1] for r in rows], dtype=float)
+            self.lons = numpy.array([r[2] for r in rows], dtype=float)
+            self.spreads = numpy.array([r[3] for r in rows], dtype=float)
+        else:
+            self.aps = dict((r[0], r[1:]) for r in rows)
+        self.size = len(rows)
+        self.lookups = 0
+        self.located = 0
+        self.lookup_time = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def known(self, aps):
+        """
+            (lats, lons, spreads, rssis) of the known APs in aps (list of
+            (bssid, rssi))
+        """
+        if numpy is not None:
+            if not self.size:
+                return [], [], [], []
+            bssids = numpy.array([ap[0] for ap in aps], dtype=numpy.int64)
+            rssis = numpy.array([ap[1] for ap in aps], dtype=float)
+            pos = numpy.searchsorted(self.bssids, bssids)
+            pos[pos >= self.size] = 0
+            found = self.bssids[pos] == bssids
+            pos = pos[found]
+            return self.lats[pos], self.lons[pos], self.spreads[pos], rssis[found]
+        known = [(self.aps[bssid], rssi) for bssid, rssi in aps if bssid in self.aps]
+        return ([k[0][0] for k in known], [k[0][1] for k in known],
+            [k[0][2] for k in known], [k[1] for k in known])
+
+    def locate(self, aps):
+        """
+            (lat, lon, accuracy) for aps (list of (bssid, rssi)), or None
+            if there aren't enough known APs or the estimate isn't
+            accurate enough
+        """
+        t0 = time.perf_counter()
+        self.lookups += 1
+        try:
+            lats, lons, spreads, rssis = self.known(aps)
+            n = len(lats)
+            if n < self.min_aps or n < self.min_known * len(aps):
+                return None
+            if numpy is not None:
+                weights = 10 ** (rssis / 20.0) / spreads
+                weights /= weights.sum()
+                lat = float(weights @ lats)
+                lon = float(weights @ lons)
+                scale = math.cos(math.radians(lat))
+                d2 = ((lats - lat) ** 2 + ((lons - lon) * scale) ** 2) * METRES_PER_DEGREE ** 2
+                accuracy = math.sqrt(float(weights @ d2)) + float(weights @ spreads)
+            else:
+                weights = [rssi_weight(r) / s for r, s in zip(rssis, spreads)]
+                total = sum(weights)
+                weights = [w / total for w in weights]
+                lat = sum(w * x for w, x in zip(weights, lats))
+                lon = sum(w * x for w, x in zip(weights, lons))
+                scale = math.cos(math.radians(lat))
+                d2 = sum(w * ((a - lat) ** 2 + ((b - lon) * scale) ** 2)
+                    for w, a, b in zip(weights, lats, lons)) * METRES_PER_DEGREE ** 2
+                accuracy = math.sqrt(d2) + sum(w * s for w, s in zip(weights, spreads))
+            if accuracy > self.max_accuracy:
+                return None
+            self.located += 1
+            return (lat, lon, accuracy)
+        finally:
+            self.lookup_time += time.perf_counter() - t0
+
+    def stats(self):
+        return {
+            'index_aps': self.size,
+            'index_lookups': self.lookups,
+            'index_located': self.located,
+            'index_us_avg': (1e6 * self.lookup_time / self.lookups
+                if self.lookups else 0.0),
+            }
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description="Build the local BSSID location index")
+    p.add_argument("--directory", "-d", default="messages",
+                    help="Message store directory (default: messages)")
+    p.add_argument("--index", default="apindex.sqlite3",
+                    help="Index file (default: apindex.sqlite3)")
+    p.add_argument("--min-observations", type=int, default=2,
+                    help="Min located messages an AP must be seen in (default: 2)")
+    args = p.parse_args()
+    t0 = time.monotonic()
+    store = MessageStore(args.directory)
+    count = build(store, args.index, args.min_observations)
+    store.close()
+    print("Indexed %d BSSIDs in %.1fs" % (count, time.monotonic() - t0))
+
+if __name__ == '__main__':
+    main()
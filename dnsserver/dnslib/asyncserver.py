@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Asyncio DNS server - alternative engine to the socketserver based
+    DNSServer in dnslib.server.
+
+    The socketserver engine starts an OS thread for every UDP datagram;
+    this one handles all requests from a single event loop, which is much
+    cheaper at high query rates. Resolvers and loggers are the same as
+    for dnslib.server:
+
+        AsyncDNSServer  - same constructor/start/start_thread/stop/isAlive
+                          interface as DNSServer (the listening socket is
+                          bound in the constructor, so PermissionError etc.
+                          are raised there)
+
+        AsyncDNSHandler - passed to the resolver and logger in place of
+                          DNSHandler, with the same 'server',
+                          'client_address' and 'protocol' attributes
+
+    The resolver 'resolve' method may either be a normal method, which is
+    called directly from the event loop (so must not block), or an
+    'async def' coroutine, which runs as a task. A normal resolver which
+    needs to block (eg. ProxyResolver) can be run in a thread pool by
+    passing an 'executor' (concurrent.futures.Executor) to the server.
+
+        >>> resolver = BaseResolver()
+        >>> logger = DNSLogger(prefix=False)
+        >>> server = AsyncDNSServer(resolver,port=8053,address="localhost",logger=logger)
+        >>> server.start_thread()
+        >>> q = DNSRecord.question("abc.def")
+        >>> a = q.send("localhost",8053)
+        Request: [...] (udp) / 'abc.def.' (A)
+        Reply: [...] (udp) / 'abc.def.' (A) / NXDOMAIN
+        >>> print(DNSRecord.parse(a))
+        ;; ->>HEADER<<- opcode: QUERY, status: NXDOMAIN, id: ...
+        ;; flags: qr aa rd ra; QUERY: 1, ANSWER: 0, AUTHORITY: 0, ADDITIONAL: 0
+        ;; QUESTION SECTION:
+        ;abc.def.                       IN      A
+        >>> server.stop()
+
+        >>> class TestResolver:
+        ...     async def resolve(self,request,handler):
+        ...         await asyncio.sleep(0)
+        ...         reply = request.reply()
+        ...         reply.add_answer(*RR.fromZone("abc.def. 60 A 1.2.3.4"))
+        ...         return reply
+        >>> resolver = TestResolver()
+        >>> server = AsyncDNSServer(resolver,port=8053,address="localhost",logger=logger,tcp=True)
+        >>> server.start_thread()
+        >>> a = q.send("localhost",8053,tcp=True)
+        Request: [...] (tcp) / 'abc.def.' (A)
+        Reply: [...] (tcp) / 'abc.def.' (A) / RRs: A
+        >>> print(DNSRecord.parse(a))
+        ;; ->>HEADER<<- opcode: QUERY, status: NOERROR, id: ...
+        ;; flags: qr aa rd ra; QUERY: 1, ANSWER: 1, AUTHORITY: 0, ADDITIONAL: 0
+        ;; QUESTION SECTION:
+        ;abc.def.                       IN      A
+        ;; ANSWER SECTION:
+        abc.def.                60      IN      A       1.2.3.4
+        >>> server.stop()
+        >>> server.isAlive()
+        False
+
+"""
+from __future__ import print_function
+
+import asyncio,inspect,socket,struct,threading
+
+from dnslib.dns import DNSRecord,DNSError,RR
+from dnslib.server import BaseResolver,DNSLogger,set_reuse_port
+from dnslib.queryview import fast_reply
+
+class AsyncDNSHandler(object):
+    """
+        Handles a single request. Provides the attributes of DNSHandler
+        which resolvers and loggers use (server/client_address/protocol)
+    """
+
+    udplen = 0                  # Max udp packet length (0 = ignore)
+
+    def __init__(self,server,client_address,protocol,send):
+        self.server = server
+        self.client_address = client_address
+        self.protocol = protocol
+        self.send = send
+
+    def handle(self,data):
+        self.server.logger.log_recv(self,data)
+        rdata = fast_reply(self.server.resolver,self,data)
+        if rdata is not None:
+            self.server.logger.log_send(self,rdata)
+            self.send(rdata)
+            return
+        try:
+            request = DNSRecord.parse(data)
+            self.server.logger.log_request(self,request)
+            reply = self.server.resolve(request,self)
+            if inspect.isawaitable(reply):
+                self.server.add_task(self.finish(reply))
+            else:
+                self.send_reply(reply)
+        except DNSError as e:
+            self.server.logger.log_error(self,e)
+
+    async def finish(self,pending):
+        try:
+            self.send_reply(await pending)
+        except DNSError as e:
+            self.server.logger.log_error(self,e)
+
+    def send_reply(self,reply):
+        self.server.logger.log_reply(self,reply)
+        rdata = reply.pack()
+        if self.protocol == 'udp' and self.udplen and len(rdata) > self.udplen:
+            truncated_reply = reply.truncate()
+            rdata = truncated_reply.pack()
+            self.server.logger.log_truncated(self,truncated_reply)
+        self.server.logger.log_send(self,rdata)
+        self.send(rdata)
+
+class UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self,server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self,transport):
+        self.transport = transport
+
+    def datagram_received(self,data,addr):
+        sendto = self.transport.sendto
+        handler = self.server.handler(self.server,addr,'udp',
+                                      lambda rdata: sendto(rdata,addr))
+        handler.handle(data)
+
+class TCPProtocol(asyncio.Protocol):
+    """
+        Handles length-prefixed requests; several requests may be
+        pipelined on one connection
+    """
+
+    def __init__(self,server):
+        self.server = server
+        self.transport = None
+        self.peer = None
+        self.data = b''
+
+    def connection_made(self,transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+
+    def data_received(self,data):
+        self.data += data
+        while len(self.data) >= 2:
+            length = struct.unpack("!H",self.data[:2])[0]
+            if len(self.data) - 2 < length:
+                break
+            packet = self.data[2:2+length]
+            self.data = self.data[2+length:]
+            handler = self.server.handler(self.server,self.peer,'tcp',self.write)
+            handler.handle(packet)
+
+    def write(self,rdata):
+        if not self.transport.is_closing():
+            self.transport.write(struct.pack("!H",len(rdata)) + rdata)
+
+class AsyncDNSServer(object):
+
+    """
+        Asyncio equivalent of DNSServer (see module docstring)
+    """
+    def __init__(self,resolver,
+                      address="",
+                      port=53,
+                      tcp=False,
+                      logger=None,
+                      handler=AsyncDNSHandler,
+                      executor=None,
+                      reuse_port=False):
+        """
+            resolver:   resolver instance
+            address:    listen address (default: "")
+            port:       listen port (default: 53)
+            tcp:        UDP (false) / TCP (true) (default: False)
+            logger:     logger instance (default: DNSLogger)
+            handler:    handler class (default: AsyncDNSHandler)
+            executor:   run (non-async) resolver in this executor
+                        (default: None - call directly from event loop)
+            reuse_port: set SO_REUSEPORT so that several processes can
+                        serve the same port (default: False)
+        """
+        self.resolver = resolver
+        self.logger = logger or DNSLogger()
+        self.handler = handler
+        self.executor = executor
+        self.tcp = tcp
+        self.loop = None
+        self.thread = None
+        self.tasks = set()
+        self.ready = threading.Event()
+        self.stopped = None
+        self.socket = socket.socket(socket.AF_INET,
+                            socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        try:
+            if reuse_port:
+                set_reuse_port(self.socket)
+            self.socket.bind((address,port))
+            if tcp:
+                self.socket.listen(128)
+        except:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+
+    def resolve(self,request,handler):
+        if self.executor and not inspect.iscoroutinefunction(self.resolver.resolve):
+            return self.loop.run_in_executor(self.executor,
+                                self.resolver.resolve,request,handler)
+        return self.resolver.resolve(request,handler)
+
+    def add_task(self,coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def serve(self):
+        """
+            Serve requests from the running event loop until stop()
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.tcp:
+            server = await self.loop.create_server(lambda: TCPProtocol(self),
+                                                   sock=self.socket)
+            close = server.close
+        else:
+            transport,_ = await self.loop.create_datagram_endpoint(
+                                                   lambda: UDPProtocol(self),
+                                                   sock=self.socket)
+            close = transport.close
+        self.ready.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            close()
+            for task in list(self.tasks):
+                task.cancel()
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            # Don't leave start_thread() waiting if serve() failed
+            self.ready.set()
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.start)
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def isAlive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Batched UDP DNS server - a single thread which drains as many waiting
+    datagrams as possible (up to max_batch) each time the socket becomes
+    readable, resolves them, then sends all of the replies.
+
+    Datagrams are received into preallocated buffers (recvmsg_into, or
+    recvfrom_into where recvmsg_into is not available) so there is no
+    per-packet allocation on receive, and there is no thread creation per
+    request as with the socketserver engine. Python has no recvmmsg/
+    sendmmsg, so each datagram is still one syscall, but they all happen
+    in one wakeup.
+
+    Resolvers and loggers are the same as for DNSServer (the resolver is
+    called from the server thread, so should not block), and the server
+    has the same start/start_thread/stop/isAlive interface. stats()
+    reports the packets handled per wakeup.
+
+        >>> resolver = BaseResolver()
+        >>> logger = DNSLogger(prefix=False)
+        >>> server = BatchUDPServer(resolver,port=8053,address="localhost",logger=logger)
+        >>> server.start_thread()
+        >>> q = DNSRecord.question("abc.def")
+        >>> a = q.send("localhost",8053)
+        Request: [...] (udp) / 'abc.def.' (A)
+        Reply: [...] (udp) / 'abc.def.' (A) / NXDOMAIN
+        >>> print(DNSRecord.parse(a))
+        ;; ->>HEADER<<- opcode: QUERY, status: NXDOMAIN, id: ...
+        ;; flags: qr aa rd ra; QUERY: 1, ANSWER: 0, AUTHORITY: 0, ADDITIONAL: 0
+        ;; QUESTION SECTION:
+        ;abc.def.                       IN      A
+        >>> server.stop()
+        >>> stats = server.stats()
+        >>> stats['packets'],stats['wakeups']
+        (1, 1)
+
+    A resolver error is logged and answered with SERVFAIL, and the
+    server carries on
+
+        >>> class BrokenResolver(BaseResolver):
+        ...     def resolve(self,request,handler):
+        ...         if request.q.qname == "broken.def":
+        ...             raise ValueError("resolver failed")
+        ...         return BaseResolver.resolve(self,request,handler)
+        >>> logger = DNSLogger("-request,-reply",prefix=False)
+        >>> server = BatchUDPServer(BrokenResolver(),port=8053,address="localhost",logger=logger)
+        >>> server.start_thread()
+        >>> a = DNSRecord.question("broken.def").send("localhost",8053)
+        Invalid Request: [...] (udp) :: resolver failed
+        >>> RCODE[DNSRecord.parse(a).header.rcode]
+        'SERVFAIL'
+        >>> a = DNSRecord.question("abc.def").send("localhost",8053)
+        >>> RCODE[DNSRecord.parse(a).header.rcode]
+        'NXDOMAIN'
+        >>> server.isAlive()
+        True
+        >>> server.stop()
+
+"""
+from __future__ import print_function
+
+import select,socket,threading
+
+from dnslib.dns import DNSRecord,DNSError,RCODE
+from dnslib.server import BaseResolver,DNSLogger,set_reuse_port
+from dnslib.queryview import fast_reply
+
+def servfail(data):
+    """
+        SERVFAIL reply packet for request packet (or None if the request
+        can't be decoded)
+    """
+    try:
+        reply = DNSRecord.parse(data).reply()
+    except DNSError:
+        return None
+    reply.header.rcode = RCODE.SERVFAIL
+    return reply.pack()
+
+class BatchDNSHandler(object):
+    """
+        Handles one datagram. Provides the attributes of DNSHandler which
+        resolvers and loggers use (server/client_address/protocol)
+    """
+
+    udplen = 0                  # Max udp packet length (0 = ignore)
+
+    def __init__(self,server,client_address):
+        self.server = server
+        self.client_address = client_address
+        self.protocol = 'udp'
+
+    def handle(self,data):
+        """
+            Return reply packet (or None if the request can't be decoded)
+        """
+        self.server.logger.log_recv(self,data)
+        rdata = fast_reply(self.server.resolver,self,data)
+        if rdata is not None:
+            self.server.logger.log_send(self,rdata)
+            return rdata
+        try:
+            request = DNSRecord.parse(data)
+            self.server.logger.log_request(self,request)
+            reply = self.server.resolver.resolve(request,self)
+            self.server.logger.log_reply(self,reply)
+            rdata = reply.pack()
+            if self.udplen and len(rdata) > self.udplen:
+                truncated_reply = reply.truncate()
+                rdata = truncated_reply.pack()
+                self.server.logger.log_truncated(self,truncated_reply)
+            self.server.logger.log_send(self,rdata)
+            return rdata
+        except DNSError as e:
+            self.server.logger.log_error(self,e)
+            return None
+
+class BatchUDPServer(object):
+
+    """
+        Batched UDP server (see module docstring)
+    """
+    def __init__(self,resolver,
+                      address="",
+                      port=53,
+                      logger=None,
+                      handler=BatchDNSHandler,
+                      reuse_port=False,
+                      max_batch=64,
+                      bufsize=4096):
+        """
+            resolver:   resolver instance
+            address:    listen address (default: "")
+            port:       listen port (default: 53)
+            logger:     logger instance (default: DNSLogger)
+            handler:    handler class (default: BatchDNSHandler)
+            reuse_port: set SO_REUSEPORT (default: False)
+            max_batch:  max datagrams handled per wakeup (default: 64)
+            bufsize:    receive buffer size per datagram (default: 4096)
+        """
+        self.resolver = resolver
+        self.logger = logger or DNSLogger()
+        self.handler = handler
+        self.max_batch = max_batch
+        self.buffers = [ bytearray(bufsize) for _ in range(max_batch) ]
+        self.views = [ memoryview(b) for b in self.buffers ]
+        self.thread = None
+        self.stopping = False
+        self.wakeups = 0
+        self.packets = 0
+        self.max_seen = 0
+        self.socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        try:
+            if reuse_port:
+                set_reuse_port(self.socket)
+            self.socket.bind((address,port))
+        except:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+        if hasattr(self.socket,"recvmsg_into"):
+            self.recv_into = self._recvmsg_into
+        else:
+            self.recv_into = self.socket.recvfrom_into
+
+    def _recvmsg_into(self,buf):
+        nbytes,ancdata,flags,addr = self.socket.recvmsg_into([buf])
+        return nbytes,addr
+
+    def receive_batch(self):
+        """
+            Return list of (data,address) for the waiting datagrams.
+            data is a view of one of the preallocated buffers, so is only
+            valid until the next call
+        """
+        batch = []
+        for view in self.views:
+            try:
+                nbytes,addr = self.recv_into(view)
+            except (BlockingIOError,InterruptedError):
+                break
+            except OSError:
+                # eg. ICMP port unreachable from an earlier reply
+                continue
+            batch.append((view[:nbytes],addr))
+        return batch
+
+    def send_batch(self,replies):
+        for rdata,addr in replies:
+            try:
+                self.socket.sendto(rdata,addr)
+            except (BlockingIOError,InterruptedError):
+                # Send buffer full - wait briefly for room, then retry once
+                select.select([],[self.socket],[],0.1)
+                try:
+                    self.socket.sendto(rdata,addr)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+    def serve_forever(self,poll_interval=0.5):
+        while not self.stopping:
+            r,_,_ = select.select([self.socket],[],[],poll_interval)
+            if not r:
+                continue
+            batch = self.receive_batch()
+            if not batch:
+                continue
+            self.wakeups += 1
+            self.packets += len(batch)
+            self.max_seen = max(self.max_seen,len(batch))
+            replies = []
+            for data,addr in batch:
+                handler = self.handler(self,addr)
+                try:
+                    rdata = handler.handle(data)
+                except Exception as e:
+                    # Resolver error - answer SERVFAIL rather than let
+                    # it stop the server thread
+                    self.logger.log_error(handler,e)
+                    rdata = servfail(data)
+                if rdata is not None:
+                    replies.append((rdata,addr))
+            self.send_batch(replies)
+
+    def start(self):
+        self.serve_forever()
+
+    def start_thread(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.socket.close()
+
+    def isAlive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self):
+        return {
+            'wakeups': self.wakeups,
+            'packets': self.packets,
+            'packets_per_wakeup': (float(self.packets) / self.wakeups
+                                        if self.wakeups else 0.0),
+            'max_batch': self.max_seen,
+        }
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for dnslib
+
+    Run as:
+
+        python -m dnslib.benchmark <benchmark> [options]
+
+    Benchmarks:
+
+        server      - UDP queries/sec for the threaded (socketserver)
+                      DNSServer vs AsyncDNSServer vs BatchUDPServer, with
+                      a trivial resolver and a number of concurrent clients
+
+        upstream    - upstream queries/sec from a number of client threads
+                      with a socket per query (DNSRecord.send) vs the
+                      pooled/multiplexed Upstream transport, and with all
+                      queries in flight at once (Upstream.submit)
+
+        parse       - DNSRecord.parse throughput on the captured packets in
+                      dnslib/test (queries and responses)
+
+        reply       - time to answer a query with a single A record using
+                      the DNSRecord object model vs QueryView/ReplyTemplate
+
+        glob        - matching query names against a large set of glob
+                      rules (like InterceptResolver skip/nxdomain lists)
+                      with DNSLabel.matchGlob vs a compiled GlobSet
+
+        memory      - memory used per RR when holding a large zone
+                      (generated A/MX/CNAME records loaded with RR.fromZone)
+
+        zone        - zone file parsing (generated zone) with ZoneParser
+                      (WordLexer) vs the streaming FastZoneParser
+"""
+
+from __future__ import print_function
+
+import argparse,binascii,glob,os.path,socket,sys,threading,time,tracemalloc
+
+from dnslib.dns import DNSRecord
+
+QUIET_LOG = "-request,-reply,-truncated,-error"
+
+def udp_client_load(address,port,queries,clients,timeout=1.0):
+    """
+        Send 'queries' queries from 'clients' concurrent client sockets
+        (each client waits for its reply before sending the next query).
+        Returns (elapsed seconds, answered, timed out)
+    """
+    packet = DNSRecord.question("bench.example.").pack()
+    per_client = queries // clients
+    results = []
+
+    def client():
+        s = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        s.settimeout(timeout)
+        answered = lost = 0
+        for _ in range(per_client):
+            s.sendto(packet,(address,port))
+            try:
+                s.recv(8192)
+                answered += 1
+            except socket.timeout:
+                lost += 1
+        s.close()
+        results.append((answered,lost))
+
+    threads = [ threading.Thread(target=client) for _ in range(clients) ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return (elapsed,sum(r[0] for r in results),sum(r[1] for r in results))
+
+def bench_server(args):
+    from dnslib.server import DNSServer,BaseResolver,DNSLogger
+    from dnslib.asyncserver import AsyncDNSServer
+    from dnslib.batchserver import BatchUDPServer
+
+    resolver = BaseResolver()
+    logger = DNSLogger(QUIET_LOG)
+    engines = [("threaded",DNSServer),("asyncio",AsyncDNSServer),
+               ("batch",BatchUDPServer)]
+    for (name,engine) in engines:
+        server = engine(resolver,address="127.0.0.1",port=args.port,logger=logger)
+        server.start_thread()
+        # Warm up
+        udp_client_load("127.0.0.1",args.port,args.clients * 10,args.clients)
+        elapsed,answered,lost = udp_client_load("127.0.0.1",args.port,
+                                                args.queries,args.clients)
+        server.stop()
+        extra = ""
+        if hasattr(server,"stats"):
+            extra = "  %.1f packets/wakeup" % server.stats()['packets_per_wakeup']
+        print("%-10s %8d queries %8.0f q/s  (%d lost)%s" % (
+                    name,answered,answered / elapsed,lost,extra))
+
+def bench_upstream(args):
+    from dnslib.server import BaseResolver,DNSLogger
+    from dnslib.batchserver import BatchUDPServer
+    from dnslib.upstream import Upstream
+
+    server = BatchUDPServer(BaseResolver(),address="127.0.0.1",port=args.port,
+                            logger=DNSLogger(QUIET_LOG))
+    server.start_thread()
+    upstream = Upstream("127.0.0.1",args.port,timeout=2)
+    packet = DNSRecord.question("bench.example.").pack()
+    request = DNSRecord.parse(packet)
+
+    def per_socket():
+        request.send("127.0.0.1",args.port,timeout=2)
+
+    def pooled():
+        upstream.query(packet)
+
+    per_client = args.queries // args.clients
+    for (name,f) in [("socket",per_socket),("pooled",pooled)]:
+        def client():
+            for _ in range(per_client):
+                f()
+        threads = [ threading.Thread(target=client) for _ in range(args.clients) ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        n = per_client * args.clients
+        print("%-10s %8d queries %8.0f q/s" % (name,n,n / elapsed))
+
+    # Many in flight at once (in batches of 200 - more than this overflows
+    # the stand-in server's socket receive buffer)
+    start = time.perf_counter()
+    n = lost = 0
+    while n < args.queries:
+        futures = [ upstream.submit(packet) for _ in range(200) ]
+        for f in futures:
+            try:
+                f.result()
+            except socket.timeout:
+                lost += 1
+        n += len(futures)
+    elapsed = time.perf_counter() - start
+    print("%-10s %8d queries %8.0f q/s  (%d lost)" % ("submit",n,n / elapsed,lost))
+    upstream.close()
+    server.stop()
+
+def test_packets(pattern="*"):
+    """
+        Return list of packets (bytes) from the dnslib/test data files
+    """
+    testdir = os.path.join(os.path.dirname(__file__),"test")
+    packets = []
+    for f in sorted(glob.glob(os.path.join(testdir,pattern))):
+        if not os.path.isfile(f):
+            continue
+        with open(f,"rb") as fh:
+            for l in fh:
+                if l.startswith(b';; QUERY:') or l.startswith(b';; RESPONSE:'):
+                    packets.append(binascii.unhexlify(l.split()[2]))
+    return packets
+
+def bench_parse(args):
+    packets = test_packets()
+    nbytes = sum(len(p) for p in packets)
+    rounds = max(1,args.queries // len(packets))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for p in packets:
+            DNSRecord.parse(p)
+    elapsed = time.perf_counter() - start
+    n = rounds * len(packets)
+    print("parse      %8d packets %8.0f packets/s %6.2f MB/s (avg %d bytes)" % (
+                n,n / elapsed,rounds * nbytes / elapsed / 1e6,nbytes // len(packets)))
+
+def bench_reply(args):
+    from dnslib.dns import RR,QTYPE,A
+    from dnslib.queryview import QueryView
+
+    packet = DNSRecord.question("ap-0123456789ab--50.0123abcd.0001.example.test").pack()
+
+    def object_model():
+        request = DNSRecord.parse(packet)
+        reply = request.reply()
+        reply.add_answer(RR(request.q.qname,QTYPE.A,ttl=120,rdata=A("127.0.0.3")))
+        return reply.pack()
+
+    def template():
+        query = QueryView(packet)
+        query.qname
+        return query.reply_a("127.0.0.3",120)
+
+    assert object_model() == template()
+    for (name,f) in [("object",object_model),("template",template)]:
+        start = time.perf_counter()
+        for _ in range(args.queries):
+            f()
+        elapsed = time.perf_counter() - start
+        print("%-10s %8d replies %8.0f replies/s %6.1f us/reply" % (
+                    name,args.queries,args.queries / elapsed,
+                    elapsed / args.queries * 1e6))
+
+def generate_rules(n):
+    """
+        n glob rules - a mix of domain wildcards, prefix wildcards,
+        single character wildcards and exact names
+    """
+    rules = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            rules.append("*.domain%d.com" % i)
+        elif kind == 1:
+            rules.append("ads%d.*" % i)
+        elif kind == 2:
+            rules.append("host%d.sub?.example.net" % i)
+        else:
+            rules.append("exact%d.example.org" % i)
+    return rules
+
+def bench_glob(args):
+    import random
+    from dnslib.label import DNSLabel
+    from dnslib.globmatch import GlobSet
+
+    rules = generate_rules(args.rules)
+    rng = random.Random(1)
+    names = []
+    for i in range(1000):
+        j = rng.randrange(args.rules * 2)
+        names.append(DNSLabel(rng.choice(["www.domain%d.com","ads%d.tracker.io",
+                                          "host%d.sub1.example.net",
+                                          "exact%d.example.org",
+                                          "miss%d.example.com"]) % j))
+
+    def linear(qname):
+        return any([ qname.matchGlob(r) for r in rules ])
+
+    compiled = GlobSet(rules)
+    for qname in names:
+        assert linear(qname) == compiled.match(qname)
+    for (name,f) in [("matchGlob",linear),("GlobSet",compiled.match)]:
+        n = 0
+        start = time.perf_counter()
+        while n < args.queries:
+            for qname in names:
+                f(qname)
+            n += len(names)
+            if name == "matchGlob" and time.perf_counter() - start > 5:
+                break
+        elapsed = time.perf_counter() - start
+        print("%-10s %8d rules %8d names %10.0f names/s %10.1f us/name" % (
+                    name,len(rules),n,n / elapsed,elapsed / n * 1e6))
+
+def generate_zone(n,origin="example.com."):
+    """
+        Zone file text with n records (mostly A, some MX/CNAME)
+    """
+    lines = ["$ORIGIN %s" % origin,"$TTL 300"]
+    for i in range(n):
+        if i % 10 == 0:
+            lines.append("host%d IN MX 10 mail%d" % (i,i))
+        elif i % 10 == 1:
+            lines.append("alias%d IN CNAME host%d" % (i,i - 1))
+        else:
+            lines.append("host%d IN A 10.%d.%d.%d" % (i,i >> 16 & 255,i >> 8 & 255,i & 255))
+    return "\n".join(lines) + "\n"
+
+def bench_memory(args):
+    from dnslib.dns import RR
+    zone = generate_zone(args.records)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rrs = RR.fromZone(zone)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("memory     %8d RRs %10d bytes %6.0f bytes/RR" % (
+                len(rrs),used,float(used) / len(rrs)))
+
+def bench_zone(args):
+    from dnslib.dns import ZoneParser
+    from dnslib.zonefile import FastZoneParser
+    zone = generate_zone(args.records)
+    expected = None
+    for name,parser in (("ZoneParser",ZoneParser),
+                        ("FastZone",FastZoneParser)):
+        start = time.perf_counter()
+        rrs = list(parser(zone))
+        elapsed = time.perf_counter() - start
+        if expected is None:
+            expected = rrs
+        elif rrs != expected:
+            print("%-10s !! records differ from ZoneParser" % name)
+        print("%-10s %8d RRs %10.0f RRs/s %6.2f MB/s" % (
+                    name,len(rrs),len(rrs) / elapsed,len(zone) / elapsed / 1e6))
+
+BENCHMARKS = {
+    'server': bench_server,
+    'upstream': bench_upstream,
+    'parse': bench_parse,
+    'reply': bench_reply,
+    'glob': bench_glob,
+    'memory': bench_memory,
+    'zone': bench_zone,
+}
+
+if __name__ == '__main__':
+
+    p = argparse.ArgumentParser(description="dnslib benchmarks")
+    p.add_argument("benchmark",choices=sorted(BENCHMARKS))
+    p.add_argument("--queries","-n",type=int,default=20000,
+                    help="Number of queries/packets (default: 20000)")
+    p.add_argument("--clients","-c",type=int,default=8,
+                    help="Concurrent clients (server/upstream) (default: 8)")
+    p.add_argument("--rules",type=int,default=5000,
+                    help="Number of glob rules (glob) (default: 5000)")
+    p.add_argument("--records","-r",type=int,default=20000,
+                    help="Number of records (memory/zone) (default: 20000)")
+    p.add_argument("--port","-p",type=int,default=8053,
+                    help="Server port (server/upstream) (default: 8053)")
+    args = p.parse_args()
+    BENCHMARKS[args.benchmark](args)
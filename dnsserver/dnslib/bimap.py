@@ -69,6 +69,9 @@ class Bimap(object):
 
     def __getattr__(self,k):
         try:
+            # inspect.unwrap (used by doctest) probes for __wrapped__
+            if k == "__wrapped__":
+                raise AttributeError()
             return self.reverse[k]
         except KeyError as e:
             raise self.error("%s: Invalid reverse lookup: [%s]" % (self.name,k))
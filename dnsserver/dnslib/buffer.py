@@ -9,6 +9,18 @@ import binascii,struct
 class BufferError(Exception):
     pass
 
+_structs = {}
+
+def compiled(fmt):
+    """
+        Return (cached) struct.Struct for fmt
+    """
+    try:
+        return _structs[fmt]
+    except KeyError:
+        s = _structs[fmt] = struct.Struct(fmt)
+        return s
+
 class Buffer(object):
 
     """
@@ -40,13 +52,27 @@ class Buffer(object):
     >>> b.offset = 7
     >>> bytearray(b.get(5))
     bytearray(b'xx234')
+
+    A buffer created with view=True reads directly from the data (through
+    a memoryview) rather than copying it - it can't be appended to
+
+    >>> v = Buffer(b"abcdefg",view=True)
+    >>> v.unpack("!BH")
+    (97, 25187)
+    >>> bytearray(v.get(3))
+    bytearray(b'def')
+    >>> v.remaining()
+    1
     """
 
-    def __init__(self,data=b''):
+    def __init__(self,data=b'',view=False):
         """
-            Initialise Buffer from data
+            Initialise Buffer from data (copied unless view is True)
         """
-        self.data = bytearray(data)
+        if view:
+            self.data = memoryview(data)
+        else:
+            self.data = bytearray(data)
         self.offset = 0
 
     def remaining(self):
@@ -78,8 +104,9 @@ class Buffer(object):
             Pack data at end of data according to fmt (from struct) & increment
             offset
         """
-        self.offset += struct.calcsize(fmt)
-        self.data += struct.pack(fmt,*args)
+        s = compiled(fmt)
+        self.offset += s.size
+        self.data += s.pack(*args)
 
     def append(self,s):
         """
@@ -92,19 +119,23 @@ class Buffer(object):
         """
             Modify data at offset `ptr` 
         """
-        s = struct.pack(fmt,*args)
-        self.data[ptr:ptr+len(s)] = s
+        compiled(fmt).pack_into(self.data,ptr,*args)
 
     def unpack(self,fmt):
         """
             Unpack data at current offset according to fmt (from struct)
         """
+        s = compiled(fmt)
+        if s.size > self.remaining():
+            raise BufferError("Not enough bytes [offset=%d,remaining=%d,requested=%d]" %
+                    (self.offset,self.remaining(),s.size))
         try:
-            data = self.get(struct.calcsize(fmt))
-            return struct.unpack(fmt,data)
+            data = s.unpack_from(self.data,self.offset)
         except struct.error as e:
             raise BufferError("Error unpacking struct '%s' <%s>" % 
-                    (fmt,binascii.hexlify(data).decode()))
+                    (fmt,binascii.hexlify(self.data[self.offset:self.offset+s.size]).decode()))
+        self.offset += s.size
+        return data
 
     def __len__(self):
         return len(self.data)
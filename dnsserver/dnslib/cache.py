@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+"""
+    DNSCache - in-process cache of upstream replies for the proxy resolvers
+
+    (SingleFlight - coalescing of identical in-flight upstream requests -
+    is also here as it uses the same key)
+
+    Replies are keyed on (qname,qtype,qclass,DO bit) - qname is compared
+    case-insensitively - and stored packed, so the cache size can be
+    bounded in bytes (least recently used entries are evicted first).
+
+        - NOERROR replies with answers are cached for the minimum TTL of
+          the answers
+        - NXDOMAIN and NODATA (NOERROR, no answers) replies are cached for
+          the SOA TTL/minimum (whichever is lower) from the authority
+          section (RFC 2308) - without an SOA they aren't cached
+        - truncated replies and other rcodes aren't cached
+
+    get() returns a fresh DNSRecord with the request id and question, and
+    the TTLs reduced by the time the reply has spent in the cache (for
+    negative replies the SOA TTL is the remaining negative TTL).
+
+    >>> cache = DNSCache()
+    >>> q = DNSRecord.question("abc.com")
+    >>> cache.get(q,now=0) is None
+    True
+    >>> a = q.reply()
+    >>> a.add_answer(*RR.fromZone("abc.com 60 A 1.2.3.4"))
+    >>> a.add_answer(*RR.fromZone("abc.com 30 A 5.6.7.8"))
+    >>> cache.put(q,a,now=0)
+    True
+
+    Hits are returned with the request id/question and TTLs rewritten
+
+    >>> q2 = DNSRecord.question("ABC.com")
+    >>> r = cache.get(q2,now=10)
+    >>> r.header.id == q2.header.id, str(r.q.qname)
+    (True, 'ABC.com.')
+    >>> [ rr.ttl for rr in r.rr ]
+    [50, 20]
+    >>> cache.get(q2,now=30) is None
+    True
+
+    DO bit is part of the key
+
+    >>> q.add_ar(EDNS0(flags="do"))
+    >>> cache.put(q,a,now=0)
+    True
+    >>> cache.get(DNSRecord.question("abc.com"),now=0) is None
+    True
+    >>> cache.get(q,now=0) is not None
+    True
+
+    Negative caching uses the SOA minimum
+
+    >>> q = DNSRecord.question("nx.abc.com")
+    >>> a = q.reply()
+    >>> a.header.rcode = RCODE.NXDOMAIN
+    >>> cache.put(q,a,now=0)
+    False
+    >>> a.add_auth(*RR.fromZone("abc.com 3600 SOA ns.abc.com. admin.abc.com. 1 3600 600 86400 300"))
+    >>> cache.put(q,a,now=0)
+    True
+    >>> r = cache.get(q,now=100)
+    >>> RCODE[r.header.rcode],r.auth[0].ttl
+    ('NXDOMAIN', 200)
+    >>> cache.get(q,now=300) is None
+    True
+
+    Size is bounded (LRU)
+
+    >>> cache = DNSCache(max_bytes=1000)
+    >>> for i in range(20):
+    ...     q = DNSRecord.question("host%d.abc.com" % i)
+    ...     a = q.reply()
+    ...     a.add_answer(*RR.fromZone("host%d.abc.com 60 A 1.2.3.4" % i))
+    ...     _ = cache.put(q,a,now=0)
+    >>> s = cache.stats()
+    >>> s['bytes'] <= 1000, s['entries'] + s['evictions'] == 20
+    (True, True)
+"""
+
+from __future__ import print_function
+
+import collections,threading,time
+
+from dnslib.dns import DNSRecord,RR,QTYPE,RCODE,EDNS0
+from dnslib.globmatch import name_key
+
+# Rough per-entry overhead (key tuple, entry list, OrderedDict node)
+ENTRY_OVERHEAD = 200
+
+class DNSCache(object):
+    """
+        LRU/TTL reply cache (see module docstring)
+    """
+
+    def __init__(self,max_bytes=16*1024*1024,max_ttl=86400,min_ttl=0):
+        """
+            max_bytes   - max size of cached replies (approx)
+            max_ttl     - max time to cache a reply (seconds)
+            min_ttl     - don't cache replies with a TTL below this
+        """
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.min_ttl = min_ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def key(self,request):
+        return request_key(request)
+
+    def reply_ttl(self,reply):
+        """
+            How long reply can be cached for (None if it can't be cached)
+        """
+        if reply.header.tc:
+            return None
+        rcode = reply.header.rcode
+        if rcode == RCODE.NOERROR and reply.rr:
+            ttl = min([ rr.ttl for rr in reply.rr ])
+        elif rcode in (RCODE.NOERROR,RCODE.NXDOMAIN):
+            soa = [ rr for rr in reply.auth if rr.rtype == QTYPE.SOA ]
+            if not soa:
+                return None
+            ttl = min(soa[0].ttl,soa[0].rdata.times[4])
+        else:
+            return None
+        ttl = min(ttl,self.max_ttl)
+        if ttl <= 0 or ttl < self.min_ttl:
+            return None
+        return ttl
+
+    def put(self,request,reply,now=None):
+        """
+            Cache reply to request (returns True if cached)
+        """
+        ttl = self.reply_ttl(reply)
+        if ttl is None:
+            return False
+        now = time.monotonic() if now is None else now
+        data = bytes(reply.pack())
+        key = self.key(request)
+        size = len(data) + sum([ len(l) for l in key[0] ]) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            old = self.entries.pop(key,None)
+            if old is not None:
+                self.bytes -= old[3]
+            self.entries[key] = [now + ttl,now,data,size]
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _,(_,_,_,evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return True
+
+    def get(self,request,now=None):
+        """
+            Cached reply for request (or None)
+        """
+        now = time.monotonic() if now is None else now
+        key = self.key(request)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                self.bytes -= entry[3]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        expires,stored,data,size = entry
+        reply = DNSRecord.parse(data)
+        reply.header.id = request.header.id
+        reply.questions = list(request.questions)
+        elapsed = int(now - stored)
+        for rr in reply.rr + reply.auth + reply.ar:
+            if rr.rtype != QTYPE.OPT:
+                rr.ttl = max(0,rr.ttl - elapsed)
+        if not reply.rr:
+            # Negative reply - SOA TTL is the remaining negative TTL
+            for rr in reply.auth:
+                if rr.rtype == QTYPE.SOA:
+                    rr.ttl = min(rr.ttl,max(0,int(expires - now)))
+        return reply
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+        }
+
+class Flight(object):
+
+    __slots__ = ('event','reply','error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.reply = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+        Coalesce identical concurrent upstream requests - the first
+        request for a key (the leader) calls fetch(), and requests for the
+        same key which arrive while it is running wait for its reply
+        rather than sending their own. Each caller gets its own copy of
+        the reply with its own id and question.
+
+        >>> flights = SingleFlight()
+        >>> calls = []
+        >>> def fetch(request):
+        ...     calls.append(request)
+        ...     time.sleep(0.2)
+        ...     reply = request.reply()
+        ...     reply.add_answer(*RR.fromZone("abc.com 60 A 1.2.3.4"))
+        ...     return reply
+        >>> requests = [ DNSRecord.question("abc.com") for i in range(10) ]
+        >>> replies = {}
+        >>> def run(r):
+        ...     replies[r.header.id] = flights.do(r,lambda: fetch(r))
+        >>> threads = [ threading.Thread(target=run,args=(r,)) for r in requests ]
+        >>> for t in threads: t.start()
+        >>> for t in threads: t.join()
+        >>> len(calls)
+        1
+        >>> all([ replies[r.header.id].header.id == r.header.id for r in requests ])
+        True
+        >>> len(set([ id(r) for r in replies.values() ]))
+        10
+        >>> s = flights.stats()
+        >>> s['flights'],s['coalesced'],s['coalescing_ratio']
+        (1, 9, 0.9)
+
+        If fetch() raises, the followers get the same exception, and if
+        it returns None (no reply) so do they
+
+        >>> def run(r,fetch):
+        ...     try:
+        ...         replies[r.header.id] = flights.do(r,fetch)
+        ...     except Exception as e:
+        ...         replies[r.header.id] = repr(e)
+        >>> def fail():
+        ...     time.sleep(0.2)
+        ...     raise OSError("upstream unreachable")
+        >>> def empty():
+        ...     time.sleep(0.2)
+        >>> for fetch in (fail,empty):
+        ...     replies = {}
+        ...     threads = [ threading.Thread(target=run,args=(r,fetch))
+        ...                     for r in requests ]
+        ...     for t in threads: t.start()
+        ...     for t in threads: t.join()
+        ...     print(set(replies.values()))
+        {"OSError('upstream unreachable')"}
+        {None}
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self,request,fetch,extra=()):
+        """
+            Reply (DNSRecord) to request from fetch() - or from a call to
+            fetch() already in progress for the same key (request_key
+            plus 'extra')
+        """
+        key = request_key(request) + tuple(extra)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if leader:
+            try:
+                flight.reply = fetch()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight.event.set()
+        else:
+            flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        if leader or flight.reply is None:
+            return flight.reply
+        reply = DNSRecord.parse(flight.reply.pack())
+        reply.header.id = request.header.id
+        reply.questions = list(request.questions)
+        return reply
+
+    def stats(self):
+        total = self.leaders + self.followers
+        return {
+            'in_flight': len(self.flights),
+            'flights': self.leaders,
+            'coalesced': self.followers,
+            'coalescing_ratio': float(self.followers) / total if total else 0.0,
+        }
+
+def request_key(request):
+    """
+        (lowercased qname,qtype,qclass,DO bit) for request
+    """
+    q = request.q
+    do = 0
+    for rr in request.ar:
+        if rr.rtype == QTYPE.OPT:
+            do = rr.edns_do
+    return (name_key(q.qname),q.qtype,q.qclass,do)
+
+def log_cache(handler,request,status,cache):
+    """
+        Call the logger log_cache hook (if the handler/logger has one)
+    """
+    logger = getattr(getattr(handler,"server",None),"logger",None)
+    hook = getattr(logger,"log_cache",None)
+    if hook is not None:
+        hook(handler,request,status,cache.stats())
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -92,8 +92,11 @@ class DNSRecord(object):
         """
             Parse DNS packet data and return DNSRecord instance
             Recursively parses sections (calling appropriate parse method)
+
+            The packet is parsed in place (through a memoryview) - it
+            isn't copied
         """
-        buffer = DNSBuffer(packet)
+        buffer = DNSBuffer(packet,view=True)
         try:
             header = DNSHeader.parse(buffer)
             questions = []
@@ -465,6 +468,8 @@ class DNSHeader(object):
         DNSHeader section
     """
 
+    __slots__ = ('_id','_bitmap','_q','_a','_auth','_ar')
+
     # Ensure attribute values match packet
     id = H('id')
     bitmap = H('bitmap')
@@ -518,7 +523,7 @@ class DNSHeader(object):
     # Accessors for header properties (automatically pack/unpack
     # into bitmap)
     def get_qr(self):
-        return get_bits(self.bitmap,15)
+        return (self.bitmap >> 15) & 1
 
     def set_qr(self,val):
         self.bitmap = set_bits(self.bitmap,val,15)
@@ -526,7 +531,7 @@ class DNSHeader(object):
     qr = property(get_qr,set_qr)
 
     def get_opcode(self):
-        return get_bits(self.bitmap,11,4)
+        return (self.bitmap >> 11) & 0xF
 
     def set_opcode(self,val):
         self.bitmap = set_bits(self.bitmap,val,11,4)
@@ -534,7 +539,7 @@ class DNSHeader(object):
     opcode = property(get_opcode,set_opcode)
 
     def get_aa(self):
-        return get_bits(self.bitmap,10)
+        return (self.bitmap >> 10) & 1
 
     def set_aa(self,val):
         self.bitmap = set_bits(self.bitmap,val,10)
@@ -542,7 +547,7 @@ class DNSHeader(object):
     aa = property(get_aa,set_aa)
         
     def get_tc(self):
-        return get_bits(self.bitmap,9)
+        return (self.bitmap >> 9) & 1
 
     def set_tc(self,val):
         self.bitmap = set_bits(self.bitmap,val,9)
@@ -550,7 +555,7 @@ class DNSHeader(object):
     tc = property(get_tc,set_tc)
         
     def get_rd(self):
-        return get_bits(self.bitmap,8)
+        return (self.bitmap >> 8) & 1
 
     def set_rd(self,val):
         self.bitmap = set_bits(self.bitmap,val,8)
@@ -558,7 +563,7 @@ class DNSHeader(object):
     rd = property(get_rd,set_rd)
         
     def get_ra(self):
-        return get_bits(self.bitmap,7)
+        return (self.bitmap >> 7) & 1
 
     def set_ra(self,val):
         self.bitmap = set_bits(self.bitmap,val,7)
@@ -566,7 +571,7 @@ class DNSHeader(object):
     ra = property(get_ra,set_ra)
 
     def get_rcode(self):
-        return get_bits(self.bitmap,0,4)
+        return self.bitmap & 0xF
 
     def set_rcode(self,val):
         self.bitmap = set_bits(self.bitmap,val,0,4)
@@ -634,6 +639,8 @@ class DNSQuestion(object):
         DNSQuestion section
     """
         
+    __slots__ = ('_qname','qtype','qclass')
+
     @classmethod
     def parse(cls,buffer):
         try:
@@ -708,6 +715,8 @@ class EDNSOption(object):
 
     """
 
+    __slots__ = ('_code','_data')
+
     code = H('code')
     data = BYTES('data')
 
@@ -748,6 +757,9 @@ class RR(object):
         Contains RR header and RD (resource data) instance
     """
 
+    __slots__ = ('_rname','_rtype','_rclass','_ttl','_rdlength','rdata',
+                 'edns_len','edns_do','edns_ver','edns_rcode')
+
     rtype = H('rtype')
     rclass = H('rclass')
     ttl = I('ttl')
@@ -911,6 +923,8 @@ class EDNS0(RR):
         True
     """
 
+    __slots__ = ()
+
     def __init__(self,rname=None,rtype=QTYPE.OPT,
             ext_rcode=0,version=0,flags="",udp_len=0,opts=None):
         check_range('ext_rcode',ext_rcode,0,255)
@@ -941,6 +955,8 @@ class RD(object):
         blob (this allows round-trip encoding/decoding)
     """
 
+    __slots__ = ('data',)
+
     @classmethod
     def parse(cls,buffer,length):
         """
@@ -1028,6 +1044,8 @@ class TXT(RD):
         example.com.            120     IN      TXT     "txtvers=1" "swver=2.3"
     """
 
+    __slots__ = ()
+
     @classmethod
     def parse(cls,buffer,length):
         try:
@@ -1075,6 +1093,8 @@ class TXT(RD):
 
 class A(RD):
 
+    __slots__ = ('_data',)
+
     data = IP4('data')
 
     @classmethod
@@ -1164,6 +1184,8 @@ class AAAA(RD):
         a tuple of 16 bytes or in text format
     """
  
+    __slots__ = ('_data',)
+
     data = IP6('data')
 
     @classmethod
@@ -1193,6 +1215,8 @@ class AAAA(RD):
 
 class MX(RD):
 
+    __slots__ = ('_preference','_label')
+
     preference = H('preference')
 
     @classmethod
@@ -1235,6 +1259,8 @@ class MX(RD):
 
 class CNAME(RD):
         
+    __slots__ = ('_label',)
+
     @classmethod
     def parse(cls,buffer,length):
         try:
@@ -1271,13 +1297,15 @@ class CNAME(RD):
     attrs = ('label',)
 
 class PTR(CNAME):
-    pass
+    __slots__ = ()
 
 class NS(CNAME):
-    pass
+    __slots__ = ()
 
 class SOA(RD):
         
+    __slots__ = ('_mname','_rname','_times')
+
     times = ntuple_range('times',5,0,4294967295)
     @classmethod
     def parse(cls,buffer,length):
@@ -1334,6 +1362,8 @@ class SOA(RD):
 
 class SRV(RD):
         
+    __slots__ = ('_priority','_weight','_port','_target')
+
     priority = H('priority')
     weight = H('weight')
     port = H('port')
@@ -1380,6 +1410,8 @@ class SRV(RD):
 
 class NAPTR(RD):
 
+    __slots__ = ('_order','_preference','flags','service','regexp','_replacement')
+
     order = H('order')
     preference = H('preference')
 
@@ -1447,6 +1479,8 @@ class NAPTR(RD):
 
 class DNSKEY(RD):
 
+    __slots__ = ('_flags','_protocol','_algorithm','key')
+
     flags = H('flags')
     protocol = B('protocol')
     algorithm = B('algorithm')
@@ -1484,6 +1518,9 @@ class DNSKEY(RD):
 
 class RRSIG(RD):
 
+    __slots__ = ('_covered','_algorithm','_labels','_orig_ttl','_sig_exp',
+                 '_sig_inc','_key_tag','name','sig')
+
     covered = H('covered')
     algorithm = B('algorithm')
     labels = B('labels')
@@ -54,6 +54,12 @@ if __name__ == '__main__':
                     help="TCP server (default: UDP only)")
     p.add_argument("--log",default="request,reply,truncated,error",
                     help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data)")
+    p.add_argument("--pool-size",type=int,default=0,
+                    metavar="<threads>",
+                    help="Handle requests in a fixed pool of threads (default: 0 - thread per request)")
+    p.add_argument("--queue-size",type=int,default=256,
+                    metavar="<requests>",
+                    help="Max requests waiting for a pool thread before shedding load (default: 256)")
     p.add_argument("--log-prefix",action='store_true',default=False,
                     help="Log prefix (timestamp/handler/resolver) (default: False)")
     args = p.parse_args()
@@ -82,6 +88,8 @@ if __name__ == '__main__':
     udp_server = DNSServer(resolver,
                            port=args.port,
                            address=args.address,
+                           pool_size=args.pool_size,
+                           queue_size=args.queue_size,
                            logger=logger)
     udp_server.start_thread()
 
@@ -89,6 +97,8 @@ if __name__ == '__main__':
         tcp_server = DNSServer(resolver,
                                port=args.port,
                                address=args.address,
+                               pool_size=args.pool_size,
+                               queue_size=args.queue_size,
                                tcp=True,
                                logger=logger)
         tcp_server.start_thread()
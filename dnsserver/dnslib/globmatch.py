@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+    GlobSet - compiled set of glob patterns (as used by DNSLabel.matchGlob)
+
+    DNSLabel.matchGlob converts both labels to lowercase strings and runs
+    fnmatch for every pattern, so checking a name against a list of
+    patterns costs one fnmatch call per pattern. GlobSet compiles the
+    patterns once, with the same match semantics:
+
+        - patterns without glob characters go in a dict keyed on the
+          lowercased label tuple
+        - other patterns are grouped by their literal suffix (the
+          trailing labels without glob characters - a pattern can only
+          match names which end in these labels), and each group is
+          compiled into a single regex
+
+    A lookup builds the lowercase name once, and only tries the groups
+    for the suffixes of the name.
+
+    >>> rules = GlobSet(["*.ads.com","tracker.*","exact.org","a?c.net"])
+    >>> rules.match(DNSLabel("x.y.ADS.com"))
+    True
+    >>> rules.match(DNSLabel("ads.com"))
+    False
+    >>> rules.match(DNSLabel("tracker.abc.def"))
+    True
+    >>> rules.match("Exact.Org")
+    True
+    >>> rules.match("abc.net"),rules.match("abbc.net")
+    (True, False)
+    >>> rules.add("*")
+    4
+    >>> rules.matches("tracker.ads.com")
+    [0, 1, 4]
+    >>> rules.matches("exact.org")
+    [2, 4]
+    >>> all([ rules.match(n) == any([ DNSLabel(n).matchGlob(p) for p in rules ])
+    ...         for n in ("a.b","ads.com","x.ads.com","abc.net","xabc.net") ])
+    True
+"""
+
+from __future__ import print_function
+
+import fnmatch,re
+
+from dnslib.label import DNSLabel
+
+GLOB_CHARS = frozenset(b'*?[]')
+
+def name_key(label):
+    """
+        Index key for a DNSLabel (lowercased label tuple)
+    """
+    return tuple([ l.lower() for l in label.label ])
+
+def is_glob(label):
+    return bool(GLOB_CHARS.intersection(label))
+
+def literal_suffix(key):
+    """
+        Trailing labels of key without glob characters
+    """
+    n = len(key)
+    while n and not is_glob(key[n-1]):
+        n -= 1
+    return key[n:]
+
+def key_str(key):
+    """
+        Name string for key (same as str(DNSLabel(key)))
+    """
+    return ".".join([ l.decode() for l in key ]) + "."
+
+def compile_glob(pattern):
+    """
+        Compiled match function for a (lowercase str) glob pattern
+    """
+    return re.compile(fnmatch.translate(pattern)).match
+
+class GlobGroup(object):
+    """
+        Patterns with the same literal suffix
+    """
+
+    __slots__ = ('indexes','regexes','matchers','regex')
+
+    def __init__(self):
+        self.indexes = []
+        self.regexes = []
+        self.matchers = []
+        self.regex = None
+
+    def add(self,index,pattern):
+        self.indexes.append(index)
+        self.regexes.append(fnmatch.translate(pattern))
+        self.matchers.append(compile_glob(pattern))
+        self.regex = None
+
+    def match(self,name):
+        """
+            True if name (lowercase str) matches any pattern in the group
+        """
+        if self.regex is None:
+            # Compile lazily, so adding many patterns is cheap
+            self.regex = re.compile("|".join(self.regexes)).match
+        return self.regex(name) is not None
+
+    def matches(self,name):
+        """
+            Indexes of the patterns matching name
+        """
+        if not self.match(name):
+            return []
+        return [ i for i,m in zip(self.indexes,self.matchers) if m(name) ]
+
+class GlobSet(object):
+    """
+        Compiled set of glob patterns (see module docstring)
+    """
+
+    def __init__(self,patterns=()):
+        self.patterns = []
+        self.exact = {}
+        self.groups = {}
+        for p in patterns:
+            self.add(p)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def add(self,pattern):
+        """
+            Add pattern (str or DNSLabel) - returns its index
+        """
+        index = len(self.patterns)
+        self.patterns.append(pattern)
+        if type(pattern) != DNSLabel:
+            pattern = DNSLabel(pattern)
+        key = name_key(pattern)
+        suffix = literal_suffix(key)
+        if len(suffix) == len(key):
+            self.exact.setdefault(key,[]).append(index)
+        else:
+            group = self.groups.get(suffix)
+            if group is None:
+                group = self.groups[suffix] = GlobGroup()
+            group.add(index,str(pattern).lower())
+        return index
+
+    def candidate_groups(self,key):
+        groups = self.groups
+        if not groups:
+            return []
+        found = []
+        for i in range(len(key),-1,-1):
+            group = groups.get(key[i:])
+            if group is not None:
+                found.append(group)
+        return found
+
+    def match(self,name):
+        """
+            True if name (DNSLabel or str) matches any pattern
+        """
+        if type(name) != DNSLabel:
+            name = DNSLabel(name)
+        key = name_key(name)
+        if key in self.exact:
+            return True
+        groups = self.candidate_groups(key)
+        if groups:
+            name = key_str(key)
+            for group in groups:
+                if group.match(name):
+                    return True
+        return False
+
+    def matches(self,name):
+        """
+            Sorted list of indexes of the patterns which match name
+        """
+        if type(name) != DNSLabel:
+            name = DNSLabel(name)
+        key = name_key(name)
+        found = list(self.exact.get(key,()))
+        groups = self.candidate_groups(key)
+        if groups:
+            name = key_str(key)
+            for group in groups:
+                found.extend(group.matches(name))
+        found.sort()
+        return found
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -9,9 +9,12 @@ from __future__ import print_function
 
 import binascii,copy,socket,struct,sys
 
-from dnslib import DNSRecord,RR,QTYPE,RCODE,parse_time
+from dnslib import DNSRecord,DNSError,RR,QTYPE,RCODE,parse_time
 from dnslib.server import DNSServer,DNSHandler,BaseResolver,DNSLogger
 from dnslib.label import DNSLabel
+from dnslib.globmatch import GlobSet
+from dnslib.cache import DNSCache,SingleFlight,log_cache
+from dnslib.upstream import Upstream
 
 class InterceptResolver(BaseResolver):
 
@@ -20,9 +23,13 @@ class InterceptResolver(BaseResolver):
         
         Proxy requests to upstream server optionally intercepting requests
         matching local records
+
+        If the upstream doesn't reply (or can't be reached) the reply is
+        SERVFAIL, as for ProxyResolver
     """
 
-    def __init__(self,address,port,ttl,intercept,skip,nxdomain,timeout=0):
+    def __init__(self,address,port,ttl,intercept,skip,nxdomain,timeout=0,
+                 cache=None):
         """
             address/port    - upstream server
             ttl             - default ttl for intercept records
@@ -30,6 +37,7 @@ class InterceptResolver(BaseResolver):
             skip            - list of wildcard labels to skip 
             nxdomain        - list of wildcard labels to retudn NXDOMAIN
             timeout         - timeout for upstream server
+            cache           - DNSCache for proxied replies (default: None)
         """
         self.address = address
         self.port = port
@@ -37,43 +45,70 @@ class InterceptResolver(BaseResolver):
         self.skip = skip
         self.nxdomain = nxdomain
         self.timeout = timeout
+        self.cache = cache
+        self.flights = SingleFlight()
+        self.upstream = Upstream(address,port,timeout=timeout)
         self.zone = []
         for i in intercept:
             if i == '-':
                 i = sys.stdin.read()
             for rr in RR.fromZone(i,ttl=self.ttl):
                 self.zone.append((rr.rname,QTYPE[rr.rtype],rr))
+        # Compiled glob rules (one match per rule class per query)
+        self.skip_rules = GlobSet(skip)
+        self.nxdomain_rules = GlobSet(nxdomain)
+        self.zone_rules = GlobSet([ name for name,rtype,rr in self.zone ])
 
     def resolve(self,request,handler):
         reply = request.reply()
         qname = request.q.qname
         qtype = QTYPE[request.q.qtype]
         # Try to resolve locally unless on skip list
-        if not any([qname.matchGlob(s) for s in self.skip]):
-            for name,rtype,rr in self.zone:
-                if qname.matchGlob(name) and (qtype in (rtype,'ANY','CNAME')):
+        if not self.skip_rules.match(qname):
+            for i in self.zone_rules.matches(qname):
+                name,rtype,rr = self.zone[i]
+                if qtype in (rtype,'ANY','CNAME'):
                     a = copy.copy(rr)
                     a.rname = qname
                     reply.add_answer(a)
         # Check for NXDOMAIN
-        if any([qname.matchGlob(s) for s in self.nxdomain]):
+        if self.nxdomain_rules.match(qname):
             reply.header.rcode = getattr(RCODE,'NXDOMAIN')
             return reply
         # Otherwise proxy
         if not reply.rr:
+            if self.cache is not None:
+                cached = self.cache.get(request)
+                log_cache(handler,request,"HIT" if cached else "MISS",self.cache)
+                if cached is not None:
+                    return cached
             try:
-                if handler.protocol == 'udp':
-                    proxy_r = request.send(self.address,self.port,
-                                    timeout=self.timeout)
-                else:
-                    proxy_r = request.send(self.address,self.port,
-                                    tcp=True,timeout=self.timeout)
-                reply = DNSRecord.parse(proxy_r)
-            except socket.timeout:
-                reply.header.rcode = getattr(RCODE,'NXDOMAIN')
+                # Identical concurrent requests share one upstream query
+                reply = self.flights.do(request,
+                                        lambda: self.fetch(request,handler),
+                                        (handler.protocol,))
+            except (OSError,DNSError):
+                # Timeout/upstream unreachable/no query ids free (as
+                # ProxyResolver)
+                reply.header.rcode = getattr(RCODE,'SERVFAIL')
+
+        return reply
 
+    def fetch(self,request,handler):
+        proxy_r = self.upstream.query(request.pack(),
+                                      tcp=handler.protocol != 'udp')
+        reply = DNSRecord.parse(proxy_r)
+        if self.cache is not None:
+            self.cache.put(request,reply)
         return reply
 
+    def stats(self):
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'flights': self.flights.stats(),
+            'upstream': self.upstream.stats(),
+        }
+
 if __name__ == '__main__':
 
     import argparse,sys,time
@@ -105,8 +140,17 @@ if __name__ == '__main__':
     p.add_argument("--timeout","-o",type=float,default=5,
                     metavar="<timeout>",
                     help="Upstream timeout (default: 5s)")
+    p.add_argument("--cache-size",type=float,default=0,
+                    metavar="<MB>",
+                    help="Cache upstream replies (size in MB) (default: 0 - no cache)")
     p.add_argument("--log",default="request,reply,truncated,error",
-                    help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data)")
+                    help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data,-cache)")
+    p.add_argument("--pool-size",type=int,default=0,
+                    metavar="<threads>",
+                    help="Handle requests in a fixed pool of threads (default: 0 - thread per request)")
+    p.add_argument("--queue-size",type=int,default=256,
+                    metavar="<requests>",
+                    help="Max requests waiting for a pool thread before shedding load (default: 256)")
     p.add_argument("--log-prefix",action='store_true',default=False,
                     help="Log prefix (timestamp/handler/resolver) (default: False)")
     args = p.parse_args()
@@ -120,7 +164,9 @@ if __name__ == '__main__':
                                  args.intercept or [],
                                  args.skip or [],
                                  args.nxdomain or [],
-                                 args.timeout)
+                                 args.timeout,
+                                 DNSCache(int(args.cache_size * 1024 * 1024))
+                                    if args.cache_size else None)
     logger = DNSLogger(args.log,args.log_prefix)
 
     print("Starting Intercept Proxy (%s:%d -> %s:%d) [%s]" % (
@@ -147,6 +193,8 @@ if __name__ == '__main__':
     udp_server = DNSServer(resolver,
                            port=args.port,
                            address=args.address,
+                           pool_size=args.pool_size,
+                           queue_size=args.queue_size,
                            logger=logger)
     udp_server.start_thread()
 
@@ -154,6 +202,8 @@ if __name__ == '__main__':
         tcp_server = DNSServer(resolver,
                                port=args.port,
                                address=args.address,
+                               pool_size=args.pool_size,
+                               queue_size=args.queue_size,
                                tcp=True,
                                logger=logger)
         tcp_server.start_thread()
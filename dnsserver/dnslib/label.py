@@ -8,7 +8,7 @@ from __future__ import print_function
 
 import fnmatch
 
-from dnslib.bit import get_bits,set_bits
+from dnslib.bit import set_bits
 from dnslib.buffer import Buffer, BufferError
 
 class DNSLabelError(Exception):
@@ -60,6 +60,9 @@ class DNSLabel(object):
     # True
 
     """
+
+    __slots__ = ('label',)
+
     def __init__(self,label):
         """
             Create DNS label instance 
@@ -197,11 +200,11 @@ class DNSBuffer(Buffer):
     aaa.bbb.ccc.
     """
 
-    def __init__(self,data=b''):
+    def __init__(self,data=b'',view=False):
         """
             Add 'names' dict to cache stored labels
         """
-        super(DNSBuffer,self).__init__(data)
+        super(DNSBuffer,self).__init__(data,view)
         self.names = {}
 
     def decode_name(self,last=-1):
@@ -210,13 +213,21 @@ class DNSBuffer(Buffer):
             to cached elements where necessary)
         """
         label = []
-        done = False
-        while not done:
-            (length,) = self.unpack("!B")
-            if get_bits(length,6,2) == 3:
+        data = self.data
+        end = len(data)
+        while True:
+            if self.offset >= end:
+                raise BufferError("Not enough bytes [offset=%d,remaining=0,requested=1]" %
+                        self.offset)
+            length = data[self.offset]
+            self.offset += 1
+            if length & 0xC0 == 0xC0:
                 # Pointer
-                self.offset -= 1
-                pointer = get_bits(self.unpack("!H")[0],0,14)
+                if self.offset >= end:
+                    raise BufferError("Not enough bytes [offset=%d,remaining=0,requested=1]" %
+                            self.offset)
+                pointer = ((length & 0x3F) << 8) | data[self.offset]
+                self.offset += 1
                 save = self.offset
                 if last == save:
                     raise BufferError("Recursive pointer in DNSLabel [offset=%d,pointer=%d,length=%d]" % 
@@ -229,17 +240,16 @@ class DNSBuffer(Buffer):
                             (self.offset,pointer,len(self.data)))
                 label.extend(self.decode_name(save).label)
                 self.offset = save
-                done = True
+                break
+            elif length > 0:
+                l = self.get(length)
+                try:
+                    l.decode()
+                except UnicodeDecodeError:
+                    raise BufferError("Invalid label <%s>" % l)
+                label.append(l)
             else:
-                if length > 0:
-                    l = self.get(length)
-                    try:
-                        l.decode()
-                    except UnicodeDecodeError:
-                        raise BufferError("Invalid label <%s>" % l)
-                    label.append(l)
-                else:
-                    done = True
+                break
         return DNSLabel(label)
 
     def encode_name(self,name):
@@ -4,8 +4,10 @@ from __future__ import print_function
 
 import binascii,socket,struct
 
-from dnslib import DNSRecord,RCODE
+from dnslib import DNSRecord,DNSError,RCODE
 from dnslib.server import DNSServer,DNSHandler,BaseResolver,DNSLogger
+from dnslib.cache import DNSCache,SingleFlight,log_cache
+from dnslib.upstream import Upstream,UpstreamGroup,PendingQuery
 
 class ProxyResolver(BaseResolver):
     """
@@ -27,28 +29,90 @@ class ProxyResolver(BaseResolver):
         'real' transparent proxy option the DNSHandler logic needs to be
         modified (see PassthroughDNSHandler)
 
+        Requests are sent over a pooled/multiplexed Upstream transport
+        (see dnslib.upstream). If a DNSCache instance is passed as 'cache'
+        replies are cached (see dnslib.cache). Identical requests which
+        arrive while one is already waiting for the upstream wait for its
+        reply (SingleFlight) - stats() has the coalescing ratio.
+
+        Additional upstream servers can be passed as 'upstreams' (list of
+        (address,port)) - queries are then spread over all of them with
+        an UpstreamGroup (latency weighted selection, hedging, failover
+        and circuit breakers). If no upstream replies (or the query can't
+        be sent - eg. every query id is in use) the reply is SERVFAIL.
+
+        >>> resolver = ProxyResolver("localhost",8055,timeout=1)
+        >>> for txid in range(65536):
+        ...     resolver.upstream.pending[txid] = PendingQuery(None,b'',b'',b'',
+        ...                                                    float('inf'),None)
+        >>> class Handler:
+        ...     protocol = 'udp'
+        >>> reply = resolver.resolve(DNSRecord.question("abc.com"),Handler())
+        >>> RCODE[reply.header.rcode]
+        'SERVFAIL'
+        >>> resolver.upstream.pending.clear()
+        >>> resolver.upstream.close()
+
+        With several upstreams the reply is SERVFAIL once every one of
+        them has failed
+
+        >>> resolver = ProxyResolver("localhost",8055,timeout=0.5,
+        ...                          upstreams=[("localhost",8056)])
+        >>> reply = resolver.resolve(DNSRecord.question("abc.com"),Handler())
+        >>> RCODE[reply.header.rcode]
+        'SERVFAIL'
+        >>> resolver.upstream.close()
+
     """
 
-    def __init__(self,address,port,timeout=0):
+    def __init__(self,address,port,timeout=0,cache=None,upstreams=(),
+                 hedge_delay=None):
         self.address = address
         self.port = port
         self.timeout = timeout
+        self.cache = cache
+        self.flights = SingleFlight()
+        if upstreams:
+            self.upstream = UpstreamGroup(
+                    [ Upstream(a,p,timeout=timeout)
+                            for a,p in [(address,port)] + list(upstreams) ],
+                    timeout=timeout,hedge_delay=hedge_delay)
+        else:
+            self.upstream = Upstream(address,port,timeout=timeout)
 
     def resolve(self,request,handler):
+        if self.cache is not None:
+            reply = self.cache.get(request)
+            log_cache(handler,request,"HIT" if reply else "MISS",self.cache)
+            if reply is not None:
+                return reply
         try:
-            if handler.protocol == 'udp':
-                proxy_r = request.send(self.address,self.port,
-                                timeout=self.timeout)
-            else:
-                proxy_r = request.send(self.address,self.port,
-                                tcp=True,timeout=self.timeout)
-            reply = DNSRecord.parse(proxy_r)
-        except socket.timeout:
+            # Identical concurrent requests share one upstream query
+            reply = self.flights.do(request,
+                                    lambda: self.fetch(request,handler),
+                                    (handler.protocol,))
+        except (OSError,DNSError):
+            # Timeout/upstream unreachable/no query ids free
             reply = request.reply()
-            reply.header.rcode = getattr(RCODE,'NXDOMAIN')
+            reply.header.rcode = getattr(RCODE,'SERVFAIL')
+
+        return reply
 
+    def fetch(self,request,handler):
+        proxy_r = self.upstream.query(request.pack(),
+                                      tcp=handler.protocol != 'udp')
+        reply = DNSRecord.parse(proxy_r)
+        if self.cache is not None:
+            self.cache.put(request,reply)
         return reply
 
+    def stats(self):
+        return {
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'flights': self.flights.stats(),
+            'upstream': self.upstream.stats(),
+        }
+
 class PassthroughDNSHandler(DNSHandler):
     """
         Modify DNSHandler logic (get_reply method) to send directly to 
@@ -57,20 +121,15 @@ class PassthroughDNSHandler(DNSHandler):
         parsed and logged but this is not inline)
     """
     def get_reply(self,data):
-        host,port = self.server.resolver.address,self.server.resolver.port
+        upstream = self.server.resolver.upstream
 
         request = DNSRecord.parse(data)
-        self.log_request(request)
+        self.server.logger.log_request(self,request)
 
-        if self.protocol == 'tcp':
-            data = struct.pack("!H",len(data)) + data
-            response = send_tcp(data,host,port)
-            response = response[2:]
-        else:
-            response = send_udp(data,host,port)
+        response = upstream.query(data,tcp=self.protocol == 'tcp')
 
         reply = DNSRecord.parse(response)
-        self.log_reply(reply)
+        self.server.logger.log_reply(self,reply)
 
         return response
 
@@ -110,36 +169,55 @@ if __name__ == '__main__':
     p.add_argument("--address","-a",default="",
                     metavar="<address>",
                     help="Local proxy listen address (default:all)")
-    p.add_argument("--upstream","-u",default="8.8.8.8:53",
+    p.add_argument("--upstream","-u",action="append",
             metavar="<dns server:port>",
-                    help="Upstream DNS server:port (default:8.8.8.8:53)")
+                    help="Upstream DNS server:port - may be repeated (default:8.8.8.8:53)")
+    p.add_argument("--hedge-delay",type=float,default=None,
+                    metavar="<seconds>",
+                    help="With several upstreams, also query another upstream after this long without a reply (default: 3 x average latency)")
     p.add_argument("--tcp",action='store_true',default=False,
                     help="TCP proxy (default: UDP only)")
     p.add_argument("--timeout","-o",type=float,default=5,
                     metavar="<timeout>",
                     help="Upstream timeout (default: 5s)")
+    p.add_argument("--cache-size",type=float,default=0,
+                    metavar="<MB>",
+                    help="Cache upstream replies (size in MB) (default: 0 - no cache)")
     p.add_argument("--passthrough",action='store_true',default=False,
                     help="Dont decode/re-encode request/response (default: off)")
     p.add_argument("--log",default="request,reply,truncated,error",
-                    help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data)")
+                    help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data,-cache)")
+    p.add_argument("--pool-size",type=int,default=0,
+                    metavar="<threads>",
+                    help="Handle requests in a fixed pool of threads (default: 0 - thread per request)")
+    p.add_argument("--queue-size",type=int,default=256,
+                    metavar="<requests>",
+                    help="Max requests waiting for a pool thread before shedding load (default: 256)")
     p.add_argument("--log-prefix",action='store_true',default=False,
                     help="Log prefix (timestamp/handler/resolver) (default: False)")
     args = p.parse_args()
 
-    args.dns,_,args.dns_port = args.upstream.partition(':')
-    args.dns_port = int(args.dns_port or 53)
+    upstreams = []
+    for u in args.upstream or ["8.8.8.8:53"]:
+        dns,_,dns_port = u.partition(':')
+        upstreams.append((dns,int(dns_port or 53)))
+    args.dns,args.dns_port = upstreams[0]
 
-    print("Starting Proxy Resolver (%s:%d -> %s:%d) [%s]" % (
+    print("Starting Proxy Resolver (%s:%d -> %s) [%s]" % (
                         args.address or "*",args.port,
-                        args.dns,args.dns_port,
+                        ",".join([ "%s:%d" % u for u in upstreams ]),
                         "UDP/TCP" if args.tcp else "UDP"))
 
-    resolver = ProxyResolver(args.dns,args.dns_port,args.timeout)
+    cache = DNSCache(int(args.cache_size * 1024 * 1024)) if args.cache_size else None
+    resolver = ProxyResolver(args.dns,args.dns_port,args.timeout,cache,
+                             upstreams[1:],args.hedge_delay)
     handler = PassthroughDNSHandler if args.passthrough else DNSHandler
     logger = DNSLogger(args.log,args.log_prefix)
     udp_server = DNSServer(resolver,
                            port=args.port,
                            address=args.address,
+                           pool_size=args.pool_size,
+                           queue_size=args.queue_size,
                            logger=logger,
                            handler=handler)
     udp_server.start_thread()
@@ -148,6 +226,8 @@ if __name__ == '__main__':
         tcp_server = DNSServer(resolver,
                                port=args.port,
                                address=args.address,
+                               pool_size=args.pool_size,
+                               queue_size=args.queue_size,
                                tcp=True,
                                logger=logger,
                                handler=handler)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+    QueryView - fast path for resolvers which only need the basics of a
+    query and answer with a single A record (or just an rcode).
+
+    QueryView reads the header fields, the first question and whether the
+    query has an EDNS (OPT) record straight from the packet, without
+    building DNSRecord/DNSHeader/DNSQuestion/RR/DNSLabel objects, and only
+    when they are first used. reply_a()/reply_rcode() build the reply
+    packet directly, echoing the question bytes and pointing the answer
+    name at them. The replies are the same as DNSRecord.reply() would give.
+
+    Answers are built from ReplyTemplates - the answer RR (name pointer,
+    type, class, ttl and rdata) is encoded once, and each reply just
+    copies the request header/question, patches the header and appends
+    the answer. reply_a() keeps a cache of A templates by (ip,ttl).
+
+    A resolver opts in by implementing:
+
+        resolve_fast(query,handler)
+
+    which is called (with a QueryView) before 'resolve', and returns the
+    reply packet - or None to fall back to the normal 'resolve' path.
+    Note that the request/reply log hooks are not called for requests
+    answered by resolve_fast (there are no DNSRecord objects to log) -
+    use the recv/send hooks to see these.
+
+    >>> q = DNSRecord.question("abc.example.com")
+    >>> v = QueryView(q.pack())
+    >>> v.id == q.header.id
+    True
+    >>> v.qname
+    'abc.example.com.'
+    >>> v.qtype,v.qclass,v.edns,v.is_query
+    (1, 1, False, True)
+    >>> a = v.reply_a("1.2.3.4",60)
+    >>> r = q.reply()
+    >>> r.add_answer(RR(q.q.qname,QTYPE.A,ttl=60,rdata=A("1.2.3.4")))
+    >>> a == bytes(r.pack())
+    True
+    >>> r = q.reply()
+    >>> r.header.rcode = RCODE.NXDOMAIN
+    >>> v.reply_rcode(RCODE.NXDOMAIN) == bytes(r.pack())
+    True
+
+    >>> q.add_ar(EDNS0())
+    >>> QueryView(q.pack()).edns
+    True
+    >>> QueryView(b"short")
+    Traceback (most recent call last):
+    ...
+    dnslib.dns.DNSError: QueryView: packet too short
+
+    Templates work for any RR type (names in the rdata aren't compressed)
+
+    >>> t = ReplyTemplate(QTYPE.MX,MX("mail.abc.com",10),300)
+    >>> q = DNSRecord.question("abc.com","MX")
+    >>> print(DNSRecord.parse(t.reply(QueryView(q.pack()))))
+    ;; ->>HEADER<<- opcode: QUERY, status: NOERROR, id: ...
+    ;; flags: qr aa rd ra; QUERY: 1, ANSWER: 1, AUTHORITY: 0, ADDITIONAL: 0
+    ;; QUESTION SECTION:
+    ;abc.com.                       IN      MX
+    ;; ANSWER SECTION:
+    abc.com.                300     IN      MX      10 mail.abc.com.
+"""
+
+import socket,struct
+
+from dnslib.dns import DNSRecord,DNSError,RR,QTYPE,RCODE,A,MX,EDNS0
+from dnslib.label import DNSBuffer
+
+HEADER = struct.Struct("!HHHHHH")
+QTAIL = struct.Struct("!HH")
+RRTAIL = struct.Struct("!HHIH")
+RRHEAD = struct.Struct("!HHHIH")
+
+# Max cached A templates (see reply_a)
+MAX_A_TEMPLATES = 4096
+
+QR = 0x8000
+AA = 0x0400
+RA = 0x0080
+
+class QueryView(object):
+
+    __slots__ = ('packet','id','bitmap','qdcount','ancount','nscount',
+                 'arcount','_qlabels','_qend','_edns')
+
+    def __init__(self,packet):
+        if len(packet) < HEADER.size:
+            raise DNSError("QueryView: packet too short")
+        self.packet = packet
+        (self.id,self.bitmap,self.qdcount,self.ancount,
+                self.nscount,self.arcount) = HEADER.unpack_from(packet)
+        self._qlabels = None
+        self._qend = None
+        self._edns = None
+
+    @property
+    def is_query(self):
+        """
+            True for a standard query (QR=0, OPCODE=QUERY) with a question
+        """
+        return (self.bitmap & 0xF800) == 0 and self.qdcount > 0
+
+    def _decode_question(self):
+        if self.qdcount < 1:
+            raise DNSError("QueryView: no question")
+        packet = self.packet
+        offset = HEADER.size
+        labels = []
+        try:
+            while True:
+                length = packet[offset]
+                if length == 0:
+                    offset += 1
+                    break
+                if length & 0xC0:
+                    # Nothing before the first question for a pointer to
+                    # point at
+                    raise DNSError("QueryView: invalid qname")
+                labels.append(bytes(packet[offset+1:offset+1+length]))
+                offset += 1 + length
+        except IndexError:
+            raise DNSError("QueryView: truncated qname")
+        if offset + QTAIL.size > len(packet):
+            raise DNSError("QueryView: truncated question")
+        self._qlabels = tuple(labels)
+        self._qend = offset + QTAIL.size
+
+    @property
+    def qlabels(self):
+        """
+            First question name as tuple of labels (bytes)
+        """
+        if self._qlabels is None:
+            self._decode_question()
+        return self._qlabels
+
+    @property
+    def qname(self):
+        """
+            First question name as str - the labels UTF-8 decoded and
+            joined with '.', as str(DNSLabel) does. Labels aren't escaped,
+            so a label containing '.' (or unprintable characters) isn't
+            distinguishable in the result - use qlabels to compare names
+            exactly. Raises DNSError if a label isn't valid UTF-8
+        """
+        try:
+            return ".".join([ l.decode() for l in self.qlabels ]) + "."
+        except UnicodeDecodeError:
+            raise DNSError("QueryView: invalid label")
+
+    @property
+    def qtype(self):
+        return QTAIL.unpack_from(self.packet,self.qend - QTAIL.size)[0]
+
+    @property
+    def qclass(self):
+        return QTAIL.unpack_from(self.packet,self.qend - QTAIL.size)[1]
+
+    @property
+    def question(self):
+        """
+            Raw bytes of the first question
+        """
+        return bytes(self.packet[HEADER.size:self.qend])
+
+    @property
+    def edns(self):
+        """
+            True if the query has an OPT record in the additional section
+        """
+        if self._edns is None:
+            self._edns = self._find_opt()
+        return self._edns
+
+    def _skip_name(self,offset):
+        packet = self.packet
+        while True:
+            length = packet[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += 1 + length
+
+    def _find_opt(self):
+        if not self.arcount:
+            return False
+        offset = self.qend
+        try:
+            # Any further questions
+            for i in range(self.qdcount - 1):
+                offset = self._skip_name(offset) + QTAIL.size
+            for i in range(self.ancount + self.nscount + self.arcount):
+                offset = self._skip_name(offset)
+                rtype,rclass,ttl,rdlength = RRTAIL.unpack_from(self.packet,offset)
+                if rtype == QTYPE.OPT:
+                    return True
+                offset += RRTAIL.size + rdlength
+        except (IndexError,struct.error):
+            raise DNSError("QueryView: truncated record")
+        return False
+
+    @property
+    def qend(self):
+        """
+            Offset of the end of the first question
+        """
+        if self._qend is None:
+            self._decode_question()
+        return self._qend
+
+    def reply_a(self,ip,ttl,aa=1,ra=1):
+        """
+            Reply packet with a single A record for the question name
+            (ip may be a dotted quad string or 4 bytes)
+        """
+        key = (ip,ttl,aa,ra)
+        template = _a_templates.get(key)
+        if template is None:
+            if len(_a_templates) >= MAX_A_TEMPLATES:
+                _a_templates.clear()
+            if isinstance(ip,bytes):
+                ip = socket.inet_ntoa(ip)
+            template = _a_templates[key] = ReplyTemplate(QTYPE.A,A(ip),ttl,
+                                                         aa=aa,ra=ra)
+        return template.reply(self)
+
+    def reply_rcode(self,rcode,aa=1,ra=1):
+        """
+            Reply packet with no answers and the given rcode
+        """
+        out = bytearray(self.packet[:self.qend])
+        HEADER.pack_into(out,0,self.id,reply_bitmap(self.bitmap,rcode,aa,ra),
+                         1,0,0,0)
+        return out
+
+def reply_bitmap(bitmap,rcode,aa,ra):
+    bitmap = (bitmap & ~(0xF | AA | RA)) | QR | rcode
+    if aa:
+        bitmap |= AA
+    if ra:
+        bitmap |= RA
+    return bitmap
+
+class NoCompressBuffer(DNSBuffer):
+    """
+        DNSBuffer which doesn't compress names (a template's rdata is
+        encoded on its own, so can't point into the rest of the packet)
+    """
+    encode_name = DNSBuffer.encode_name_nocompress
+
+class ReplyTemplate(object):
+    """
+        Pre-encoded reply with a single answer RR (rtype/rdata/ttl) for
+        the question name
+    """
+
+    __slots__ = ('answer','aa','ra')
+
+    def __init__(self,rtype,rdata,ttl,rclass=1,aa=1,ra=1):
+        buffer = NoCompressBuffer()
+        rdata.pack(buffer)
+        self.answer = RRHEAD.pack(0xC00C,rtype,rclass,ttl,len(buffer.data)) + \
+                      bytes(buffer.data)
+        self.aa = aa
+        self.ra = ra
+
+    def reply(self,query):
+        """
+            Reply packet (bytearray) for query (QueryView)
+        """
+        out = bytearray(query.packet[:query.qend])
+        HEADER.pack_into(out,0,query.id,
+                         reply_bitmap(query.bitmap,RCODE.NOERROR,self.aa,self.ra),
+                         1,1,0,0)
+        out += self.answer
+        return out
+
+_a_templates = {}
+
+def fast_reply(resolver,handler,data):
+    """
+        If resolver implements resolve_fast, return its reply packet for
+        data (or None to use the normal path)
+
+        A UDP reply longer than handler.udplen is truncated here, as the
+        normal path would - not resolved again (resolve_fast may have
+        side effects)
+
+        >>> class Resolver:
+        ...     calls = 0
+        ...     def resolve_fast(self,query,handler):
+        ...         self.calls += 1
+        ...         return query.reply_a("1.2.3.4",60)
+        >>> class Logger:
+        ...     def log_truncated(self,handler,reply):
+        ...         print("Truncated:",RCODE[reply.header.rcode],reply.header.tc)
+        >>> class Server:
+        ...     logger = Logger()
+        >>> class Handler:
+        ...     protocol = 'udp'
+        ...     udplen = 40
+        ...     server = Server()
+        >>> resolver = Resolver()
+        >>> rdata = fast_reply(resolver,Handler(),DNSRecord.question("abc.example.com").pack())
+        Truncated: NOERROR 1
+        >>> r = DNSRecord.parse(rdata)
+        >>> r.header.tc, len(r.rr), resolver.calls
+        (1, 0, 1)
+    """
+    resolve_fast = getattr(resolver,"resolve_fast",None)
+    if resolve_fast is None:
+        return None
+    try:
+        query = QueryView(data)
+        rdata = resolve_fast(query,handler)
+    except DNSError:
+        # Let the normal path report it
+        return None
+    if rdata is not None and handler.udplen and handler.protocol == 'udp' \
+            and len(rdata) > handler.udplen:
+        truncated_reply = DNSRecord.parse(rdata).truncate()
+        handler.server.logger.log_truncated(handler,truncated_reply)
+        rdata = truncated_reply.pack()
+    return rdata
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -79,6 +79,24 @@
         abc.def.                60      IN      A       1.2.3.4
         >>> server.stop()
 
+        >>> server = DNSServer(resolver,port=8053,address="localhost",logger=logger,pool_size=4)
+        >>> server.start_thread()
+        >>> a = q.send("localhost",8053)
+        Request: [...] (udp) / 'abc.def.' (A)
+        Reply: [...] (udp) / 'abc.def.' (A) / RRs: A
+        >>> server.dropped()
+        0
+        >>> server.stop()
+
+        Bind errors are raised as they are
+
+        >>> server = DNSServer(resolver,port=8053,address="localhost",logger=logger,tcp=True)
+        >>> DNSServer(resolver,port=8053,address="localhost",logger=logger,tcp=True,pool_size=4)
+        Traceback (most recent call last):
+        ...
+        OSError: [Errno ...] Address already in use
+        >>> server.server.server_close()
+
 
 """
 from __future__ import print_function
@@ -90,7 +108,10 @@ try:
 except ImportError:
     import SocketServer as socketserver
 
+from concurrent.futures import ThreadPoolExecutor
+
 from dnslib import DNSRecord,DNSError,QTYPE,RCODE,RR
+from dnslib.queryview import fast_reply
 
 class BaseResolver(object):
     """
@@ -105,6 +126,10 @@ class BaseResolver(object):
 
         Note that a single instance is used by all DNSHandler instances so 
         need to consider blocking & thread safety.
+
+        A resolver can also implement 'resolve_fast' to answer simple
+        queries without decoding them into a DNSRecord (see
+        dnslib.queryview)
     """
     def resolve(self,request,handler):
         """
@@ -151,6 +176,10 @@ class DNSHandler(socketserver.BaseRequestHandler):
             self.server.logger.log_error(self,e)
 
     def get_reply(self,data):
+        rdata = fast_reply(self.server.resolver,self,data)
+        if rdata is not None:
+            return rdata
+
         request = DNSRecord.parse(data)
         self.server.logger.log_request(self,request)
 
@@ -188,6 +217,10 @@ class DNSLogger:
             log_truncated     - Truncated
             log_error         - Decoding error
             log_data          - Dump full request/response
+
+        Loggers may also implement (resolvers check before calling):
+
+            log_cache         - Reply cache hit/miss (see dnslib.cache)
     """
 
     def __init__(self,log="",prefix=True):
@@ -208,7 +241,7 @@ class DNSLogger:
         [ enabled.add(l[1:]) for l in log if l.startswith('+') ]
         [ enabled.discard(l[1:]) for l in log if l.startswith('-') ]
         for l in ['log_recv','log_send','log_request','log_reply',
-                  'log_truncated','log_error','log_data']:
+                  'log_truncated','log_error','log_data','log_cache']:
             if l[4:] not in enabled:
                 setattr(self,l,self.log_pass)
         self.prefix = prefix
@@ -292,15 +325,113 @@ class DNSLogger:
                     handler.protocol,
                     e))
 
+    def log_cache(self,handler,request,status,stats):
+        print("%sCache: [%s:%d] (%s) / '%s' (%s) / %s (hits=%d misses=%d evictions=%d entries=%d)" % (
+                    self.log_prefix(handler),
+                    handler.client_address[0],
+                    handler.client_address[1],
+                    handler.protocol,
+                    request.q.qname,
+                    QTYPE[request.q.qtype],
+                    status,
+                    stats['hits'],
+                    stats['misses'],
+                    stats['evictions'],
+                    stats['entries']))
+
     def log_data(self,dnsobj):
         print("\n",dnsobj.toZone("    "),"\n",sep="")
 
 
+def set_reuse_port(sock):
+    """
+        Set SO_REUSEPORT so that several processes can bind the same
+        address/port (the kernel load-balances between them)
+    """
+    if not hasattr(socket,"SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT not supported on this platform")
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+
 class UDPServer(socketserver.ThreadingMixIn,socketserver.UDPServer):
     allow_reuse_address = True
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            set_reuse_port(self.socket)
+        socketserver.UDPServer.server_bind(self)
 
 class TCPServer(socketserver.ThreadingMixIn,socketserver.TCPServer):
     allow_reuse_address = True
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            set_reuse_port(self.socket)
+        socketserver.TCPServer.server_bind(self)
+
+class PooledMixIn(object):
+    """
+        Alternative to ThreadingMixIn: requests are handled by a fixed
+        pool of pool_size threads, with at most queue_size requests
+        waiting. When the queue is full the request is shed - a UDP
+        request gets an immediate shed_rcode (SERVFAIL) reply, a TCP
+        connection is closed - and counted in 'dropped'.
+    """
+    pool_size = 16
+    queue_size = 256
+    shed_rcode = RCODE.SERVFAIL
+
+    def server_activate(self):
+        super(PooledMixIn,self).server_activate()
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        self.slots = threading.BoundedSemaphore(self.pool_size + self.queue_size)
+        self.dropped = 0
+
+    def process_request(self,request,client_address):
+        if not self.slots.acquire(False):
+            self.dropped += 1
+            self.shed_request(request,client_address)
+            return
+        try:
+            self.executor.submit(self.process_request_pool,request,client_address)
+        except RuntimeError:
+            # Executor has been shut down
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def process_request_pool(self,request,client_address):
+        try:
+            self.finish_request(request,client_address)
+        except Exception:
+            self.handle_error(request,client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def shed_request(self,request,client_address):
+        if self.socket_type == socket.SOCK_DGRAM:
+            data,connection = request
+            try:
+                reply = DNSRecord.parse(data).reply()
+                reply.header.rcode = self.shed_rcode
+                connection.sendto(reply.pack(),client_address)
+            except DNSError:
+                pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super(PooledMixIn,self).server_close()
+        # No executor if server_bind/server_activate failed
+        executor = getattr(self,"executor",None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+class PooledUDPServer(PooledMixIn,UDPServer):
+    pass
+
+class PooledTCPServer(PooledMixIn,TCPServer):
+    pass
 
 class DNSServer(object):
 
@@ -315,6 +446,11 @@ class DNSServer(object):
 
         In most cases only a custom resolver instance is required
         (and possibly logger)
+
+        By default each request is handled in a new thread; if pool_size
+        is set a fixed thread pool is used instead (see PooledMixIn) and
+        the number of requests shed because the queue was full is
+        available from dropped()
     """
     def __init__(self,resolver,
                       address="",
@@ -322,7 +458,11 @@ class DNSServer(object):
                       tcp=False,
                       logger=None,
                       handler=DNSHandler,
-                      server=None):
+                      server=None,
+                      reuse_port=False,
+                      pool_size=0,
+                      queue_size=256,
+                      shed_rcode=RCODE.SERVFAIL):
         """
             resolver:   resolver instance
             address:    listen address (default: "")
@@ -331,13 +471,34 @@ class DNSServer(object):
             logger:     logger instance (default: DNSLogger)
             handler:    handler class (default: DNSHandler)
             server:     socketserver class (default: UDPServer/TCPServer)
+            reuse_port: set SO_REUSEPORT so that several processes can
+                        serve the same port (default: False)
+            pool_size:  handle requests in a pool of this many threads
+                        (default: 0 - new thread per request)
+            queue_size: max requests waiting for a pool thread (default: 256)
+            shed_rcode: rcode for UDP requests shed when the queue is full
+                        (default: SERVFAIL)
         """
         if not server:
-            if tcp:
+            if pool_size:
+                server = PooledTCPServer if tcp else PooledUDPServer
+            elif tcp:
                 server = TCPServer
             else:
                 server = UDPServer
-        self.server = server((address,port),handler)
+        self.server = server((address,port),handler,bind_and_activate=False)
+        if reuse_port:
+            self.server.reuse_port = True
+        if pool_size:
+            self.server.pool_size = pool_size
+            self.server.queue_size = queue_size
+            self.server.shed_rcode = shed_rcode
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except:
+            self.server.server_close()
+            raise
         self.server.resolver = resolver
         self.server.logger = logger or DNSLogger()
     
@@ -353,7 +514,10 @@ class DNSServer(object):
         self.server.shutdown()
 
     def isAlive(self):
-        return self.thread.isAlive()
+        return self.thread.is_alive()
+
+    def dropped(self):
+        return getattr(self.server,"dropped",0)
 
 if __name__ == "__main__":
     import doctest
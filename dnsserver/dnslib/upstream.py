@@ -0,0 +1,796 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Upstream - persistent transport to an upstream DNS server for the
+    proxy resolvers
+
+    DNSRecord.send (and proxy.send_udp/send_tcp) open a new socket for
+    every query and block reading it. Upstream instead keeps:
+
+        - a pool of connected UDP sockets, read by a single receiver
+          thread
+        - persistent TCP connections (reconnected when the upstream
+          closes them), each read by its own thread; queries are
+          pipelined on the connection
+
+    Each outgoing query is given a random transaction id which isn't
+    already outstanding, and the reply is matched back to the caller by
+    id, transport and question (replies which don't match are dropped).
+    The caller's id is restored before the reply is returned, so many
+    callers can have queries in flight over the same sockets at once.
+
+    submit() returns a concurrent.futures.Future for the reply packet
+    (for callers which don't want to block - eg. asyncio.wrap_future);
+    query() waits for it. Queries which don't get a reply in time fail
+    with socket.timeout.
+
+    >>> class TestResolver:
+    ...     def resolve(self,request,handler):
+    ...         reply = request.reply()
+    ...         reply.add_answer(*RR.fromZone("%s 60 A 1.2.3.4" % request.q.qname))
+    ...         return reply
+    >>> logger = DNSLogger("-request,-reply",prefix=False)
+    >>> udp_server = DNSServer(TestResolver(),port=8053,address="localhost",logger=logger)
+    >>> tcp_server = DNSServer(TestResolver(),port=8053,address="localhost",logger=logger,tcp=True)
+    >>> udp_server.start_thread()
+    >>> tcp_server.start_thread()
+    >>> upstream = Upstream("localhost",8053,timeout=2)
+    >>> q = DNSRecord.question("abc.com")
+    >>> a = DNSRecord.parse(upstream.query(q.pack()))
+    >>> a.header.id == q.header.id, str(a.rr[0].rdata)
+    (True, '1.2.3.4')
+    >>> a = DNSRecord.parse(upstream.query(q.pack(),tcp=True))
+    >>> a.header.id == q.header.id, str(a.rr[0].rdata)
+    (True, '1.2.3.4')
+
+    Concurrent queries are multiplexed
+
+    >>> qs = [ DNSRecord.question("host%d.abc.com" % i) for i in range(50) ]
+    >>> futures = [ upstream.submit(q.pack(),tcp=(i % 2 == 1)) for i,q in enumerate(qs) ]
+    >>> replies = [ DNSRecord.parse(f.result(5)) for f in futures ]
+    >>> all([ r.header.id == q.header.id and r.q.qname == q.q.qname
+    ...         for q,r in zip(qs,replies) ])
+    True
+    >>> upstream.stats()['outstanding']
+    0
+    >>> upstream.close()
+    >>> udp_server.stop()
+    >>> tcp_server.stop()
+
+    Timeouts
+
+    >>> upstream = Upstream("localhost",8053,timeout=0.2)
+    >>> try:
+    ...     upstream.query(q.pack())
+    ... except socket.timeout as e:
+    ...     print("timeout:",e)
+    timeout: upstream timeout
+
+    Replies to queries the caller has given up on are dropped
+
+    >>> f = upstream.submit(q.pack())
+    >>> f.cancel()
+    True
+    >>> p = list(upstream.pending.values())[0]
+    >>> upstream.handle_reply(p.packet,p.transport)
+    True
+    >>> f.cancelled(), upstream.thread.is_alive()
+    (True, True)
+    >>> upstream.close()
+
+    UpstreamGroup spreads queries over several upstreams, picked at
+    random weighted by their (EWMA) latency. If the chosen upstream hasn't
+    replied after the hedge delay the query is also sent to another one,
+    and the first reply wins; errors fail over to another upstream
+    straight away. An upstream which fails failure_threshold times in a
+    row is taken out of use (circuit breaker) for 'cooldown' seconds,
+    after which one probe query is let through. stats() has the state,
+    latency and latency histogram for each upstream.
+
+    >>> class SlowResolver(TestResolver):
+    ...     def resolve(self,request,handler):
+    ...         time.sleep(0.5)
+    ...         return TestResolver.resolve(self,request,handler)
+    >>> fast = DNSServer(TestResolver(),port=8053,address="localhost",logger=logger)
+    >>> slow = DNSServer(SlowResolver(),port=8054,address="localhost",logger=logger)
+    >>> fast.start_thread()
+    >>> slow.start_thread()
+    >>> group = UpstreamGroup([Upstream("localhost",8054),
+    ...                        Upstream("localhost",8053),
+    ...                        Upstream("localhost",8055)],   # Nothing there
+    ...                       timeout=1,hedge_delay=0.05,cooldown=60)
+    >>> start = time.monotonic()
+    >>> replies = [ DNSRecord.parse(group.query(q.pack())) for i in range(20) ]
+    >>> all([ str(r.rr[0].rdata) == '1.2.3.4' for r in replies ])
+    True
+    >>> time.monotonic() - start < 5
+    True
+    >>> time.sleep(1)
+    >>> stats = group.stats()
+    >>> stats['upstreams']['localhost:8055']['state']
+    'open'
+    >>> stats['upstreams']['localhost:8053']['state']
+    'closed'
+
+    submit() runs queries on a bounded pool of threads
+
+    >>> futures = [ group.submit(q.pack()) for i in range(50) ]
+    >>> all([ str(DNSRecord.parse(f.result(5)).rr[0].rdata) == '1.2.3.4'
+    ...         for f in futures ])
+    True
+    >>> len([ t for t in threading.enumerate()
+    ...         if t.name.startswith("UpstreamGroup") ]) <= 16
+    True
+    >>> group.close()
+    >>> fast.stop()
+    >>> slow.stop()
+
+    Once the cooldown has passed, the upstream gets one probe query when
+    it is next picked - other upstreams being picked doesn't use it up -
+    and the probe's result closes or reopens the breaker
+
+    >>> group = UpstreamGroup([Upstream("localhost",8053),
+    ...                        Upstream("localhost",8055)],cooldown=0.1)
+    >>> for i in range(3):
+    ...     group.health[1].failure(time.monotonic(),3,0.1)
+    >>> [ group.select([]) for i in range(100) ].count(1)
+    0
+    >>> time.sleep(0.2)
+    >>> group.health[1].state
+    'open'
+    >>> [ group.select([]) for i in range(1000) ].count(1)
+    1
+    >>> group.health[1].state
+    'half-open'
+    >>> group.health[1].failure(time.monotonic(),3,0.1)
+    >>> group.health[1].state
+    'open'
+    >>> time.sleep(0.2)
+    >>> [ group.select([]) for i in range(1000) ].count(1)
+    1
+    >>> group.health[1].success(0.01)
+    >>> [ group.select([]) for i in range(1000) ].count(1) > 100
+    True
+    >>> group.close()
+"""
+
+from __future__ import print_function
+
+import bisect,concurrent.futures,random,secrets,selectors,socket,struct,threading,time
+
+from dnslib.dns import DNSRecord,DNSError,RR
+from dnslib.server import DNSServer,DNSLogger
+
+DEFAULT_TIMEOUT = 5.0
+UDP_RCVBUF = 1024 * 1024
+# Min automatic hedge delay (seconds)
+HEDGE_MIN = 0.01
+
+class PendingQuery(object):
+
+    __slots__ = ('future','orig_id','question','packet','deadline','transport')
+
+    def __init__(self,future,orig_id,question,packet,deadline,transport):
+        self.future = future
+        self.orig_id = orig_id
+        self.question = question
+        self.packet = packet
+        self.deadline = deadline
+        self.transport = transport
+
+class TCPConnection(object):
+    """
+        Persistent (pipelined) TCP connection to the upstream. Replies are
+        matched to the socket they arrive on; if the upstream closes the
+        connection after answering some queries (eg. a server which only
+        handles one query per connection) the unanswered queries are sent
+        again on a new connection, otherwise they fail
+    """
+
+    def __init__(self,upstream):
+        self.upstream = upstream
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def get_socket(self):
+        """
+            Connected socket (connecting if needed)
+        """
+        with self.lock:
+            if self.sock is None:
+                sock = socket.socket(self.upstream.family,socket.SOCK_STREAM)
+                sock.settimeout(self.upstream.timeout)
+                try:
+                    sock.connect(self.upstream.sockaddr)
+                except OSError:
+                    sock.close()
+                    raise
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+                self.sock = sock
+                self.upstream.connects += 1
+                t = threading.Thread(target=self.read,args=(sock,))
+                t.daemon = True
+                t.start()
+            return self.sock
+
+    def send(self,sock,packet):
+        with self.lock:
+            sock.sendall(struct.pack("!H",len(packet)) + packet)
+
+    def discard(self,sock):
+        """
+            Stop using sock for new queries (reader thread cleans up)
+        """
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv_exact(self,sock,n):
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("upstream closed connection")
+            data += chunk
+        return data
+
+    def read(self,sock):
+        answered = 0
+        error = ConnectionError("upstream closed connection")
+        try:
+            while True:
+                length = struct.unpack("!H",self.recv_exact(sock,2))[0]
+                if self.upstream.handle_reply(self.recv_exact(sock,length),sock):
+                    answered += 1
+        except Exception as e:
+            error = e if isinstance(e,ConnectionError) else \
+                        ConnectionError("upstream connection error: %s" % e)
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+        if answered and not self.upstream.stopping:
+            self.upstream.resend(sock,self)
+        else:
+            self.upstream.fail(sock,error)
+
+    def close(self):
+        with self.lock:
+            sock,self.sock = self.sock,None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+class Upstream(object):
+    """
+        Pooled/multiplexed upstream transport (see module docstring)
+    """
+
+    def __init__(self,address,port=53,timeout=DEFAULT_TIMEOUT,
+                      udp_sockets=4,tcp_connections=2):
+        """
+            address/port    - upstream server
+            timeout         - default query timeout (seconds)
+            udp_sockets     - number of UDP sockets
+            tcp_connections - number of persistent TCP connections
+        """
+        self.address = address
+        self.port = port
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        info = socket.getaddrinfo(address,port,0,socket.SOCK_DGRAM)[0]
+        self.family,self.sockaddr = info[0],info[4]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.connects = 0
+        self.resent = 0
+        self.errors = 0
+        self.selector = selectors.DefaultSelector()
+        self.udp = []
+        for i in range(udp_sockets):
+            sock = socket.socket(self.family,socket.SOCK_DGRAM)
+            try:
+                # Room for bursts of replies
+                sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,UDP_RCVBUF)
+            except OSError:
+                pass
+            sock.connect(self.sockaddr)
+            sock.setblocking(False)
+            self.selector.register(sock,selectors.EVENT_READ)
+            self.udp.append(sock)
+        self.tcp = [ TCPConnection(self) for i in range(tcp_connections) ]
+        self.next_udp = 0
+        self.next_tcp = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_id(self):
+        # Caller holds lock
+        if len(self.pending) >= 65536:
+            raise DNSError("Upstream: too many outstanding queries")
+        while True:
+            txid = secrets.randbits(16)
+            if txid not in self.pending:
+                return txid
+
+    def submit(self,data,tcp=False,timeout=None):
+        """
+            Send query packet (bytes) to upstream - returns Future for
+            the reply packet
+        """
+        data = bytes(data)
+        if len(data) < 12:
+            raise DNSError("Upstream: packet too short")
+        question = question_bytes(data)
+        future = concurrent.futures.Future()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        if tcp:
+            conn = self.tcp[self.next_tcp % len(self.tcp)]
+            self.next_tcp += 1
+        else:
+            sock = self.udp[self.next_udp % len(self.udp)]
+            self.next_udp += 1
+        # A persistent TCP connection may have been closed by the upstream
+        # since it was last used - so try a new one if the send fails
+        for retry in ((True,False) if tcp else (False,)):
+            try:
+                if tcp:
+                    sock = conn.get_socket()
+            except OSError as e:
+                future.set_exception(e)
+                return future
+            with self.lock:
+                txid = self.new_id()
+                packet = struct.pack("!H",txid) + data[2:]
+                self.pending[txid] = PendingQuery(future,data[:2],question,
+                                                  packet,deadline,sock)
+            try:
+                if tcp:
+                    conn.send(sock,packet)
+                else:
+                    sock.send(packet)
+                self.sent += 1
+                return future
+            except OSError as e:
+                with self.lock:
+                    self.pending.pop(txid,None)
+                if not retry:
+                    future.set_exception(e)
+                    return future
+                conn.discard(sock)
+
+    def query(self,data,tcp=False,timeout=None):
+        """
+            Send query packet to upstream and return reply packet
+            (raises socket.timeout if there is no reply in time)
+        """
+        timeout = timeout or self.timeout
+        future = self.submit(data,tcp,timeout)
+        try:
+            # The receiver thread fails the query at its deadline - the
+            # extra wait here is just a safety net
+            return future.result(timeout + 1)
+        except concurrent.futures.TimeoutError:
+            raise socket.timeout("upstream timeout")
+
+    def handle_reply(self,data,transport):
+        """
+            Match reply to pending query (returns True if matched)
+        """
+        if len(data) < 12:
+            self.unmatched += 1
+            return False
+        txid = struct.unpack("!H",data[:2])[0]
+        with self.lock:
+            p = self.pending.get(txid)
+            if p is None or p.transport is not transport or \
+                    data[12:12+len(p.question)] != p.question:
+                self.unmatched += 1
+                return False
+            del self.pending[txid]
+        self.received += 1
+        complete(p.future,result=p.orig_id + data[2:])
+        return True
+
+    def take(self,transport):
+        with self.lock:
+            txids = [ txid for txid,p in self.pending.items()
+                                if p.transport is transport ]
+            return [ (txid,self.pending.pop(txid)) for txid in txids ]
+
+    def fail(self,transport,error):
+        """
+            Fail all queries pending on transport
+        """
+        for txid,p in self.take(transport):
+            complete(p.future,error=error)
+
+    def resend(self,transport,conn):
+        """
+            Send queries pending on (closed) TCP socket again on a new
+            connection
+        """
+        pending = self.take(transport)
+        if not pending:
+            return
+        try:
+            sock = conn.get_socket()
+        except OSError as e:
+            for txid,p in pending:
+                complete(p.future,error=e)
+            return
+        with self.lock:
+            for txid,p in pending:
+                p.transport = sock
+                self.pending[txid] = p
+        for txid,p in pending:
+            try:
+                conn.send(sock,p.packet)
+                self.resent += 1
+            except OSError:
+                # Reader thread for the new socket fails/resends these
+                break
+
+    def expire(self,now):
+        with self.lock:
+            expired = [ txid for txid,p in self.pending.items()
+                                    if p.deadline <= now ]
+            expired = [ self.pending.pop(txid) for txid in expired ]
+        for p in expired:
+            self.timeouts += 1
+            complete(p.future,error=socket.timeout("upstream timeout"))
+
+    def run(self):
+        next_expire = 0
+        while not self.stopping:
+            for key,_ in self.selector.select(0.05):
+                sock = key.fileobj
+                while True:
+                    try:
+                        data = sock.recv(65535)
+                    except (BlockingIOError,InterruptedError):
+                        break
+                    except OSError:
+                        # eg. ICMP port unreachable
+                        break
+                    try:
+                        self.handle_reply(data,sock)
+                    except Exception:
+                        # Don't let one bad reply stop the receiver
+                        self.errors += 1
+            now = time.monotonic()
+            if now >= next_expire:
+                try:
+                    self.expire(now)
+                except Exception:
+                    self.errors += 1
+                next_expire = now + 0.05
+
+    def close(self):
+        self.stopping = True
+        self.thread.join()
+        for conn in self.tcp:
+            conn.close()
+        for sock in self.udp:
+            self.selector.unregister(sock)
+            sock.close()
+        self.selector.close()
+        self.expire(float('inf'))
+
+    def stats(self):
+        return {
+            'outstanding': len(self.pending),
+            'sent': self.sent,
+            'received': self.received,
+            'timeouts': self.timeouts,
+            'unmatched': self.unmatched,
+            'tcp_connects': self.connects,
+            'tcp_resent': self.resent,
+            'errors': self.errors,
+        }
+
+def complete(future,result=None,error=None):
+    """
+        Set the result (or exception) of a pending query's future - unless
+        the caller has cancelled it (returns False)
+    """
+    if future.done() or not future.set_running_or_notify_cancel():
+        return False
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return True
+
+def question_bytes(data):
+    """
+        Raw question section of packet (first question only)
+    """
+    if data[4:6] == b'\x00\x00':
+        return b''
+    offset = 12
+    try:
+        while True:
+            length = data[offset]
+            if length == 0:
+                return data[12:offset+5]
+            if length & 0xC0:
+                return data[12:offset]
+            offset += 1 + length
+    except IndexError:
+        raise DNSError("Upstream: truncated question")
+
+class UpstreamHealth(object):
+    """
+        Latency/failure record for one upstream in an UpstreamGroup:
+        EWMA latency, latency histogram and circuit breaker state
+    """
+
+    # Histogram bucket upper bounds (ms) - last bucket is everything above
+    BUCKETS = (1,2,5,10,20,50,100,200,500,1000,2000,5000)
+
+    def __init__(self,alpha=0.2):
+        self.alpha = alpha
+        self.ewma = None
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.open_until = 0
+        self.opened = 0
+        self.probing = False
+
+    def success(self,latency):
+        if self.ewma is None:
+            self.ewma = latency
+        else:
+            self.ewma += self.alpha * (latency - self.ewma)
+        self.histogram[bisect.bisect_left(self.BUCKETS,latency * 1000)] += 1
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.probing = False
+
+    def failure(self,now,threshold,cooldown):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == 'half-open' or \
+                (self.state == 'closed' and self.consecutive_failures >= threshold):
+            self.state = 'open'
+            self.open_until = now + cooldown
+            self.opened += 1
+        self.probing = False
+
+    def available(self,now):
+        """
+            True if queries can be sent (an open breaker lets one probe
+            query through once the cooldown has passed) - doesn't change
+            the state, see use()
+        """
+        if self.state == 'open':
+            return now >= self.open_until
+        if self.state == 'half-open':
+            return not self.probing
+        return True
+
+    def use(self,now):
+        """
+            Upstream has been picked for a query - if the breaker is due a
+            probe this is it (success()/failure() closes or reopens it)
+        """
+        if self.state == 'open' and now >= self.open_until:
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            self.probing = True
+
+    def stats(self):
+        labels = [ "<=%dms" % b for b in self.BUCKETS ] + \
+                 [ ">%dms" % self.BUCKETS[-1] ]
+        return {
+            'state': self.state,
+            'ewma_ms': None if self.ewma is None else round(self.ewma * 1000,3),
+            'successes': self.successes,
+            'failures': self.failures,
+            'opened': self.opened,
+            'histogram': dict(zip(labels,self.histogram)),
+        }
+
+class UpstreamGroup(object):
+    """
+        Several upstreams with latency-weighted selection, hedging,
+        failover and circuit breakers (same query/submit interface as
+        Upstream - see module docstring)
+    """
+
+    def __init__(self,upstreams,timeout=DEFAULT_TIMEOUT,hedge_delay=None,
+                      max_hedges=1,failure_threshold=3,cooldown=5.0,
+                      workers=16):
+        """
+            upstreams           - list of Upstream instances
+            timeout             - default query timeout (seconds)
+            hedge_delay         - send the query to another upstream if
+                                  there is no reply after this long
+                                  (default: None - 3 x EWMA latency of
+                                  the first upstream; 0 - race two
+                                  upstreams from the start)
+            max_hedges          - max extra upstreams per query (not
+                                  counting failover after errors)
+            failure_threshold   - consecutive failures to open breaker
+            cooldown            - seconds before an open breaker lets a
+                                  probe query through
+            workers             - max threads running queries for
+                                  submit() (query() runs on the caller's
+                                  thread)
+        """
+        self.upstreams = list(upstreams)
+        self.health = [ UpstreamHealth() for u in self.upstreams ]
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.hedge_delay = hedge_delay
+        self.max_hedges = max_hedges
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.queries = 0
+        self.hedged = 0
+        self.failovers = 0
+        self.failed = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers,
+                                        thread_name_prefix="UpstreamGroup")
+
+    def select(self,exclude):
+        """
+            Index of upstream to use next (None if all have been tried).
+            Upstreams are picked at random, weighted by 1/EWMA latency,
+            from those with a closed breaker (or due a probe); if there are
+            none the one whose breaker reopens soonest is used
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [ i for i in range(len(self.upstreams))
+                                if i not in exclude ]
+            if not candidates:
+                return None
+            available = [ i for i in candidates if self.health[i].available(now) ]
+            if not available:
+                index = min(candidates,key=lambda i:self.health[i].open_until)
+            else:
+                known = [ self.health[i].ewma for i in available
+                                if self.health[i].ewma is not None ]
+                # Untried upstreams get the best known latency, so they are used
+                default = min(known) if known else 0.01
+                weights = []
+                for i in available:
+                    ewma = self.health[i].ewma
+                    weights.append(1.0 / max(default if ewma is None else ewma,0.0001))
+                index = self.random.choices(available,weights)[0]
+            self.health[index].use(now)
+            return index
+
+    def record(self,index,start,future):
+        now = time.monotonic()
+        with self.lock:
+            if future.exception() is None:
+                self.health[index].success(now - start)
+            else:
+                self.health[index].failure(now,self.failure_threshold,
+                                           self.cooldown)
+
+    def get_hedge_delay(self,index,timeout):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        ewma = self.health[index].ewma
+        if ewma is None:
+            return min(0.1,timeout / 2)
+        return min(max(3 * ewma,HEDGE_MIN),timeout / 2)
+
+    def submit(self,data,tcp=False,timeout=None):
+        """
+            Returns Future for the reply packet. The query runs on one of
+            a fixed pool of threads (see 'workers') - if they are all
+            busy it waits for one, but its timeout counts from now
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        def run():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("upstream timeout")
+            return self.query(data,tcp,remaining)
+        return self.executor.submit(run)
+
+    def query(self,data,tcp=False,timeout=None):
+        """
+            Send query packet to the upstreams and return the first good
+            reply (raises socket.timeout if there is none in time)
+        """
+        timeout = timeout or self.timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        self.queries += 1
+        tried = []
+        pending = {}
+        hedges = 0
+        error = None
+
+        def launch():
+            index = self.select(tried)
+            if index is None:
+                return None
+            tried.append(index)
+            now = time.monotonic()
+            f = self.upstreams[index].submit(data,tcp,deadline - now)
+            f.add_done_callback(lambda f,i=index,t=now: self.record(i,t,f))
+            pending[f] = index
+            return index
+
+        index = launch()
+        if index is None:
+            raise DNSError("UpstreamGroup: no upstreams")
+        hedge_at = start + self.get_hedge_delay(index,timeout)
+        if self.hedge_delay == 0 and launch() is not None:
+            hedges += 1
+            self.hedged += 1
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            can_hedge = hedges < self.max_hedges and len(tried) < len(self.upstreams)
+            wait_until = min(deadline,hedge_at) if can_hedge else deadline
+            done,_ = concurrent.futures.wait(list(pending),
+                                    timeout=max(0,wait_until - now),
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                del pending[f]
+                if f.exception() is None:
+                    return f.result()
+                error = f.exception()
+                # Fail over straight away
+                if launch() is not None:
+                    self.failovers += 1
+            if not done and can_hedge and time.monotonic() >= hedge_at:
+                if launch() is not None:
+                    hedges += 1
+                    self.hedged += 1
+                    hedge_at = time.monotonic() + self.get_hedge_delay(tried[-1],timeout)
+        self.failed += 1
+        if isinstance(error,socket.timeout) or error is None or pending:
+            raise socket.timeout("upstream timeout")
+        raise error
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for u in self.upstreams:
+            u.close()
+
+    def stats(self):
+        with self.lock:
+            upstreams = {}
+            for u,h in zip(self.upstreams,self.health):
+                s = h.stats()
+                s.update(u.stats())
+                upstreams["%s:%d" % (u.address,u.port)] = s
+        return {
+            'queries': self.queries,
+            'hedged': self.hedged,
+            'failovers': self.failovers,
+            'failed': self.failed,
+            'upstreams': upstreams,
+        }
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+    FastZoneParser - streaming zone file parser for large zones
+
+    ZoneParser tokenises the zone with WordLexer, which reads the input a
+    character at a time (with peek/pushback), and RR.fromZone builds a
+    list of every RR. FastZoneParser reads the input a line at a time and
+    splits each line into tokens with a single compiled regex, then
+    builds the RRs exactly as ZoneParser does (same $ORIGIN/$TTL, blank
+    owner, parenthesis, quoting and escape handling) - yielding them one
+    at a time, so a zone can be streamed straight into a ZoneStore
+    without holding the whole file or a list of RRs in memory.
+
+    (Unlike ZoneParser a line containing only whitespace, or whitespace
+    and a comment, is ignored rather than raising IndexError)
+
+    >>> zone = '''
+    ... $ORIGIN abc.com.
+    ... $TTL 300
+    ... @       IN  SOA ns1 admin ( 2024010101 ; serial
+    ...                   3600 600 86400 60 )
+    ...         IN  NS  ns1
+    ... ns1         A   1.2.3.4
+    ...             A   1.2.3.5   ; second address
+    ... txt     60  TXT "quoted \\\\"text\\\\" ; not a comment" 'single'
+    ... '''
+    >>> for rr in FastZoneParser(zone):
+    ...     print(rr.toZone())
+    abc.com.                300     IN      SOA     ns1.abc.com. admin.abc.com. 2024010101 3600 600 86400 60
+    abc.com.                300     IN      NS      ns1.abc.com.
+    ns1.abc.com.            300     IN      A       1.2.3.4
+    ns1.abc.com.            300     IN      A       1.2.3.5
+    txt.abc.com.            60      IN      TXT     "quoted "text" ; not a comment" "single"
+    >>> list(FastZoneParser(zone)) == list(ZoneParser(zone))
+    True
+
+    load_zone streams the records into a ZoneStore, calling progress
+    (with the number of records and bytes read and the elapsed time)
+    every 'interval' records and at the end
+
+    >>> from dnslib.zonestore import ZoneStore
+    >>> store = ZoneStore()
+    >>> def progress(records,nbytes,elapsed):
+    ...     print("%d records %d bytes" % (records,nbytes))
+    >>> load_zone(zone,store,progress=progress,interval=2)
+    2 records 133 bytes
+    4 records 200 bytes
+    5 records 259 bytes
+    5
+    >>> len(store)
+    5
+"""
+
+from __future__ import print_function
+
+import io,re,time
+
+from dnslib.dns import ZoneParser,DNSLabel,parse_time
+
+TOKEN = re.compile(r'''
+      (?P<space>[ \t\x0b\x0c]+)
+    | (?P<comment>;.*)
+    | (?P<quote>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<word>[!\#-:<-~]+)
+    | (?P<open>["'])
+    | (?P<bad>.)
+''',re.X|re.S)
+
+ESCAPE = {'n':'\n','t':'\t','r':'\r'}
+
+def unescape(s):
+    """
+        Decode escapes in a quoted string (as Lexer.readescaped)
+    """
+    if '\\' not in s:
+        return s
+    out = []
+    i = 0
+    while i < len(s):
+        c = s[i]
+        if c == '\\':
+            n = s[i+1:i+4]
+            if n.isdigit():
+                out.append(chr(int(n,8)))
+                i += 1 + len(n)
+            elif n[:1] == 'x':
+                out.append(chr(int(n[1:],16)))
+                i += 1 + len(n)
+            else:
+                c = s[i+1:i+2]
+                out.append(ESCAPE.get(c,c))
+                i += 2
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+class FastZoneParser(ZoneParser):
+
+    """
+        Streaming zone file parser (see module docstring)
+    """
+
+    def __init__(self,zone,origin="",ttl=0):
+        if hasattr(zone,'read'):
+            self.f = zone
+        elif type(zone) == bytes:
+            self.f = io.StringIO(zone.decode())
+        elif type(zone) == str:
+            self.f = io.StringIO(zone)
+        else:
+            raise ValueError("Invalid input")
+        if type(origin) is DNSLabel:
+            self.origin = origin
+        else:
+            self.origin= DNSLabel(origin)
+        self.ttl = ttl
+        self.label = DNSLabel("")
+        self.nbytes = 0
+
+    def lines(self):
+        """
+            Lines without line endings (a '\\r' also ends a line, as for
+            WordLexer)
+        """
+        for line in self.f:
+            self.nbytes += len(line)
+            line = line.rstrip('\r\n')
+            if '\r' in line:
+                for part in line.split('\r'):
+                    yield part
+            else:
+                yield line
+
+    def tokens(self):
+        """
+            Yield list of (kind,value) tokens for each line. A quoted
+            string may continue over several lines (as for WordLexer)
+        """
+        lines = self.lines()
+        for line in lines:
+            while True:
+                tokens = []
+                for m in TOKEN.finditer(line):
+                    kind = m.lastgroup
+                    if kind == 'word':
+                        tokens.append(('ATOM',m.group()))
+                    elif kind == 'space':
+                        tokens.append(('SPACE',None))
+                    elif kind == 'quote':
+                        tokens.append(('ATOM',unescape(m.group()[1:-1])))
+                    elif kind == 'comment':
+                        tokens.append(('COMMENT',None))
+                    elif kind == 'open':
+                        break
+                    else:
+                        raise ValueError("Invalid input [%d]: %s" % (
+                                            self.nbytes,m.group()))
+                else:
+                    yield tokens
+                    break
+                # Unterminated quote - join the next line
+                try:
+                    line += '\n' + next(lines)
+                except StopIteration:
+                    tokens.append(('ATOM',unescape(line[m.start()+1:])))
+                    yield tokens
+                    break
+
+    def parse(self):
+        rr = []
+        paren = False
+        prev = None
+        for tokens in self.tokens():
+            i = iter(tokens)
+            for tok,val in i:
+                if tok == 'SPACE':
+                    if prev == 'NL' and not paren:
+                        rr.append('')
+                elif tok == 'ATOM':
+                    if val == '(':
+                        paren = True
+                    elif val == ')':
+                        paren = False
+                    elif val == '$ORIGIN':
+                        self.expect_token(i,'SPACE')
+                        origin = self.expect_token(i,'ATOM')
+                        self.origin = self.label = DNSLabel(origin)
+                    elif val == '$TTL':
+                        self.expect_token(i,'SPACE')
+                        ttl = self.expect_token(i,'ATOM')
+                        self.ttl = parse_time(ttl)
+                    else:
+                        rr.append(val)
+                prev = tok
+            # End of line
+            if not paren and rr:
+                if rr != ['']:
+                    yield self.parse_rr(rr)
+                rr = []
+            prev = 'NL'
+        if rr and rr != ['']:
+            yield self.parse_rr(rr)
+
+    def expect_token(self,i,expect):
+        t,val = next(i,('NL',None))
+        if t != expect:
+            raise ValueError("Invalid Token: %s (expecting: %s)" % (t,expect))
+        return val
+
+def load_zone(zone,store,origin="",ttl=0,progress=None,interval=100000):
+    """
+        Parse zone (str/bytes/file) with FastZoneParser and add the
+        records to store (ZoneStore). If progress is given it is called
+        as progress(records,bytes,elapsed) every 'interval' records and
+        when the zone has been loaded. Returns the number of records
+    """
+    parser = FastZoneParser(zone,origin,ttl)
+    start = time.perf_counter()
+    count = 0
+    for rr in parser:
+        store.add(rr)
+        count += 1
+        if progress and count % interval == 0:
+            progress(count,parser.nbytes,time.perf_counter() - start)
+    if progress:
+        progress(count,parser.nbytes,time.perf_counter() - start)
+    return count
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
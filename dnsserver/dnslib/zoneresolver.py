@@ -2,25 +2,100 @@
 
 from __future__ import print_function
 
-import copy
+import collections,copy,gc,os,threading,time
 
-from dnslib import RR,QTYPE,RCODE
+from dnslib import QTYPE,RCODE
+from dnslib.label import DNSBuffer
 from dnslib.server import DNSServer,DNSHandler,BaseResolver,DNSLogger
+from dnslib.zonestore import ZoneStore
+from dnslib.zonefile import load_zone
+from dnslib.zonesnapshot import ZoneSnapshot,open_snapshot,write_snapshot,source_stat
 
 class ZoneResolver(BaseResolver):
     """
         Simple fixed zone file resolver.
     """
 
-    def __init__(self,zone,glob=False):
+    def __init__(self,zone,glob=False,progress=None):
         """
-            Initialise resolver from zone file. 
-            Stores RRs as a list of (label,type,rr) tuples
+            Initialise resolver from zone file (str or file object).
+            Zone is parsed with the streaming FastZoneParser directly
+            into an indexed ZoneStore (see dnslib.zonefile/zonestore)
             If 'glob' is True use glob match against zone file 
+            'progress' is passed to load_zone (called with records,
+            bytes read and elapsed time while loading)
+
+            'zone' can also be a ZoneSnapshot (see dnslib.zonesnapshot),
+            which is served directly from the mmapped file (for glob
+            matching the records are loaded into a ZoneStore)
         """
-        self.zone = [(rr.rname,QTYPE[rr.rtype],rr) for rr in RR.fromZone(zone)]
         self.glob = glob
-        self.eq = 'matchGlob' if glob else '__eq__'
+        self.reload_lock = threading.Lock()
+        self.store = self.build_store(zone,progress)
+
+    def build_store(self,zone,progress=None):
+        if isinstance(zone,ZoneSnapshot):
+            return ZoneStore(zone,glob=True) if self.glob else zone
+        store = ZoneStore(glob=self.glob)
+        load_zone(zone,store,progress=progress)
+        return store
+
+    def reload(self,zone,progress=None):
+        """
+            Replace zone (same arguments as the constructor). The new
+            index is built before it is swapped in - resolve() looks the
+            store up once per request, so requests in progress finish
+            against the old zone and no request sees a partial zone. The
+            old zone is freed when the last request using it finishes.
+
+            Long running servers should gc.freeze() once the zone is
+            loaded, so full collections don't scan it (and after a reload
+            gc.unfreeze()/gc.collect() before freezing the new zone, or
+            the old one is never collected).
+
+            Returns dict with the number of records, records added and
+            removed, and the time taken
+        """
+        with self.reload_lock:
+            start = time.perf_counter()
+            store = self.build_store(zone,progress)
+            loaded = time.perf_counter()
+            added,removed = zone_delta(self.store,store)
+            self.store = store
+            return {
+                'records': len(store),
+                'added': added,
+                'removed': removed,
+                'load_time': loaded - start,
+                'elapsed': time.perf_counter() - start,
+            }
+
+    @property
+    def zone(self):
+        """
+            Zone as list of (label,type,rr) tuples
+        """
+        return [(rr.rname,QTYPE[rr.rtype],rr) for rr in self.store]
+
+    def writable_store(self):
+        # A snapshot is read-only - load it into a ZoneStore to update
+        if isinstance(self.store,ZoneSnapshot):
+            self.store = ZoneStore(self.store,glob=self.glob)
+        return self.store
+
+    def add(self,rr):
+        """
+            Add record to zone
+        """
+        with self.reload_lock:
+            self.writable_store().add(rr)
+
+    def remove(self,rr):
+        """
+            Remove record from zone (returns False if not found)
+        """
+        with self.reload_lock:
+            return self.writable_store().remove(rr)
 
     def resolve(self,request,handler):
         """
@@ -29,32 +104,139 @@ class ZoneResolver(BaseResolver):
         """
         reply = request.reply()
         qname = request.q.qname
-        qtype = QTYPE[request.q.qtype]
-        for name,rtype,rr in self.zone:
-            # Check if label & type match
-            if getattr(qname,self.eq)(name) and (qtype == rtype or 
-                                                 qtype == 'ANY' or 
-                                                 rtype == 'CNAME'):
-                # If we have a glob match fix reply label
-                if self.glob:
-                    a = copy.copy(rr)
-                    a.rname = qname
-                    reply.add_answer(a)
-                else:
-                    reply.add_answer(rr)
-                # Check for A/AAAA records associated with reply and
-                # add in additional section
-                if rtype in ['CNAME','NS','MX','PTR']:
-                    for a_name,a_rtype,a_rr in self.zone:
-                        if a_name == rr.rdata.label and a_rtype in ['A','AAAA']:
-                            reply.add_ar(a_rr)
+        # self.store is read once (reload swaps in a new store)
+        for rr,glue in self.store.find(qname,request.q.qtype):
+            # If we have a glob match fix reply label
+            if self.glob:
+                a = copy.copy(rr)
+                a.rname = qname
+                reply.add_answer(a)
+            else:
+                reply.add_answer(rr)
+            # A/AAAA records associated with CNAME/NS/MX/PTR reply go
+            # in additional section
+            for a_rr in glue:
+                reply.add_ar(a_rr)
         if not reply.rr:
             reply.header.rcode = RCODE.NXDOMAIN
         return reply
 
+def record_key(rr):
+    buffer = DNSBuffer()
+    rr.pack(buffer)
+    return bytes(buffer.data)
+
+def same_record(a,b):
+    # RR.__eq__ ignores the TTL - a TTL change counts as a changed record
+    return a == b and a.ttl == b.ttl
+
+def zone_delta(old,new):
+    """
+        (added,removed) record counts between two zones (iterables of RR)
+
+        Records are compared one by one from the start and the end of
+        the zones (a reload usually changes a few records in the middle)
+        - only the records in between are packed and counted
+    """
+    old,new = list(old),list(new)
+    start,end = 0,min(len(old),len(new))
+    while start < end and same_record(old[start],new[start]):
+        start += 1
+    tail = 0
+    while tail < end - start and same_record(old[-1-tail],new[-1-tail]):
+        tail += 1
+    delta = collections.Counter([ record_key(rr)
+                                    for rr in new[start:len(new)-tail] ])
+    delta.subtract([ record_key(rr) for rr in old[start:len(old)-tail] ])
+    added = sum([ n for n in delta.values() if n > 0 ])
+    removed = -sum([ n for n in delta.values() if n < 0 ])
+    return (added,removed)
+
+class ZoneWatcher(object):
+    """
+        Reload ZoneResolver when the zone file changes (polls the file
+        size/mtime every 'interval' seconds - interval=0 only reloads on
+        trigger()). Reloads run in a background thread, so the servers
+        carry on answering from the old zone while the new one is built.
+
+        If 'snapshot' is given, the zone is loaded from the snapshot if
+        it is current, otherwise the snapshot is rewritten after the zone
+        file is parsed.
+
+        'callback' is called with the stats returned by ZoneResolver.reload
+        (or with {'error':exception} if the reload fails - the old zone is
+        kept)
+    """
+
+    def __init__(self,resolver,path,interval=1.0,snapshot=None,callback=None):
+        self.resolver = resolver
+        self.path = path
+        self.interval = interval
+        self.snapshot = snapshot
+        self.callback = callback
+        self.event = threading.Event()
+        self.stopped = False
+        self.last = self.stat()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.event.set()
+
+    def trigger(self):
+        """
+            Request a reload (safe to call from a signal handler)
+        """
+        self.event.set()
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_size,st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def run(self):
+        while not self.stopped:
+            triggered = self.event.wait(self.interval or None)
+            self.event.clear()
+            if self.stopped:
+                break
+            current = self.stat()
+            if triggered or (current is not None and current != self.last):
+                self.last = current
+                self.reload()
+
+    def reload(self):
+        try:
+            zone = None
+            if self.snapshot:
+                zone = open_snapshot(self.snapshot,self.path)
+            if zone is None:
+                # Stat before parsing - if the file changes while it is
+                # read the snapshot is stale
+                stat = source_stat(self.path)
+                with open(self.path) as f:
+                    stats = self.resolver.reload(f)
+                if self.snapshot:
+                    write_snapshot(self.resolver.store,self.snapshot,
+                                   stat=stat)
+            else:
+                stats = self.resolver.reload(zone)
+        except Exception as e:
+            stats = {'error':e}
+        if self.callback:
+            self.callback(stats)
+        return stats
+
 if __name__ == '__main__':
 
-    import argparse,sys,time
+    import argparse,signal,sys
 
     p = argparse.ArgumentParser(description="Zone DNS Resolver")
     p.add_argument("--zone","-z",required=True,
@@ -68,6 +250,15 @@ if __name__ == '__main__':
                         help="Listen address (default:all)")
     p.add_argument("--glob",action='store_true',default=False,
                         help="Glob match against zone file (default: false)")
+    p.add_argument("--snapshot",
+                        metavar="<snapshot-file>",
+                        help="Serve zone from precompiled snapshot (recompiled from the zone file if missing or stale)")
+    p.add_argument("--watch",type=float,default=0,
+                        metavar="<seconds>",
+                        help="Reload zone when the zone file changes (poll interval) - SIGHUP always reloads (default: 0 - off)")
+    p.add_argument("--show",type=int,default=100,
+                        metavar="<records>",
+                        help="Number of zone records to print at startup (default: 100)")
     p.add_argument("--udplen","-u",type=int,default=0,
                     metavar="<udplen>",
                     help="Max UDP packet length (default:0)")
@@ -75,16 +266,43 @@ if __name__ == '__main__':
                         help="TCP server (default: UDP only)")
     p.add_argument("--log",default="request,reply,truncated,error",
                     help="Log hooks to enable (default: +request,+reply,+truncated,+error,-recv,-send,-data)")
+    p.add_argument("--pool-size",type=int,default=0,
+                    metavar="<threads>",
+                    help="Handle requests in a fixed pool of threads (default: 0 - thread per request)")
+    p.add_argument("--queue-size",type=int,default=256,
+                    metavar="<requests>",
+                    help="Max requests waiting for a pool thread before shedding load (default: 256)")
     p.add_argument("--log-prefix",action='store_true',default=False,
                     help="Log prefix (timestamp/handler/resolver) (default: False)")
     args = p.parse_args()
     
-    if args.zone == '-':
-        args.zone = sys.stdin
-    else:
-        args.zone = open(args.zone)
+    def progress(records,nbytes,elapsed):
+        print("Loading zone: %d records (%.1f MB) %.1fs [%.0f records/s]" % (
+                    records,nbytes / 1e6,elapsed,records / (elapsed or 1)))
 
-    resolver = ZoneResolver(args.zone,args.glob)
+    snapshot = None
+    if args.snapshot and args.zone != '-':
+        start = time.perf_counter()
+        snapshot = open_snapshot(args.snapshot,args.zone)
+        if snapshot:
+            print("Loaded snapshot: %s (%d records) %.3fs" % (
+                    args.snapshot,len(snapshot),time.perf_counter() - start))
+        else:
+            print("Snapshot missing or stale: %s - parsing zone file" %
+                    args.snapshot)
+
+    if snapshot:
+        resolver = ZoneResolver(snapshot,args.glob)
+    else:
+        if args.zone == '-':
+            args.zone = sys.stdin
+        else:
+            stat = source_stat(args.zone)
+            args.zone = open(args.zone)
+        resolver = ZoneResolver(args.zone,args.glob,progress=progress)
+        if args.snapshot and args.zone is not sys.stdin:
+            write_snapshot(resolver.store,args.snapshot,stat=stat)
+            print("Wrote snapshot: %s" % args.snapshot)
     logger = DNSLogger(args.log,args.log_prefix)
 
     print("Starting Zone Resolver (%s:%d) [%s]" % (
@@ -92,16 +310,45 @@ if __name__ == '__main__':
                         args.port,
                         "UDP/TCP" if args.tcp else "UDP"))
 
-    for rr in resolver.zone:
-        print("    | ",rr[2].toZone(),sep="")
+    for i,rr in enumerate(resolver.store):
+        if i == args.show:
+            print("    | ... (%d more)" % (len(resolver.store) - i))
+            break
+        print("    | ",rr.toZone(),sep="")
     print()
 
     if args.udplen:
         DNSHandler.udplen = args.udplen
 
+    # Move the zone out of the GC generations (it is long lived, and
+    # scanning it on every full collection stalls the server threads)
+    gc.collect()
+    gc.freeze()
+
+    def reloaded(stats):
+        if 'error' in stats:
+            print("Zone reload failed: %s (keeping old zone)" % stats['error'])
+        else:
+            print("Reloaded zone: %d records (+%d/-%d) in %.2fs (load %.2fs)" % (
+                        stats['records'],stats['added'],stats['removed'],
+                        stats['elapsed'],stats['load_time']))
+            # Freezing again would leave the old zone in the permanent
+            # generation - unfreeze, collect it and freeze the new zone
+            gc.unfreeze()
+            gc.collect()
+            gc.freeze()
+
+    if args.zone is not sys.stdin:
+        path = args.zone if snapshot else args.zone.name
+        watcher = ZoneWatcher(resolver,path,args.watch,
+                              args.snapshot,reloaded).start()
+        signal.signal(signal.SIGHUP,lambda signum,frame: watcher.trigger())
+
     udp_server = DNSServer(resolver,
                            port=args.port,
                            address=args.address,
+                           pool_size=args.pool_size,
+                           queue_size=args.queue_size,
                            logger=logger)
     udp_server.start_thread()
 
@@ -109,6 +356,8 @@ if __name__ == '__main__':
         tcp_server = DNSServer(resolver,
                                port=args.port,
                                address=args.address,
+                               pool_size=args.pool_size,
+                               queue_size=args.queue_size,
                                tcp=True,
                                logger=logger)
         tcp_server.start_thread()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+    ZoneSnapshot - precompiled binary zone for fast resolver startup
+
+    write_snapshot() compiles a zone into a binary file which
+    ZoneSnapshot mmaps (read-only) and answers lookups from directly -
+    there is no parsing at startup, and processes serving the same
+    snapshot share its pages through the page cache.
+
+    File layout (all integers network order):
+
+        header      magic/version, record count, hash table size, size
+                    and mtime of the source zone file, offsets of the
+                    name table and hash table
+        records     for each record (in zone order): length (H) and
+                    the RR in wire format (names uncompressed relative
+                    to the record, so each record decodes on its own)
+        names       for each distinct (lowercased) name: key length and
+                    record count (HH), the key (lowercased wire format
+                    name) and for each record with this name - offset (I),
+                    length (H), rtype (H) and the offset of the name
+                    entry for its glue (I - CNAME/NS/MX/PTR target, or
+                    NO_GLUE)
+        hash table  open addressing (linear probing) table of name entry
+                    offsets (I - 0 is empty) indexed by crc32 of the key
+
+    find() has the same interface and results as ZoneStore.find (exact
+    match only - glob zones are loaded into a ZoneStore).
+
+    If the snapshot is opened with the source zone file, it is checked
+    against the file's size and mtime - open_snapshot() returns None for
+    a stale, missing or invalid snapshot, so the caller can fall back to
+    parsing the zone file.
+
+    >>> import os,tempfile
+    >>> from dnslib.zonestore import ZoneStore,TEST_ZONE
+    >>> from dnslib.label import DNSLabel
+    >>> path = os.path.join(tempfile.mkdtemp(),"test.snap")
+    >>> write_snapshot(RR.fromZone(TEST_ZONE),path)
+    6
+    >>> snapshot = ZoneSnapshot(path)
+    >>> len(snapshot)
+    6
+    >>> list(snapshot) == RR.fromZone(TEST_ZONE)
+    True
+    >>> for rr,glue in snapshot.find(DNSLabel("ABC.com"),QTYPE.MX):
+    ...     print(rr.toZone())
+    ...     print([ a.toZone() for a in glue ])
+    abc.com.                60      IN      MX      10 mail.abc.com.
+    ['mail.abc.com.           60      IN      A       5.6.7.8']
+    >>> store = ZoneStore(RR.fromZone(TEST_ZONE))
+    >>> all([ snapshot.find(DNSLabel(n),t) == store.find(DNSLabel(n),t)
+    ...         for n in ("abc.com","www.abc.com","mail.abc.com","xyz.com")
+    ...             for t in (QTYPE.A,QTYPE.MX,QTYPE.TXT,QTYPE.ANY) ])
+    True
+    >>> snapshot.close()
+
+    Stale snapshots are rejected
+
+    >>> zone = os.path.join(os.path.dirname(path),"test.zone")
+    >>> with open(zone,"w") as f:
+    ...     _ = f.write(TEST_ZONE)
+    >>> compile_zone(zone,path)
+    6
+    >>> snapshot = open_snapshot(path,zone)
+    >>> len(snapshot)
+    6
+    >>> snapshot.close()
+    >>> with open(zone,"a") as f:
+    ...     _ = f.write("new.com. 60 A 1.1.1.1\\n")
+    >>> open_snapshot(path,zone) is None
+    True
+    >>> ZoneSnapshot(path,zone)
+    Traceback (most recent call last):
+    ...
+    dnslib.zonesnapshot.SnapshotError: Stale snapshot: ...
+
+    A snapshot of records read before the zone file changed is stale
+    (stat the file before reading it)
+
+    >>> stat = source_stat(zone)
+    >>> with open(zone,"a") as f:
+    ...     _ = f.write("new.org. 60 A 1.1.1.1\\n")
+    >>> write_snapshot(RR.fromZone(TEST_ZONE),path,stat=stat)
+    6
+    >>> open_snapshot(path,zone) is None
+    True
+"""
+
+from __future__ import print_function
+
+import collections,mmap,os,struct,zlib
+
+from dnslib.dns import RR,QTYPE
+from dnslib.label import DNSBuffer
+from dnslib.globmatch import name_key
+from dnslib.zonestore import GLUE_TYPES
+from dnslib.zonefile import FastZoneParser
+
+MAGIC = b'DNSZSNAP'
+VERSION = 1
+
+# magic,version,flags,records,buckets,source size,source mtime (ns),
+# names offset,hash table offset
+HEADER = struct.Struct("!8sHHIIQqQQ")
+RECLEN = struct.Struct("!H")
+NAME = struct.Struct("!HH")
+NAMEREC = struct.Struct("!IHHI")
+BUCKET = struct.Struct("!I")
+NO_GLUE = 0xFFFFFFFF
+MAX_OFFSET = 0xFFFFFFFE
+
+class SnapshotError(Exception):
+    pass
+
+def wire_key(key):
+    """
+        Lowercased wire format name for key (name_key tuple)
+    """
+    return b''.join([ struct.pack("!B",len(l)) + l for l in key ]) + b'\x00'
+
+def source_stat(source):
+    """
+        (size,mtime_ns) for source zone file (or (0,0))
+    """
+    if source is None:
+        return (0,0)
+    st = os.stat(source)
+    return (st.st_size,st.st_mtime_ns)
+
+def write_snapshot(rrs,path,source=None,stat=None):
+    """
+        Write records (iterable of RR) to snapshot file 'path' - source is
+        the zone file the records came from (used to detect a stale
+        snapshot) and stat its (size,mtime_ns) from source_stat() taken
+        before it was read (default: now - if the file can change while
+        it is being parsed, pass the stat from before, so a snapshot of
+        the old contents isn't marked current). File is written to a temp
+        file and renamed, so readers never see a partial snapshot.
+        Returns number of records
+    """
+    src_size,src_mtime = stat if stat is not None else source_stat(source)
+    records = bytearray()
+    names = collections.OrderedDict()
+    count = 0
+    for rr in rrs:
+        buffer = DNSBuffer()
+        rr.pack(buffer)
+        offset = HEADER.size + len(records) + RECLEN.size
+        records += RECLEN.pack(len(buffer.data))
+        records += buffer.data
+        key = name_key(rr.rname)
+        target = name_key(rr.rdata.label) if rr.rtype in GLUE_TYPES else None
+        names.setdefault(key,[]).append((offset,len(buffer.data),rr.rtype,target))
+        count += 1
+    # Name entry offsets
+    names_offset = HEADER.size + len(records)
+    entries = {}
+    offset = names_offset
+    for key,recs in names.items():
+        entries[key] = offset
+        offset += NAME.size + len(wire_key(key)) + NAMEREC.size * len(recs)
+    if offset > MAX_OFFSET:
+        raise SnapshotError("Zone too large for snapshot")
+    table_offset = offset
+    nbuckets = 8
+    while nbuckets < len(names) * 2:
+        nbuckets *= 2
+    table = [0] * nbuckets
+    data = bytearray()
+    for key,recs in names.items():
+        wire = wire_key(key)
+        data += NAME.pack(len(wire),len(recs))
+        data += wire
+        for offset,length,rtype,target in recs:
+            data += NAMEREC.pack(offset,length,rtype,entries.get(target,NO_GLUE))
+        i = zlib.crc32(wire) & (nbuckets - 1)
+        while table[i]:
+            i = (i + 1) & (nbuckets - 1)
+        table[i] = entries[key]
+    header = HEADER.pack(MAGIC,VERSION,0,count,nbuckets,src_size,src_mtime,
+                         names_offset,table_offset)
+    tmp = "%s.tmp.%d" % (path,os.getpid())
+    with open(tmp,"wb") as f:
+        f.write(header)
+        f.write(records)
+        f.write(data)
+        f.write(struct.pack("!%dI" % nbuckets,*table))
+    os.replace(tmp,path)
+    return count
+
+def compile_zone(zone,path,origin="",ttl=0):
+    """
+        Compile zone file (path) to snapshot. Returns number of records
+    """
+    stat = source_stat(zone)
+    with open(zone) as f:
+        return write_snapshot(FastZoneParser(f,origin,ttl),path,stat=stat)
+
+class ZoneSnapshot(object):
+    """
+        Read-only zone served from an mmapped snapshot (see module
+        docstring)
+    """
+
+    glob = False
+
+    def __init__(self,path,source=None):
+        """
+            path    - snapshot file
+            source  - zone file the snapshot was compiled from (raises
+                      SnapshotError if it has changed since)
+        """
+        with open(path,"rb") as f:
+            self.mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            if len(self.mm) < HEADER.size:
+                raise SnapshotError("Invalid snapshot: %s" % path)
+            (magic,version,flags,self.count,self.nbuckets,src_size,src_mtime,
+                self.names_offset,self.table_offset) = HEADER.unpack_from(self.mm)
+            if magic != MAGIC or version != VERSION:
+                raise SnapshotError("Invalid snapshot: %s" % path)
+            if self.table_offset + self.nbuckets * BUCKET.size != len(self.mm):
+                raise SnapshotError("Invalid snapshot (truncated): %s" % path)
+            if source is not None and \
+                    source_stat(source) != (src_size,src_mtime):
+                raise SnapshotError("Stale snapshot: %s" % path)
+        except Exception:
+            self.mm.close()
+            raise
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+            Iterate over records (in zone order)
+        """
+        offset = HEADER.size
+        while offset < self.names_offset:
+            length, = RECLEN.unpack_from(self.mm,offset)
+            offset += RECLEN.size
+            yield self.rr(offset,length)
+            offset += length
+
+    def rr(self,offset,length):
+        return RR.parse(DNSBuffer(self.mm[offset:offset+length]))
+
+    def lookup(self,key):
+        """
+            Offset of name entry for key (name_key tuple) or None
+        """
+        wire = wire_key(key)
+        mask = self.nbuckets - 1
+        i = zlib.crc32(wire) & mask
+        while True:
+            entry, = BUCKET.unpack_from(self.mm,self.table_offset + i * BUCKET.size)
+            if entry == 0:
+                return None
+            keylen,_ = NAME.unpack_from(self.mm,entry)
+            start = entry + NAME.size
+            if self.mm[start:start+keylen] == wire:
+                return entry
+            i = (i + 1) & mask
+
+    def records(self,entry):
+        """
+            List of (offset,length,rtype,glue entry) for name entry
+        """
+        keylen,n = NAME.unpack_from(self.mm,entry)
+        start = entry + NAME.size + keylen
+        return [ NAMEREC.unpack_from(self.mm,start + i * NAMEREC.size)
+                        for i in range(n) ]
+
+    def glue(self,entry):
+        if entry == NO_GLUE:
+            return []
+        return [ self.rr(offset,length)
+                    for offset,length,rtype,_ in self.records(entry)
+                        if rtype in (QTYPE.A,QTYPE.AAAA) ]
+
+    def find(self,qname,qtype):
+        """
+            Return list of (rr,glue) for records matching qname (DNSLabel)
+            and qtype (int) - as ZoneStore.find
+        """
+        entry = self.lookup(name_key(qname))
+        if entry is None:
+            return []
+        return [ (self.rr(offset,length),self.glue(glue))
+                    for offset,length,rtype,glue in self.records(entry)
+                        if qtype == rtype or qtype == QTYPE.ANY or
+                           rtype == QTYPE.CNAME ]
+
+def open_snapshot(path,source=None):
+    """
+        ZoneSnapshot for path - or None if the snapshot is missing,
+        invalid or stale (older than source)
+    """
+    try:
+        return ZoneSnapshot(path,source)
+    except (OSError,ValueError,SnapshotError):
+        return None
+
+if __name__ == '__main__':
+
+    import argparse,time
+
+    p = argparse.ArgumentParser(description="Compile zone file to snapshot")
+    p.add_argument("zone",metavar="<zone-file>",
+                    help="Zone file")
+    p.add_argument("snapshot",metavar="<snapshot-file>",
+                    help="Snapshot file")
+    args = p.parse_args()
+
+    start = time.perf_counter()
+    count = compile_zone(args.zone,args.snapshot)
+    print("Compiled %d records to %s (%d bytes) in %.2fs" % (
+                count,args.snapshot,os.path.getsize(args.snapshot),
+                time.perf_counter() - start))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""
+    ZoneStore - indexed store of zone RRs for ZoneResolver
+
+    Records are indexed so that a lookup doesn't have to scan the zone:
+
+        - exact match: dict keyed on the lowercased label tuple, holding a
+          dict of rtype -> records
+        - glob match: trie keyed on the reversed (lowercased) labels. A
+          glob pattern is stored at the node for its literal suffix (the
+          trailing labels with no glob characters), so a lookup only tries
+          the patterns found while walking down the query name (each
+          compiled once - see dnslib.globmatch)
+        - glue: A/AAAA records by name, and the target of each CNAME/NS/
+          MX/PTR record is worked out when it is added, so the additional
+          records for an answer are a single dict lookup
+
+    Records can be added and removed at any time (the indexes are updated
+    in place). Lookups return records in the order they were added - the
+    same order the linear scan of the zone gave.
+
+    >>> store = ZoneStore(RR.fromZone(TEST_ZONE))
+    >>> len(store)
+    6
+    >>> for rr,glue in store.find(DNSLabel("ABC.com"),QTYPE.A):
+    ...     print(rr.toZone())
+    abc.com.                60      IN      A       1.2.3.4
+    >>> for rr,glue in store.find(DNSLabel("abc.com"),QTYPE.MX):
+    ...     print(rr.toZone())
+    ...     print([ a.toZone() for a in glue ])
+    abc.com.                60      IN      MX      10 mail.abc.com.
+    ['mail.abc.com.           60      IN      A       5.6.7.8']
+    >>> [ QTYPE[rr.rtype] for rr,glue in store.find(DNSLabel("abc.com"),QTYPE.ANY) ]
+    ['A', 'MX', 'TXT']
+    >>> store.find(DNSLabel("xyz.com"),QTYPE.A)
+    []
+
+    CNAME records are returned for any qtype
+
+    >>> [ rr.toZone() for rr,glue in store.find(DNSLabel("www.abc.com"),QTYPE.AAAA) ]
+    ['www.abc.com.            60      IN      CNAME   abc.com.']
+
+    Incremental updates (glue is updated too)
+
+    >>> store.remove(RR.fromZone("mail.abc.com 60 A 5.6.7.8")[0])
+    True
+    >>> store.find(DNSLabel("abc.com"),QTYPE.MX)[0][1]
+    []
+    >>> store.add(RR.fromZone("mail.abc.com 60 AAAA ::1")[0])
+    >>> [ a.toZone() for a in store.find(DNSLabel("abc.com"),QTYPE.MX)[0][1] ]
+    ['mail.abc.com.           60      IN      AAAA    ::1']
+    >>> store.remove(RR.fromZone("nothere.com 60 A 1.1.1.1")[0])
+    False
+
+    Glob matching
+
+    >>> store = ZoneStore(RR.fromZone(TEST_ZONE),glob=True)
+    >>> [ rr.toZone() for rr,glue in store.find(DNSLabel("x.y.wild.com"),QTYPE.A) ]
+    ['*.wild.com.             60      IN      A       9.9.9.9']
+    >>> [ rr.toZone() for rr,glue in store.find(DNSLabel("Abc.Com"),QTYPE.A) ]
+    ['abc.com.                60      IN      A       1.2.3.4']
+    >>> store.find(DNSLabel("wild.com"),QTYPE.A)
+    []
+    >>> store.remove(RR.fromZone("*.wild.com 60 A 9.9.9.9")[0])
+    True
+    >>> store.find(DNSLabel("x.wild.com"),QTYPE.A)
+    []
+"""
+
+from __future__ import print_function
+
+import itertools
+
+from dnslib.dns import RR,QTYPE
+from dnslib.label import DNSLabel
+from dnslib.globmatch import name_key,literal_suffix,key_str,compile_glob
+
+TEST_ZONE = """
+abc.com.        60  A     1.2.3.4
+abc.com.        60  MX    10 mail.abc.com.
+www.abc.com.    60  CNAME abc.com.
+mail.abc.com.   60  A     5.6.7.8
+abc.com.        60  TXT   "txt"
+*.wild.com.     60  A     9.9.9.9
+"""
+
+# Records which get A/AAAA glue for their target in the additional section
+GLUE_TYPES = (QTYPE.CNAME,QTYPE.NS,QTYPE.MX,QTYPE.PTR)
+
+class ZoneEntry(object):
+
+    __slots__ = ('seq','rr','key','target','pattern')
+
+    def __init__(self,seq,rr):
+        self.seq = seq
+        self.rr = rr
+        self.key = name_key(rr.rname)
+        if rr.rtype in GLUE_TYPES:
+            self.target = name_key(rr.rdata.label)
+        else:
+            self.target = None
+        self.pattern = None
+
+class TrieNode(object):
+
+    __slots__ = ('children','entries')
+
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+
+class ZoneStore(object):
+    """
+        Indexed zone (see module docstring)
+    """
+
+    def __init__(self,rrs=(),glob=False):
+        """
+            rrs     - initial records
+            glob    - match query names against record names as glob
+                      patterns (see DNSLabel.matchGlob)
+        """
+        self.glob = glob
+        self.seq = itertools.count()
+        self.names = {}
+        self.trie = TrieNode()
+        self.glue = {}
+        self.count = 0
+        for rr in rrs:
+            self.add(rr)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+            Iterate over records (in the order they were added)
+        """
+        entries = [ e for rtypes in self.names.values()
+                            for l in rtypes.values()
+                                for e in l ]
+        entries.sort(key=lambda e:e.seq)
+        return iter([ e.rr for e in entries ])
+
+    def add(self,rr):
+        """
+            Add record
+        """
+        entry = ZoneEntry(next(self.seq),rr)
+        self.names.setdefault(entry.key,{}).setdefault(rr.rtype,[]).append(entry)
+        if rr.rtype in (QTYPE.A,QTYPE.AAAA):
+            self.glue.setdefault(entry.key,[]).append(rr)
+        if self.glob:
+            entry.pattern = compile_glob(str(rr.rname).lower())
+            self.trie_node(entry.key,create=True).entries.append(entry)
+        self.count += 1
+
+    def remove(self,rr):
+        """
+            Remove (first) record equal to rr. Returns False if not found
+        """
+        key = name_key(rr.rname)
+        rtypes = self.names.get(key)
+        entries = rtypes.get(rr.rtype) if rtypes else None
+        for entry in entries or ():
+            if entry.rr == rr:
+                break
+        else:
+            return False
+        entries.remove(entry)
+        if not entries:
+            del rtypes[rr.rtype]
+            if not rtypes:
+                del self.names[key]
+        if rr.rtype in (QTYPE.A,QTYPE.AAAA):
+            glue = self.glue[key]
+            glue.remove(entry.rr)
+            if not glue:
+                del self.glue[key]
+        if self.glob:
+            self.trie_remove(entry)
+        self.count -= 1
+        return True
+
+    def trie_node(self,key,create=False):
+        node = self.trie
+        for label in reversed(literal_suffix(key)):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = TrieNode()
+            node = child
+        return node
+
+    def trie_remove(self,entry):
+        path = [self.trie]
+        for label in reversed(literal_suffix(entry.key)):
+            path.append(path[-1].children[label])
+        path[-1].entries.remove(entry)
+        # Prune empty nodes
+        labels = list(literal_suffix(entry.key))
+        while len(path) > 1 and not path[-1].entries and not path[-1].children:
+            path.pop()
+            del path[-1].children[labels.pop(0)]
+
+    def match_exact(self,key):
+        rtypes = self.names.get(key)
+        if not rtypes:
+            return ()
+        return [ e for l in rtypes.values() for e in l ]
+
+    def match_glob(self,key):
+        # A pattern only matches names ending in its literal suffix, so
+        # collect candidates from the nodes along the (reversed) name
+        node = self.trie
+        candidates = list(node.entries)
+        for label in reversed(key):
+            node = node.children.get(label)
+            if node is None:
+                break
+            candidates.extend(node.entries)
+        if not candidates:
+            return ()
+        name = key_str(key)
+        return [ e for e in candidates if e.pattern(name) ]
+
+    def find(self,qname,qtype):
+        """
+            Return list of (rr,glue) for records matching qname (DNSLabel)
+            and qtype (int) - records of type qtype, or any type for ANY,
+            and CNAME records. glue is the list of A/AAAA records for the
+            name a CNAME/NS/MX/PTR record points to
+        """
+        key = name_key(qname)
+        if self.glob:
+            entries = self.match_glob(key)
+        else:
+            entries = self.match_exact(key)
+        matches = [ e for e in entries if qtype == e.rr.rtype or
+                                          qtype == QTYPE.ANY or
+                                          e.rr.rtype == QTYPE.CNAME ]
+        matches.sort(key=lambda e:e.seq)
+        return [ (e.rr,self.glue.get(e.target,[]) if e.target else [])
+                        for e in matches ]
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -1,86 +1,395 @@
 #!/usr/bin/env python3
+"""
+    Geolocate telemetry messages from the access points they saw, with
+    the remote geolocation API (see GeolocatePool).
+
+    Messages stored by the DNS server, located through a stub API:
+
+    >>> import http.server, tempfile
+    >>> from mydns import DataSaver
+    >>> class StubAPI(http.server.BaseHTTPRequestHandler):
+    ...     def do_POST(self):
+    ...         self.rfile.read(int(self.headers['Content-Length']))
+    ...         body = json.dumps({'location': {'lat': 51.5, 'lng': -0.1},
+    ...             'accuracy': 20}).encode('ascii')
+    ...         self.send_response(200)
+    ...         self.send_header('Content-Length', str(len(body)))
+    ...         self.end_headers()
+    ...         self.wfile.write(body)
+    ...     def log_message(self, *args):
+    ...         pass
+    >>> api = http.server.HTTPServer(('localhost', 0), StubAPI)
+    >>> threading.Thread(target=api.serve_forever, daemon=True).start()
+    >>> directory = tempfile.mkdtemp()
+    >>> class Saver(DataSaver):
+    ...     db_directory = os.path.join(directory, 'messages')
+    >>> saver = Saver()
+    >>> chunks = {
+    ...     '1a2b.1': ['machine-1', 'time-836000000', 'ap-aabbccddeeff--50', 'ap-001122334455--60'],
+    ...     '1a2b.2': ['machine-1', 'time-836000060', 'ap-aabbccddeeff--55'],
+    ...     '1a2b.3': ['machine-1', 'time-836000120', 'ap-aabbccddeeff--52', 'ap-001122334455--61'],
+    ...     }
+    >>> all([saver.store_name('%s.%s' % (part, chunk_id))
+    ...     for chunk_id, parts in chunks.items() for part in parts + ['eom']])
+    True
+    >>> saver.close()
+    >>> saver.stats()['rows_written']
+    3
+    >>> store = MessageStore(saver.db_directory)
+    >>> store.partitions()
+    ['2026-06']
+    >>> pool = GeolocatePool(store, workers=2, rate=100,
+    ...     url='http://localhost:%d/geolocate' % api.server_port,
+    ...     cache=FingerprintCache(':memory:'))
+    >>> for id, time_created in store.select('id, time_created', 'status IS NULL', ordered=True):
+    ...     pool.submit(id, time_created, store.aps(id, time_created))
+    ...     pool.collect()
+    >>> pool.close()
+    >>> for row in store.select('id, status, lat, lon', ordered=True):
+    ...     print(row)
+    ('1a2b.1', 'OK', 51.5, -0.1)
+    ('1a2b.2', 'ERROR', None, None)
+    ('1a2b.3', 'CACHED', 51.5, -0.1)
+    >>> stats = pool.stats()
+    >>> stats['located'], stats['located_cached'], stats['not_found']
+    (1, 1, 1)
+    >>> store.close()
+    >>> api.shutdown()
+"""
 
 import os
 import json
-import sqlite3
+import time
+import random
+import argparse
+import threading
+import http.client
+import urllib.error
 import urllib.request
+import concurrent.futures
+
+from messagestore import MessageStore, decode_stored, format_bssid
+from apcache import FingerprintCache
+from apindex import BSSIDIndex, build as build_index
 
 api_key = 'wrong'
 MIN_ACCURACY = 200 # Metres
+API_URL = 'https://www.googleapis.com/geolocation/v1/geolocate'
 
-def load_api_key():
+def load_api_key(filename='api_key.txt'):
     global api_key
-    api_key = open('api_key.txt').read().strip()
-
-def normalise_mac(mac):
-    # Convert mac adddress into 02:ab:cd:ef:09:10
-    mac = mac.replace(':','')
-    chunks = []
-    for n in range(len(mac) // 2):
-        chunk = mac[n*2: n*2 + 2]
-        chunks.append(chunk.upper())
-    return ':'.join(chunks)
-
-def geolocate(ap_list):
+    api_key = open(filename).read().strip()
+
+class RetryableError(Exception):
+    """
+        Rate limited (HTTP 429), server error (5xx) or network error:
+        the request may succeed if tried again later. retry_after is the
+        delay the server asked for (seconds) if any.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket():
+    """
+        Allows rate requests per second on average, with bursts of up to
+        burst requests. take() blocks until a request is allowed; it is
+        safe to call from several threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def geolocate(ap_list, url=API_URL, timeout=10):
+    """
+        Return (lat, lon) for a list of (mac address, signal strength),
+        or None if the location isn't known (accurately enough) or the
+        answer can't be understood. Raises RetryableError if it's worth
+        trying again later.
+    """
     # Build json request
     jsonobj = {'wifiAccessPoints': [
-       { "macAddress" : a[0], "signalStrength": a[1] } 
-        for a in ap_list ] 
+       { "macAddress" : a[0], "signalStrength": a[1] }
+        for a in ap_list ]
         }
-    url = 'https://www.googleapis.com/geolocation/v1/geolocate?key=' + api_key
+    url = url + '?key=' + api_key
     try:
         req = urllib.request.Request(url, bytes(json.dumps(jsonobj), 'ascii'),
             headers = {'Content-Type': 'application/json'} )
-        resp = urllib.request.urlopen(req)
+        resp = urllib.request.urlopen(req, timeout=timeout)
+        body = resp.read()
     except urllib.error.HTTPError as e:
+        if e.code == 429 or e.code >= 500:
+            retry_after = e.headers.get('Retry-After')
+            raise RetryableError('HTTP %d' % e.code,
+                float(retry_after) if retry_after and retry_after.isdigit() else None)
+        return None
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        # Includes timeouts and connection resets while reading the body
+        raise RetryableError(str(e))
+    try:
+        respobj = json.loads(str(body, 'ascii'))
+        if 'location' in respobj:
+            loc = respobj['location']
+            if respobj['accuracy'] < MIN_ACCURACY:
+                return (float(loc['lat']), float(loc['lng']))
+    except (ValueError, KeyError, TypeError):
+        # Malformed answer
         return None
-    resp_json = str(resp.read(), 'ascii')
-    print(resp_json)
-    respobj = json.loads(resp_json)
-    if 'location' in respobj:
-        loc = respobj['location']
-        if respobj['accuracy'] < MIN_ACCURACY:
-            return (loc['lat'], loc['lng'])
     # Not found
-    return None 
-
-def process_message(db, id, raw_info):
-    print("Processing message id=", id)
-    entries = raw_info.split('\n')
-    entset = set(map(lambda s: s.strip(), entries))
-    aps = [] # List of tuple: macaddr, sig strength
-    for entry in sorted(entset):
-        bits = entry.split('-', 2)
-        if bits[0] == 'ap':
-            # Accesspoint
-            mac = normalise_mac(bits[1])
-            strength = int(bits[2])
-            aps.append( (mac, strength) )
-    for ap in aps:
-        print(ap) 
-    status = 'ERROR'
-    lat = None
-    if len(aps) > 1:
-        # We can geolocate.
-        where = geolocate(aps)
-        if where is not None:
+    return None
+
+class GeolocatePool():
+    """
+        Geolocates messages on a pool of worker threads.
+
+        The caller (one thread - it owns the MessageStore) reads the
+        messages and their APs and submits them; workers call the API,
+        each call first taking a token from a shared TokenBucket, and
+        retry HTTP 429/5xx and network errors with exponential backoff
+        (with jitter, or the server's Retry-After). Results are written
+        back in batches of batch_size, one transaction per partition.
+
+        A message which still fails after max_retries is left with status
+        NULL, so the next run tries it again.
+
+        If a FingerprintCache is given, messages whose APs are (nearly)
+        the same as an earlier message's are answered from it without an
+        API call (status 'CACHED'), and API answers are added to it.
+
+        If a BSSIDIndex is given, messages the cache can't answer are
+        positioned from the known locations of their APs if possible
+        (status 'LOCAL'), and only sent to the API otherwise.
+
+        Only API answers get status 'OK', so the index (see
+        apindex.build) never learns from reused or estimated positions.
+    """
+    def __init__(self, store, workers=8, rate=10.0, burst=None, url=API_URL,
+            max_retries=5, backoff=1.0, max_backoff=60.0, batch_size=500,
+            max_pending=None, cache=None, index=None):
+        self.store = store
+        self.cache = cache
+        self.index = index
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.max_pending = max_pending or workers * 4
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers,
+            thread_name_prefix='geolocate')
+        self.pending = {}
+        self.updates = []
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.located = 0
+        self.located_locally = 0
+        self.located_cached = 0
+        self.not_found = 0
+        self.failed = 0
+        self.retries = 0
+
+    def locate(self, aps):
+        """
+            (lat, lon) or None - or RetryableError if retries ran out
+        """
+        ap_list = [ (format_bssid(bssid), rssi) for bssid, rssi in aps ]
+        attempt = 0
+        while True:
+            self.bucket.take()
+            try:
+                return geolocate(ap_list, self.url)
+            except RetryableError as e:
+                if attempt >= self.max_retries:
+                    return e
+                delay = e.retry_after
+                if delay is None:
+                    delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                    delay *= random.uniform(0.5, 1.0)
+                attempt += 1
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+
+    def submit(self, id, time_created, aps):
+        """
+            Queue a message (aps is a list of (bssid, signal strength)).
+            Blocks while max_pending messages are in progress.
+        """
+        if len(aps) < 2:
+            # Can't geolocate
+            self.result(id, time_created, None)
+            return
+        if self.cache is not None:
+            cached = self.cache.lookup(aps)
+            if cached is not None:
+                self.result(id, time_created, cached[0], 'CACHED')
+                return
+        if self.index is not None:
+            where = self.index.locate(aps)
+            if where is not None:
+                lat, lon, accuracy = where
+                self.result(id, time_created, (lat, lon), 'LOCAL')
+                return
+        while len(self.pending) >= self.max_pending:
+            self.collect(concurrent.futures.FIRST_COMPLETED)
+        future = self.executor.submit(self.locate, aps)
+        self.pending[future] = (id, time_created, aps)
+
+    def collect(self, return_when=concurrent.futures.ALL_COMPLETED):
+        done, _ = concurrent.futures.wait(list(self.pending), return_when=return_when)
+        for future in done:
+            id, time_created, aps = self.pending.pop(future)
+            try:
+                where = future.result()
+            except Exception as e:
+                # Unexpected error in a worker: leave the message for the
+                # next run rather than lose the other results
+                print("Geolocate %s failed: %r" % (id, e))
+                where = RetryableError(repr(e))
+            if self.cache is not None and not isinstance(where, RetryableError):
+                self.cache.put(aps, where)
+            self.result(id, time_created, where)
+
+    def result(self, id, time_created, where, status='OK'):
+        self.processed += 1
+        if isinstance(where, RetryableError):
+            self.failed += 1
+            return
+        if where is None:
+            self.not_found += 1
+            self.updates.append((id, time_created, 'ERROR', None, None))
+        else:
+            if status == 'LOCAL':
+                self.located_locally += 1
+            elif status == 'CACHED':
+                self.located_cached += 1
+            else:
+                self.located += 1
             lat, lon = where
-            status = 'OK'
-    with db:
-        db.execute('UPDATE message SET status=? WHERE id=?',
-            (status, id))
-        if lat:
-            db.execute('UPDATE message SET lat=?, lon=? WHERE id=?',
-                (lat, lon, id))
+            self.updates.append((id, time_created, status, lat, lon))
+        if len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.updates:
+            self.store.update_many(self.updates, ('status', 'lat', 'lon'))
+            self.updates = []
+        if self.cache is not None:
+            # Cache hits' last_used times
+            self.cache.commit()
+
+    def close(self):
+        """
+            Wait for all queued messages and write their results
+        """
+        self.collect()
+        self.flush()
+        self.executor.shutdown()
+
+    def stats(self):
+        stats = {
+            'processed': self.processed,
+            'located': self.located,
+            'located_locally': self.located_locally,
+            'located_cached': self.located_cached,
+            'not_found': self.not_found,
+            'failed': self.failed,
+            'retries': self.retries,
+            'pending': len(self.pending),
+            }
+        if self.cache is not None:
+            cache_stats = self.cache.stats()
+            stats['cache_hit_rate'] = round(cache_stats['hit_rate'], 3)
+            stats['cache_entries'] = cache_stats['entries']
+        if self.index is not None:
+            stats.update(self.index.stats())
+        return stats
 
 def main():
-    load_api_key()
-    db = sqlite3.connect('messages.sqlite3')
-    cur = db.cursor()
-    cur.execute('select id, raw_info from message where status is null');
-    for row in cur:
-        id, raw_info = row
-        process_message(db, id, raw_info)
+    p = argparse.ArgumentParser(description="Geolocate telemetry messages")
+    p.add_argument("--directory", "-d", default="messages",
+                    help="Message store directory (default: messages)")
+    p.add_argument("--workers", "-w", type=int, default=8,
+                    help="Concurrent API requests (default: 8)")
+    p.add_argument("--rate", "-r", type=float, default=10.0,
+                    help="Max API requests per second (default: 10)")
+    p.add_argument("--burst", type=float, default=None,
+                    help="Max burst of API requests (default: rate)")
+    p.add_argument("--retries", type=int, default=5,
+                    help="Retries on HTTP 429/5xx (default: 5)")
+    p.add_argument("--batch-size", type=int, default=500,
+                    help="Status updates per commit (default: 500)")
+    p.add_argument("--url", default=API_URL,
+                    help="Geolocation API URL (default: %s)" % API_URL)
+    p.add_argument("--api-key-file", default="api_key.txt",
+                    help="File containing the API key (default: api_key.txt)")
+    p.add_argument("--cache", default="apcache.sqlite3",
+                    help="AP-set fingerprint cache file, '' for none (default: apcache.sqlite3)")
+    p.add_argument("--cache-threshold", type=float, default=0.6,
+                    help="Min Jaccard similarity of AP sets for a cache hit (default: 0.6)")
+    p.add_argument("--cache-ttl", type=float, default=30,
+                    help="Cache entry lifetime in days (default: 30)")
+    p.add_argument("--index", default="apindex.sqlite3",
+                    help="Local BSSID location index file, '' for none (default: apindex.sqlite3)")
+    p.add_argument("--build-index", action="store_true", default=False,
+                    help="Rebuild the BSSID index from located messages first")
+    args = p.parse_args()
+
+    load_api_key(args.api_key_file)
+    store = MessageStore(args.directory)
+    # Messages stored before decoding at ingest (each partition is only
+    # scanned once)
+    decode_stored(store)
+    cache = None
+    if args.cache:
+        cache = FingerprintCache(args.cache, threshold=args.cache_threshold,
+            ttl=args.cache_ttl * 86400)
+        cache.purge()
+    index = None
+    if args.index:
+        if args.build_index:
+            print("Indexed %d BSSIDs" % build_index(store, args.index))
+        index = BSSIDIndex(args.index)
+    pool = GeolocatePool(store, workers=args.workers, rate=args.rate,
+        burst=args.burst, url=args.url, max_retries=args.retries,
+        batch_size=args.batch_size, cache=cache, index=index)
+    t0 = time.monotonic()
+    try:
+        for n, (id, time_created) in enumerate(
+                store.select('id, time_created', 'status is null')):
+            # Decoded at ingest (see messagestore.decode_chunk)
+            pool.submit(id, time_created, store.aps(id, time_created))
+            if n and n % 1000 == 0:
+                elapsed = time.monotonic() - t0
+                print("%d messages %.1f/s %s" % (n, n / elapsed, pool.stats()))
+    finally:
+        try:
+            pool.close()
+            store.close()
+        finally:
+            # Even if the run failed: commits the cache's last_used times
+            stats = pool.stats()
+            if cache is not None:
+                cache.close()
+    print("Done in %.1fs:" % (time.monotonic() - t0), stats)
 
 if __name__ == '__main__':
     main()
@@ -2,24 +2,26 @@
 
 import os
 import json
-import sqlite3
 import time
 import datetime
 
+from messagestore import MessageStore
+
 def main():
-    db = sqlite3.connect('messages.sqlite3')
-    cur = db.cursor()
+    store = MessageStore('messages')
     now = datetime.datetime.now()
     midnight = datetime.datetime(now.year, now.month, now.day, 0,0,0)
     midnight_ts = midnight.timestamp()
-    cur.execute("select id, time_created, lat, lon,time_human from message where status='OK' "
-        " and time_created > ? order by time_created", (midnight_ts, ));
+    # Only opens the partition(s) holding today's messages
+    rows = store.select("id, time_created, lat, lon,time_human", "status IN ('OK', 'CACHED', 'LOCAL')",
+        start=midnight_ts, ordered=True)
     with open('markers.js', 'w') as f:
         print("var markers=[", file=f)
-        for row in cur:
+        for row in rows:
             id, time_created, lat, lng, time_human = row
             print(" {lat: %f, lng: %f, id: '%s'}, " % (lat, lng, time_human), file=f )   
         print("];", file=f)
+    store.close()
 
 if __name__ == '__main__':
     main()
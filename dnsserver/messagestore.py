@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Message store - telemetry messages partitioned by time into one
+    SQLite file per month (or day).
+
+    A single flat message table gets slower to insert into and to scan as
+    it grows, and geolocate.py/makemap.py only ever want recent messages
+    or messages with a particular status. Each partition is a separate
+    database holding the usual message table, with indexes on status,
+    time_created and machine_id:
+
+        <directory>/messages-2026-10.sqlite3        (period='month')
+        <directory>/messages-2026-10-18.sqlite3     (period='day')
+
+    Messages are placed by time_created (UTC). A retransmitted chunk has
+    the same id and time_created so lands in the same partition, where
+    INSERT OR IGNORE drops it as before.
+
+    select() only opens the partitions which overlap the requested time
+    range, queries each in turn (oldest first) and yields the rows, so
+    with ordered=True the rows come out in time_created order without a
+    global sort.
+
+    Connections are cached per partition; a MessageStore (like a sqlite3
+    connection) should only be used from one thread.
+
+    Chunks are decoded once, at ingest (decode_chunk): the machine-,
+    time-, reset- and tx entries go into typed columns of the message
+    row, and each ap-<bssid>-<rssi> entry into a row of the ap table in
+    the same partition, with the BSSID as a 48 bit integer:
+
+        ap(message_id, bssid, rssi)     indexed on bssid
+
+    raw_info is still kept. Rows stored before decoding was added have
+    ap_count NULL; decode_stored() (or --decode) fills them in, and marks
+    the partition as done (user_version) so it is only scanned once.
+
+    Run this file to copy messages from an old single-file database into
+    a store:
+
+        python3 messagestore.py --import messages.sqlite3 --directory messages
+"""
+
+import calendar
+import datetime
+import os
+import re
+import sqlite3
+import time
+
+# Columns of the original single-file database
+LEGACY_COLUMNS = ('id', 'time_received', 'time_created', 'time_human', 'raw_info',
+    'status', 'machine_id', 'session_id', 'lat', 'lon')
+
+# Decoded at ingest
+DECODED_COLUMNS = ('reset_cause', 'tx', 'ap_count')
+
+COLUMNS = LEGACY_COLUMNS + DECODED_COLUMNS
+
+# Columns written by the DNS server (the rest are filled in later)
+INSERT_COLUMNS = ('id', 'time_received', 'time_created', 'time_human', 'raw_info',
+    'machine_id', 'session_id') + DECODED_COLUMNS
+
+# user_version of a partition whose messages have all been decoded
+DECODED_VERSION = 1
+
+# Device timestamps are seconds since this
+EPOCH = datetime.datetime(2000,1,1)
+
+PERIODS = {
+    'month': ('%Y-%m', re.compile(r'^(\d{4})-(\d{2})$')),
+    'day': ('%Y-%m-%d', re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')),
+    }
+
+def init_partition(filename):
+    db = sqlite3.connect(filename)
+    created = db.execute("SELECT count(*) FROM sqlite_master"
+        " WHERE type='table' AND name='message'").fetchone()[0] == 0
+    db.execute("CREATE TABLE IF NOT EXISTS message(id, time_received, time_created, time_human, raw_info, "
+        " status, machine_id, session_id, lat, lon,"
+        " reset_cause INTEGER, tx INTEGER, ap_count INTEGER,"
+        " PRIMARY KEY(id))")
+    # Partitions created before the decoded columns were added
+    existing = set(row[1] for row in db.execute("PRAGMA table_info(message)"))
+    for column in DECODED_COLUMNS:
+        if column not in existing:
+            db.execute("ALTER TABLE message ADD COLUMN %s INTEGER" % column)
+    db.execute("CREATE TABLE IF NOT EXISTS ap(message_id, bssid INTEGER, rssi INTEGER,"
+        " PRIMARY KEY(message_id, bssid)) WITHOUT ROWID")
+    db.execute("CREATE INDEX IF NOT EXISTS message_status ON message(status)")
+    db.execute("CREATE INDEX IF NOT EXISTS message_time_created ON message(time_created)")
+    db.execute("CREATE INDEX IF NOT EXISTS message_machine_id ON message(machine_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS ap_bssid ON ap(bssid)")
+    if created:
+        # Nothing to decode in a new partition (see decode_stored)
+        db.execute("PRAGMA user_version=%d" % DECODED_VERSION)
+    db.commit()
+    return db
+
+def decode_chunk(chunk_id, parts):
+    """
+        Decode the parts of a chunk: machine-<hex id>, time-<seconds since
+        2000>, reset-<cause>, ap-<bssid>-<rssi>, tx and eom (names may
+        have had their case changed on the way, so it is ignored).
+
+        Returns (values, aps): values is a dict of message columns
+        (time_created is None if there was no time- part), aps a list of
+        (bssid, rssi) sorted by bssid, with bssid a 48 bit int. Malformed
+        parts are skipped, and only the first RSSI of a BSSID is kept.
+
+        >>> values, aps = decode_chunk('1A2B.3', ['machine-00ff', 'time-1000',
+        ...     'reset-2', 'AP-AABBCCDDEEFF--50', 'ap-aabbccddeeff--70',
+        ...     'ap-001122334455--81', 'ap-0011-5', 'ap-bad', 'tx', 'eom'])
+        >>> values['session_id'], values['machine_id'], values['time_human']
+        ('1a2b', '00ff', '2000-01-01T00:16:40')
+        >>> values['time_created'] == calendar.timegm((2000, 1, 1, 0, 16, 40))
+        True
+        >>> values['reset_cause'], values['tx'], values['ap_count']
+        (2, 1, 2)
+        >>> [(format_bssid(bssid), rssi) for bssid, rssi in aps]
+        [('00:11:22:33:44:55', -81), ('AA:BB:CC:DD:EE:FF', -50)]
+        >>> decode_chunk('1.1', ['eom'])[0]['time_created'] is None
+        True
+    """
+    values = {
+        'session_id': chunk_id.split('.')[0].lower(),
+        'machine_id': None,
+        'time_created': None,
+        'time_human': None,
+        'reset_cause': None,
+        'tx': 0,
+        }
+    aps = {}
+    for info in parts:
+        kind, _, arg = info.lower().partition('-')
+        try:
+            if kind == 'ap':
+                bssid, rssi = arg.split('-', 1)
+                if len(bssid) == 12:
+                    aps.setdefault(int(bssid, 16), int(rssi))
+            elif kind == 'time':
+                chunk_datetime = EPOCH + datetime.timedelta(seconds=int(arg))
+                # EPOCH is naive UTC - .timestamp() would take it as local time
+                values['time_created'] = calendar.timegm(chunk_datetime.timetuple())
+                values['time_human'] = chunk_datetime.isoformat()
+            elif kind == 'machine':
+                values['machine_id'] = arg
+            elif kind == 'reset':
+                values['reset_cause'] = int(arg)
+            elif kind == 'tx':
+                values['tx'] = 1
+        except ValueError:
+            continue
+    values['ap_count'] = len(aps)
+    return values, sorted(aps.items())
+
+def format_bssid(bssid):
+    """
+        48 bit int as 02:AB:CD:EF:09:10
+    """
+    digits = '%012X' % bssid
+    return ':'.join(digits[n:n+2] for n in range(0, 12, 2))
+
+class MessageStore():
+    """
+        Messages go to the partition for their time_created, and reads
+        only open the partitions which can hold the requested range
+
+        >>> import tempfile
+        >>> store = MessageStore(tempfile.mkdtemp())
+        >>> oct1 = calendar.timegm((2026, 10, 1, 0, 0, 0))
+        >>> nov1 = calendar.timegm((2026, 11, 1, 0, 0, 0))
+        >>> store.partition_key(oct1 - 1), store.partition_key(oct1)
+        ('2026-09', '2026-10')
+        >>> store.partition_range('2026-10') == (oct1, nov1)
+        True
+        >>> rows = [('m%d' % n, 0, t, '', '', 'machine', 'session', None, 0, 1)
+        ...     for n, t in enumerate((oct1 - 60, oct1 + 60, nov1 + 60))]
+        >>> store.insert(rows, aps=[('m1', oct1 + 60, 0xaabbccddeeff, -50)])
+        3
+        >>> store.insert(rows[:1])
+        0
+        >>> store.partitions()
+        ['2026-09', '2026-10', '2026-11']
+        >>> store.partitions(oct1, nov1)
+        ['2026-10']
+        >>> [row[0] for row in store.select('id', start=oct1 - 60, end=nov1, ordered=True)]
+        ['m0', 'm1']
+        >>> [(format_bssid(bssid), rssi) for bssid, rssi in store.aps('m1', oct1 + 60)]
+        [('AA:BB:CC:DD:EE:FF', -50)]
+
+        update_many() groups the updates by partition
+
+        >>> store.update_many([('m0', oct1 - 60, 'OK', 51.5, -0.1),
+        ...     ('m2', nov1 + 60, 'ERROR', None, None)], ('status', 'lat', 'lon'))
+        >>> list(store.select('id, status, lat', 'status IS NOT NULL', ordered=True))
+        [('m0', 'OK', 51.5), ('m2', 'ERROR', None)]
+        >>> store.close()
+    """
+
+    def __init__(self, directory='messages', period='month', prefix='messages',
+            wal=True):
+        if period not in PERIODS:
+            raise ValueError("period must be one of: %s" % ', '.join(PERIODS))
+        self.directory = directory
+        self.period = period
+        self.prefix = prefix
+        self.wal = wal
+        self.key_format, self.key_re = PERIODS[period]
+        self.name_re = re.compile(r'^%s-(.*)\.sqlite3$' % re.escape(prefix))
+        self.dbs = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def partition_key(self, t):
+        """
+            Partition key ('2026-10' or '2026-10-18') for a timestamp
+        """
+        return time.strftime(self.key_format, time.gmtime(t))
+
+    def partition_range(self, key):
+        """
+            (start, end) timestamps of partition key, end exclusive
+        """
+        fields = [int(f) for f in self.key_re.match(key).groups()]
+        if self.period == 'month':
+            year, month = fields
+            start = calendar.timegm((year, month, 1, 0, 0, 0))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            end = calendar.timegm((year, month, 1, 0, 0, 0))
+        else:
+            start = calendar.timegm(tuple(fields) + (0, 0, 0))
+            end = start + 86400
+        return start, end
+
+    def filename(self, key):
+        return os.path.join(self.directory, '%s-%s.sqlite3' % (self.prefix, key))
+
+    def partitions(self, start=None, end=None):
+        """
+            Sorted keys of the existing partitions which can hold messages
+            with start <= time_created < end (either can be None)
+        """
+        keys = []
+        for name in os.listdir(self.directory):
+            m = self.name_re.match(name)
+            if m is None or not self.key_re.match(m.group(1)):
+                continue
+            key = m.group(1)
+            p_start, p_end = self.partition_range(key)
+            if start is not None and p_end <= start:
+                continue
+            if end is not None and p_start >= end:
+                continue
+            keys.append(key)
+        keys.sort()
+        return keys
+
+    def connect(self, key):
+        db = self.dbs.get(key)
+        if db is None:
+            db = init_partition(self.filename(key))
+            if self.wal:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+            self.dbs[key] = db
+        return db
+
+    def insert(self, rows, columns=INSERT_COLUMNS, aps=()):
+        """
+            Insert rows (tuples of columns, which must include
+            time_created) and AP observations (tuples of message id,
+            time_created, bssid, rssi) - one transaction per partition
+            touched. Rows with an id (or message id and bssid) already in
+            their partition are ignored. Returns the number of messages
+            inserted (not counting ignored duplicates).
+        """
+        t_index = columns.index('time_created')
+        by_key = {}
+        for row in rows:
+            by_key.setdefault(self.partition_key(row[t_index]), ([], []))[0].append(row)
+        for message_id, time_created, bssid, rssi in aps:
+            by_key.setdefault(self.partition_key(time_created), ([], []))[1].append(
+                (message_id, bssid, rssi))
+        sql = "INSERT OR IGNORE INTO message (%s) VALUES (%s)" % (
+            ', '.join(columns), ','.join('?' * len(columns)))
+        inserted = 0
+        for key, (part_rows, part_aps) in by_key.items():
+            db = self.connect(key)
+            with db:
+                inserted += db.executemany(sql, part_rows).rowcount
+                db.executemany("INSERT OR IGNORE INTO ap (message_id, bssid, rssi) VALUES (?,?,?)",
+                    part_aps)
+        return inserted
+
+    def aps(self, id, time_created):
+        """
+            List of (bssid, rssi) seen in message id, sorted by bssid
+        """
+        db = self.connect(self.partition_key(time_created))
+        return db.execute("SELECT bssid, rssi FROM ap WHERE message_id=? ORDER BY bssid",
+            (id,)).fetchall()
+
+    def select(self, columns, where=None, params=(), start=None, end=None,
+            ordered=False):
+        """
+            Yield rows of columns (SQL column list) from every partition
+            which can hold messages with start <= time_created < end,
+            matching the optional where clause. ordered=True returns the
+            rows in time_created order.
+        """
+        conditions = []
+        bounds = []
+        if start is not None:
+            conditions.append('time_created >= ?')
+            bounds.append(start)
+        if end is not None:
+            conditions.append('time_created < ?')
+            bounds.append(end)
+        if where:
+            conditions.append('(%s)' % where)
+        sql = 'SELECT %s FROM message' % columns
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if ordered:
+            sql += ' ORDER BY time_created'
+        for key in self.partitions(start, end):
+            # Materialise each partition's rows, so callers can update
+            # the store while iterating
+            for row in self.connect(key).execute(sql, tuple(bounds) + tuple(params)).fetchall():
+                yield row
+
+    def update(self, id, time_created, **values):
+        """
+            Set columns (keyword arguments) of message id, which was
+            created at time_created (this picks the partition)
+        """
+        db = self.connect(self.partition_key(time_created))
+        assignments = ', '.join('%s=?' % c for c in values)
+        with db:
+            db.execute('UPDATE message SET %s WHERE id=?' % assignments,
+                tuple(values.values()) + (id,))
+
+    def update_many(self, updates, columns):
+        """
+            Batched update: updates are tuples of (id, time_created, value
+            for each of columns) - one transaction per partition touched
+        """
+        by_key = {}
+        for update in updates:
+            by_key.setdefault(self.partition_key(update[1]), []).append(
+                tuple(update[2:]) + (update[0],))
+        sql = 'UPDATE message SET %s WHERE id=?' % ', '.join('%s=?' % c for c in columns)
+        for key, rows in by_key.items():
+            db = self.connect(key)
+            with db:
+                db.executemany(sql, rows)
+
+    def checkpoint(self):
+        for db in self.dbs.values():
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        for db in self.dbs.values():
+            db.close()
+        self.dbs = {}
+
+def decoded_row(row):
+    """
+        Row of an old database (LEGACY_COLUMNS) as (row of COLUMNS, AP
+        observations) for insert(), decoding its raw_info
+    """
+    message = dict(zip(LEGACY_COLUMNS, row))
+    values, aps = decode_chunk(message['id'], (message['raw_info'] or '').split('\n'))
+    for column in ('machine_id', 'session_id'):
+        if message[column] is None:
+            message[column] = values[column]
+    for column in DECODED_COLUMNS:
+        message[column] = values[column]
+    return (tuple(message[c] for c in COLUMNS),
+        [(message['id'], message['time_created'], bssid, rssi) for bssid, rssi in aps])
+
+def import_db(store, filename, batch_size=10000):
+    """
+        Copy every message from an old single-table database into store,
+        decoding raw_info. Returns the number of rows read.
+    """
+    src = sqlite3.connect(filename)
+    cur = src.execute('SELECT %s FROM message WHERE time_created IS NOT NULL'
+        % ', '.join(LEGACY_COLUMNS))
+    count = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        decoded = [decoded_row(row) for row in rows]
+        store.insert([d[0] for d in decoded], COLUMNS,
+            [ap for d in decoded for ap in d[1]])
+        count += len(rows)
+    src.close()
+    return count
+
+def decode_stored(store):
+    """
+        Decode messages stored before decoding at ingest was added
+        (ap_count is NULL). Partitions which have already been done (or
+        were created since) are skipped. Returns the number of messages
+        decoded.
+    """
+    count = 0
+    for key in store.partitions():
+        db = store.connect(key)
+        if db.execute("PRAGMA user_version").fetchone()[0] >= DECODED_VERSION:
+            continue
+        rows = db.execute("SELECT id, time_created, raw_info FROM message"
+            " WHERE ap_count IS NULL").fetchall()
+        for id, time_created, raw_info in rows:
+            values, aps = decode_chunk(id, (raw_info or '').split('\n'))
+            db.execute("UPDATE message SET machine_id=coalesce(machine_id, ?),"
+                " session_id=coalesce(session_id, ?), reset_cause=?, tx=?, ap_count=?"
+                " WHERE id=?", (values['machine_id'], values['session_id'],
+                values['reset_cause'], values['tx'], values['ap_count'], id))
+            db.executemany("INSERT OR IGNORE INTO ap (message_id, bssid, rssi) VALUES (?,?,?)",
+                [(id, bssid, rssi) for bssid, rssi in aps])
+        db.execute("PRAGMA user_version=%d" % DECODED_VERSION)
+        db.commit()
+        count += len(rows)
+    return count
+
+def main():
+    import argparse
+    p = argparse.ArgumentParser(description="Telemetry message store")
+    p.add_argument("--directory", "-d", default="messages",
+                    help="Store directory (default: messages)")
+    p.add_argument("--period", choices=sorted(PERIODS), default="month",
+                    help="Partition period (default: month)")
+    p.add_argument("--import", dest="import_db", metavar="<sqlite-file>",
+                    help="Copy messages from an old single-file database")
+    p.add_argument("--decode", action="store_true", default=False,
+                    help="Decode raw_info of messages stored before decoding at ingest")
+    args = p.parse_args()
+    store = MessageStore(args.directory, args.period)
+    if args.import_db:
+        t0 = time.monotonic()
+        count = import_db(store, args.import_db)
+        print("Imported %d messages in %.1fs" % (count, time.monotonic() - t0))
+    if args.decode:
+        t0 = time.monotonic()
+        count = decode_stored(store)
+        print("Decoded %d messages in %.1fs" % (count, time.monotonic() - t0))
+    for key in store.partitions():
+        db = store.connect(key)
+        print(key, db.execute('SELECT count(*) FROM message').fetchone()[0])
+    store.close()
+
+if __name__ == '__main__':
+    main()
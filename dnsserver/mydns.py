@@ -6,22 +6,364 @@ import dnslib
 from dnslib import RR,QTYPE,RCODE,TXT,parse_time
 from dnslib.label import DNSLabel
 from dnslib.server import DNSServer,DNSHandler,BaseResolver,DNSLogger
+from querylog import QueryJournal
+from messagestore import MessageStore, INSERT_COLUMNS, decode_chunk
 
 import time
 import datetime
 import socket
 import struct
-import sqlite3
 import collections
+import re
+import sys
+import threading
+import queue
+import atexit
+import argparse
+import multiprocessing
+import signal
+
+# Queued to tell ChunkWriter to flush and exit
+_STOP_WRITER = object()
+
+class WriterError(Exception):
+    """
+        The ChunkWriter thread has stopped, so messages can't be saved
+    """
+
+class ChunkWriter(threading.Thread):
+    """
+        Background writer which owns the only MessageStore (sqlite
+        connections) used for inserting messages.
+
+        Rows are queued by the resolver thread(s) with put() and written
+        in batches, one commit per batch, so that a burst of messages costs
+        one fsync rather than one each. A batch is committed when it reaches
+        batch_size rows, or flush_interval seconds after its first row
+        arrived, whichever is sooner.
+
+        A batch which fails to write (disk full, database locked...) is
+        logged and retried every retry_interval seconds, with the store
+        reopened, up to max_retries times; then it is dropped (counted in
+        rows_dropped) so the writer can carry on with new messages. If
+        the writer thread stops anyway, put() and close() raise
+        WriterError rather than queue messages which will never be
+        written.
+
+        close() flushes anything still queued, checkpoints the WAL into the
+        partition files and closes the connections.
+    """
+    def __init__(self, db_directory, batch_size=200, flush_interval=1.0,
+            retry_interval=5.0, max_retries=12):
+        super().__init__(name='ChunkWriter', daemon=True)
+        self.db_directory = db_directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.write_errors = 0
+        self.commits = 0
+        self.commit_time_total = 0.0
+        self.commit_time_max = 0.0
+        self.last_commit_time = 0.0
+        self.closed = False
+        self.error = None
+
+    def check(self):
+        """
+            Raise WriterError if the writer thread has stopped
+        """
+        if self.error is not None:
+            raise WriterError("ChunkWriter stopped: %r" % self.error)
+        if self.ident is not None and not self.is_alive():
+            raise WriterError("ChunkWriter stopped")
+
+    def put(self, message):
+        """
+            message is a tuple of (row, aps): row has the INSERT_COLUMNS of
+            the message, aps is a list of (bssid, rssi)
+        """
+        if self.closed:
+            raise WriterError("ChunkWriter closed")
+        self.check()
+        self.queue.put(message)
+
+    def open_db(self):
+        # Partitions use WAL with synchronous=NORMAL: that only syncs at
+        # checkpoint; the commit itself survives an application crash,
+        # which is what we care about.
+        return MessageStore(self.db_directory)
+
+    def run(self):
+        try:
+            self.write_queued()
+        except BaseException as e:
+            self.error = e
+            print("ChunkWriter stopped:", repr(e))
+            raise
+
+    def write_queued(self):
+        self.db = self.open_db()
+        try:
+            batch = []
+            deadline = None
+            retries = 0
+            stopping = False
+            while True:
+                if not stopping:
+                    timeout = None
+                    if deadline is not None:
+                        timeout = max(0, deadline - time.monotonic())
+                    try:
+                        row = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        row = None
+                    if row is _STOP_WRITER:
+                        stopping = True
+                        # Drain anything queued after the stop marker was put.
+                        while True:
+                            try:
+                                row = self.queue.get_nowait()
+                            except queue.Empty:
+                                break
+                            if row is not _STOP_WRITER:
+                                batch.append(row)
+                    elif row is not None:
+                        if not batch:
+                            deadline = time.monotonic() + self.flush_interval
+                        batch.append(row)
+                if not batch:
+                    if stopping:
+                        break
+                    continue
+                now = time.monotonic()
+                if retries:
+                    # Failed before: only try again at the retry time
+                    if now < deadline:
+                        if not stopping:
+                            continue
+                        time.sleep(deadline - now)
+                elif not (stopping or len(batch) >= self.batch_size or now >= deadline):
+                    continue
+                if self.write_batch(batch):
+                    retries = 0
+                elif retries < self.max_retries:
+                    retries += 1
+                    deadline = time.monotonic() + self.retry_interval
+                    continue
+                else:
+                    print("ChunkWriter: dropping %d messages after %d retries" % (
+                        len(batch), retries))
+                    self.rows_dropped += len(batch)
+                    retries = 0
+                batch = []
+                deadline = None
+            self.db.checkpoint()
+        finally:
+            self.db.close()
+
+    def write_batch(self, batch):
+        """
+            Write batch to the store - returns False (having logged the
+            error and reopened the store) if it failed
+        """
+        t0 = time.monotonic()
+        try:
+            # Ignores duplicate ids: most likely a retransmitted chunk.
+            # One commit per partition (normally just the current one).
+            inserted = self.db.insert([row for row, aps in batch],
+                aps=[(row[0], row[2], bssid, rssi) for row, aps in batch
+                    for bssid, rssi in aps])
+        except Exception as e:
+            self.write_errors += 1
+            print("ChunkWriter: failed to write %d messages: %r" % (len(batch), e))
+            try:
+                self.db.close()
+            except Exception:
+                pass
+            self.db = self.open_db()
+            return False
+        elapsed = time.monotonic() - t0
+        self.rows_written += inserted
+        self.commits += 1
+        self.commit_time_total += elapsed
+        self.commit_time_max = max(self.commit_time_max, elapsed)
+        self.last_commit_time = elapsed
+        return True
+
+    def close(self):
+        """
+            Flush all queued rows to disk and stop the writer thread.
+            Safe to call more than once. Raises WriterError if the writer
+            had stopped (messages still queued have been lost).
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.is_alive():
+            self.queue.put(_STOP_WRITER)
+            self.join()
+        if self.error is not None:
+            raise WriterError("ChunkWriter stopped: %r" % self.error)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+            'write_errors': self.write_errors,
+            'commits': self.commits,
+            'commit_ms_avg': (1000.0 * self.commit_time_total / self.commits
+                if self.commits else 0.0),
+            'commit_ms_max': 1000.0 * self.commit_time_max,
+            'commit_ms_last': 1000.0 * self.last_commit_time,
+            }
+
+class ChunkBuffer():
+    """
+        Holds the parts of chunks which are still being received, until
+        their "eom" part arrives.
+
+        Chunks are kept in least-recently-used order. A chunk which has not
+        had a new part for ttl seconds is dropped as an orphan (the device
+        has gone away mid-transmission), and the least recently used chunks
+        are dropped whenever the estimated memory use goes over max_bytes.
+
+        Parts are interned and de-duplicated within a chunk, so resolver
+        retries and retransmissions cost nothing; the same strings
+        ("tx", "eom", "machine-...") are shared between chunks.
+    """
+    # Rough per-chunk and per-part overheads (bytes) for the memory estimate
+    CHUNK_OVERHEAD = 240
+    PART_OVERHEAD = 80
+
+    def __init__(self, ttl=600, max_bytes=64*1024*1024, max_parts=256):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_parts = max_parts
+        self.lock = threading.Lock()
+        # chunk_id -> [last_seen, estimated_size, {part: None}]
+        self.chunks = collections.OrderedDict()
+        self.bytes_used = 0
+        self.completed = 0
+        self.duplicates = 0
+        self.orphans_expired = 0
+        self.evicted_lru = 0
+        self.overflowed = 0
+
+    def add(self, chunk_id, info, now=None):
+        """
+            Add a part to a chunk. Returns the list of parts (in the order
+            first received, including "eom") once the chunk is complete,
+            otherwise None.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            entry = self.chunks.get(chunk_id)
+            if entry is None:
+                chunk_id = sys.intern(chunk_id)
+                entry = [now, self.CHUNK_OVERHEAD + len(chunk_id), {}]
+                self.chunks[chunk_id] = entry
+                self.bytes_used += entry[1]
+            else:
+                entry[0] = now
+                self.chunks.move_to_end(chunk_id)
+            parts = entry[2]
+            if info in parts:
+                self.duplicates += 1
+            elif len(parts) >= self.max_parts:
+                # Junk or a runaway sender; drop it rather than let it grow.
+                self.overflowed += 1
+                self._remove(chunk_id)
+                return None
+            else:
+                parts[sys.intern(info)] = None
+                size = self.PART_OVERHEAD + len(info)
+                entry[1] += size
+                self.bytes_used += size
+            if info.lower() == 'eom':
+                self._remove(chunk_id)
+                self.completed += 1
+                return list(parts)
+            self._expire(now)
+            return None
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+
+    def _expire(self, now):
+        # The oldest entry is always first, so stop at the first live one.
+        cutoff = now - self.ttl
+        while self.chunks:
+            chunk_id, entry = next(iter(self.chunks.items()))
+            if entry[0] < cutoff:
+                self.orphans_expired += 1
+            elif self.bytes_used > self.max_bytes:
+                self.evicted_lru += 1
+            else:
+                break
+            self._remove(chunk_id)
+
+    def _remove(self, chunk_id):
+        entry = self.chunks.pop(chunk_id)
+        self.bytes_used -= entry[1]
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def stats(self):
+        return {
+            'in_flight': len(self.chunks),
+            'bytes_used': self.bytes_used,
+            'completed': self.completed,
+            'duplicates': self.duplicates,
+            'orphans_expired': self.orphans_expired,
+            'evicted_lru': self.evicted_lru,
+            'overflowed': self.overflowed,
+            }
 
 class DataSaver():
-    db_filename = 'messages.sqlite3'
+    # MessageStore directory (one sqlite file per month)
+    db_directory = 'messages'
+
+    # chunk ids are <session id>.<chunk number>, both hex
+    chunk_id_re = re.compile(r'^[0-9a-fA-F]{1,16}\.[0-9a-fA-F]{1,8}$')
 
     def __init__(self):
-        self.chunks_by_id = collections.defaultdict(list)
+        self.chunks = ChunkBuffer()
+        self.rejected = 0
         # fail-fast
-        db = self.init_db()
-        db.close() 
+        MessageStore(self.db_directory).close()
+        self.writer = ChunkWriter(self.db_directory)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self.writer.close()
+
+    def stats(self):
+        stats = self.writer.stats()
+        stats.update(self.chunks.stats())
+        stats['rejected'] = self.rejected
+        return stats
+
+    @classmethod
+    def split_name(cls, name):
+        """
+            Split a local name into (info, chunk_id), or return None
+            if it's not a telemetry name.
+        """
+        bits = name.split('.', 1)
+        if len(bits) > 1 and cls.chunk_id_re.match(bits[1]):
+            return bits
+        return None
 
     def store_name(self, name):
         """
@@ -33,58 +375,99 @@ class DataSaver():
 
             Once we have a complete packet, store the packet in sqlite.
         """
-        bits = name.split('.', 1)
-        if len(bits) > 1:
-            info, chunk_id = bits
-            self.chunks_by_id[chunk_id].append(info)
-            if info.lower() == 'eom':
-                self.save_chunk(chunk_id)
-                # free memory:
-                del self.chunks_by_id[chunk_id]
-            return True
-        else:
+        bits = self.split_name(name)
+        if bits is None:
+            if '.' in name:
+                self.rejected += 1
             return False
+        info, chunk_id = bits
+        chunk = self.chunks.add(chunk_id, info)
+        if chunk is not None:
+            self.save_chunk(chunk_id, chunk)
+        return True
 
-    def save_chunk(self, chunk_id):
-        db = self.init_db()
-        chunk = self.chunks_by_id[chunk_id]
+    def save_chunk(self, chunk_id, chunk):
         if len(chunk) < 2:
             # Not useful.
             return
-        # Read timestamp
-        # (default time - the time we received it)
-        time_received = datetime.datetime.utcnow().replace(microsecond=0)
-        chunk_datetime = None
-        for info in chunk:
-            if info.startswith('time-'):
-                chunk_time = int(info.split('-')[1])
-                # our time epoch, add
-                chunk_datetime = datetime.datetime(2000,1,1) + datetime.timedelta(seconds=chunk_time)
-        if chunk_datetime is None:
+        # Decode the parts once, here, rather than in every job which
+        # reads the messages (see messagestore.decode_chunk)
+        values, aps = decode_chunk(chunk_id, chunk)
+        if values['time_created'] is None:
             print("Discard message: no timestamp")
         else:
-            raw_info = '\n'.join(chunk)
-            time_human = chunk_datetime.isoformat()
-            time_created = chunk_datetime.timestamp()
-            try:
-                db.execute("INSERT INTO message (id, time_received, time_created, time_human, raw_info) VALUES "
-                " (?,?,?,?,?)", (chunk_id, time_received.timestamp(), time_created, time_human, raw_info) )
-                db.commit()
-            except sqlite3.IntegrityError as e:
-                # Probably duplicate.
-                pass
-            db.close()
+            values['id'] = chunk_id
+            values['time_received'] = int(time.time())
+            values['raw_info'] = '\n'.join(chunk)
+            self.writer.put( (tuple(values[c] for c in INSERT_COLUMNS), aps) )
 
-    def init_db(self):
-        db = sqlite3.connect(self.db_filename)
-        try:
-            db.execute("CREATE TABLE message(id, time_received, time_created, time_human, raw_info, "
-                " status, machine_id, session_id, lat, lon,"
-                " PRIMARY KEY(id))")
-            db.commit()
-        except sqlite3.OperationalError:
-            pass
-        return db
+class NameForwarder(threading.Thread):
+    """
+        Stands in for both the QueryJournal and the DataSaver in a worker
+        process (see --workers), sending names to the supervisor process,
+        which owns the only journal, chunk buffer and database writer.
+
+        The parts of one chunk can arrive at different workers, so they must
+        be reassembled in one place, in order. Telemetry names are therefore
+        written to the (shared, locked) pipe before the reply goes back to
+        the device, and the device doesn't send the next part until it has
+        the reply. Journal names are not order sensitive and are batched.
+
+        The pipe's lock is shared with the other workers, so this process
+        must never exit while one of its threads is part way through a
+        put - close() waits for any put in progress and refuses new ones.
+    """
+    def __init__(self, names_queue, batch_size=500, flush_interval=0.2):
+        super().__init__(name='NameForwarder', daemon=True)
+        self.names_queue = names_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.batch = []
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.put_lock = threading.Lock()
+        self.closed = False
+
+    def log(self, name):
+        with self.lock:
+            self.batch.append(('q', name))
+            full = len(self.batch) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def store_name(self, name):
+        if DataSaver.split_name(name) is None:
+            return False
+        return self.put([('s', name)])
+
+    def flush(self):
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if batch:
+            self.put(batch)
+
+    def put(self, batch):
+        with self.put_lock:
+            if self.closed:
+                return False
+            self.names_queue.put(batch)
+            return True
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        with self.put_lock:
+            self.closed = True
 
 class DynamicResolver(BaseResolver):
 
@@ -93,76 +476,247 @@ class DynamicResolver(BaseResolver):
         'mr8266.tk.'
         )
 
-    def __init__(self):
+    def __init__(self, saver=None, journal=None):
         self.ttl = 120
-        self.saver = DataSaver()
+        if saver is None:
+            saver = DataSaver()
+        if journal is None:
+            journal = QueryJournal('dnslog.txt')
+            journal.start()
+            atexit.register(journal.close)
+        self.saver = saver
+        self.journal = journal
 
-    def resolve(self,request,handler):
-        reply = request.reply()
-        qname = request.q.qname
-        # Check it's our zone
+    def local_name(self, qname):
+        """
+            Return the part of qname (str) before our zone, or
+            None if it's not in our zone.
+        """
         good_origin = False
         for origin in self.possible_origins:
             suffix = '.' + str(origin)
-            if str(qname).endswith(suffix):
+            if qname.endswith(suffix):
                 good_origin = origin
-        
         if not good_origin:
-            reply.header.rcode = RCODE.SERVFAIL
-            return reply
-            
-        local_name = str(qname)[:(- len(good_origin) - 1)]
-        
-        def reply_ipv4(request, ip, ttl=self.ttl):
-            reply = request.reply()
-            qname = request.q.qname
-            reply.add_answer(RR(qname, QTYPE.A, ttl=ttl,
-                rdata=dnslib.A(ip)))
-            return reply
-           
-        with open('dnslog.txt', 'a') as f:
-          print(local_name, file=f) 
+            return None
+        return qname[:(- len(good_origin) - 1)]
+
+    def answer(self, local_name):
+        """
+            Return (ip, ttl) to answer local_name with, or None for NXDOMAIN
+        """
+        self.journal.log(local_name)
         if local_name in ('test', 'test1'):
-            return reply_ipv4(request, '127.0.0.1')
+            return ('127.0.0.1', self.ttl)
         if local_name == 'test2':
-            return reply_ipv4(request, '127.0.0.2')
+            return ('127.0.0.2', self.ttl)
         if local_name == 'time':
             # short ttl on time.
-            return reply_ipv4(request, self.time_ip(), 5)
+            return (self.time_ip(), 5)
         if self.saver.store_name(local_name):
-            return reply_ipv4(request, '127.0.0.3')
+            return ('127.0.0.3', self.ttl)
         # Otherwise:
-        reply.header.rcode = RCODE.NXDOMAIN
+        return None
+
+    def resolve(self,request,handler):
+        reply = request.reply()
+        qname = request.q.qname
+        # Check it's our zone
+        local_name = self.local_name(str(qname))
+        if local_name is None:
+            reply.header.rcode = RCODE.SERVFAIL
+            return reply
+
+        answer = self.answer(local_name)
+        if answer is None:
+            reply.header.rcode = RCODE.NXDOMAIN
+            return reply
+        ip, ttl = answer
+        reply.add_answer(RR(qname, QTYPE.A, ttl=ttl,
+            rdata=dnslib.A(ip)))
         return reply
-        
+
+    def resolve_fast(self, query, handler):
+        """
+            Same as resolve, without decoding the request into a DNSRecord
+            (see dnslib.queryview)
+        """
+        if not query.is_query:
+            return None
+        local_name = self.local_name(query.qname)
+        if local_name is None:
+            return query.reply_rcode(RCODE.SERVFAIL)
+        answer = self.answer(local_name)
+        if answer is None:
+            return query.reply_rcode(RCODE.NXDOMAIN)
+        ip, ttl = answer
+        return query.reply_a(ip, ttl)
+
     def time_ip(self):
         # Return a "ipv4 address" which contains the number of 
         # seconds since 2000-01-01 00:00 GMT
         epoch = datetime.datetime(2000,1,1)
-        since_epoch = datetime.datetime.now() - epoch
+        since_epoch = datetime.datetime.utcnow() - epoch
         secs_since_epoch = int(since_epoch.total_seconds())
         return socket.inet_ntoa(struct.pack('>I', int(secs_since_epoch)))
 
-if __name__ == '__main__':
+def choose_port(address):
+    """
+        Use port 53 if we're allowed to, otherwise 5353.
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.bind((address, 53))
+        return 53
+    except PermissionError:
+        return 5353
+    finally:
+        probe.close()
 
-    resolver = DynamicResolver()
+def run_worker(address, port, names_queue, pool_size, queue_size):
+    """
+        Body of a worker process: serve DNS on the shared port and send
+        names to the supervisor.
+    """
+    # SIGTERM only sets a flag: exiting from the signal handler could
+    # leave the shared queue locked (see NameForwarder)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    forwarder = NameForwarder(names_queue)
+    forwarder.start()
+    resolver = DynamicResolver(saver=forwarder, journal=forwarder)
+    server = DNSServer(resolver, port=port, address=address, reuse_port=True,
+        pool_size=pool_size, queue_size=queue_size)
+    server.start_thread()
+    try:
+        while not stopping.is_set() and server.isAlive():
+            time.sleep(0.5)
+        server.stop()
+    finally:
+        forwarder.close()
+
+class Supervisor():
+    """
+        Runs N worker processes all bound to the same port with
+        SO_REUSEPORT, restarts any which die, and stores the names they
+        forward using a single DataSaver and QueryJournal.
+    """
+    restart_delay = 1.0 # Seconds
 
-    address = ''
-    port = 5353
-    print("Starting Resolver")
-    
-    udp_server = None
-    for port in (53, 5353):
+    def __init__(self, address, port, workers, pool_size=0, queue_size=256):
+        self.address = address
+        self.port = port
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.num_workers = workers
+        # SimpleQueue writes straight to the pipe; see NameForwarder
+        self.names_queue = multiprocessing.SimpleQueue()
+        self.saver = DataSaver()
+        self.journal = QueryJournal('dnslog.txt')
+        self.journal.start()
+        self.workers = [None] * workers
+        self.started = [0.0] * workers
+        self.restarts = 0
+        self.collector = threading.Thread(target=self.collect, name='Collector',
+            daemon=True)
+
+    def collect(self):
+        while True:
+            batch = self.names_queue.get()
+            if batch is None:
+                break
+            for kind, name in batch:
+                if kind == 'q':
+                    self.journal.log(name)
+                else:
+                    self.saver.store_name(name)
+
+    def start_worker(self, n):
+        p = multiprocessing.Process(target=run_worker, name='mydns-worker-%d' % n,
+            args=(self.address, self.port, self.names_queue, self.pool_size,
+                self.queue_size))
+        p.start()
+        self.workers[n] = p
+        self.started[n] = time.monotonic()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.collector.start()
+        for n in range(self.num_workers):
+            self.start_worker(n)
         try:
-            udp_server = DNSServer(resolver,
-                                   port=port,
-                                   address=address)
-            break
-        except PermissionError:
-            if port == 5353:
-                raise # Otherwise try again
-    udp_server.start_thread()
+            while True:
+                time.sleep(1)
+                self.saver.chunks.expire()
+                for n, p in enumerate(self.workers):
+                    if p.is_alive():
+                        continue
+                    # Don't spin if a worker dies immediately every time.
+                    if time.monotonic() - self.started[n] < self.restart_delay:
+                        continue
+                    print("Worker %s exited (%s); restarting" % (p.name, p.exitcode))
+                    p.join()
+                    self.restarts += 1
+                    self.start_worker(n)
+        finally:
+            self.stop()
+
+    def stop(self):
+        for p in self.workers:
+            if p is not None and p.is_alive():
+                p.terminate()
+        for p in self.workers:
+            if p is not None:
+                p.join()
+        # Workers have flushed everything they had; let the collector finish.
+        self.names_queue.put(None)
+        self.collector.join()
+        self.saver.close()
+        self.journal.close()
+        print("Saved messages:", self.saver.stats(), "worker restarts:", self.restarts)
 
-    while udp_server.isAlive():
-        time.sleep(1)
+if __name__ == '__main__':
+
+    p = argparse.ArgumentParser(description="Telemetry DNS server")
+    p.add_argument("--port", "-p", type=int, default=None,
+                    help="Server port (default: 53 if permitted, otherwise 5353)")
+    p.add_argument("--address", "-a", default="",
+                    help="Listen address (default: all)")
+    p.add_argument("--workers", "-w", type=int, default=1,
+                    help="Number of server processes sharing the port (default: 1)")
+    p.add_argument("--pool-size", type=int, default=0,
+                    help="Handle requests in a fixed pool of threads (default: 0 - thread per request)")
+    p.add_argument("--queue-size", type=int, default=256,
+                    help="Max requests waiting for a pool thread before answering SERVFAIL (default: 256)")
+    args = p.parse_args()
+
+    port = args.port
+    if port is None:
+        port = choose_port(args.address)
+    print("Starting Resolver on port %d" % port)
+
+    if args.workers > 1:
+        Supervisor(args.address, port, args.workers, args.pool_size,
+            args.queue_size).run()
+        sys.exit(0)
+
+    resolver = DynamicResolver()
+    udp_server = DNSServer(resolver,
+                           port=port,
+                           address=args.address,
+                           pool_size=args.pool_size,
+                           queue_size=args.queue_size)
+    udp_server.start_thread()
 
+    try:
+        while udp_server.thread.is_alive():
+            time.sleep(1)
+            # Drop orphaned chunks even when no new queries arrive.
+            resolver.saver.chunks.expire()
+    finally:
+        # Make sure every completed message is on disk before exit.
+        resolver.saver.close()
+        resolver.journal.close()
+        print("Saved messages:", resolver.saver.stats(),
+            "dropped requests:", udp_server.dropped())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Query journal - records every query name received by the resolver
+    without doing any file I/O on the resolver thread.
+
+    QueryJournal.log() just appends to a deque (append/popleft are atomic,
+    so no lock is needed); a background thread drains it in batches into a
+    buffered file. The current segment is rotated when it gets bigger than
+    max_bytes or when the (UTC) day changes, and rotated segments are
+    gzipped.
+
+    Two formats are supported:
+
+        text   - one query name per line (same as the old dnslog.txt)
+        binary - MAGIC, then for each query: seconds (uint32),
+                 milliseconds (uint16), name length (uint8), name
+
+    Run this file to print journal segments (either format, optionally
+    gzipped) as text:
+
+        python3 querylog.py dnslog.qlog dnslog.qlog.20260101-000000.gz
+"""
+
+import collections
+import datetime
+import gzip
+import itertools
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b'QLOG1\n'
+RECORD = struct.Struct('!IHB')
+
+class QueryJournal(threading.Thread):
+    """
+        If a batch can't be written (disk full, directory gone...) the
+        error is printed and counted, the batch is dropped and the file
+        is reopened for the next batch - the thread keeps running.
+
+        >>> journal = QueryJournal('/nonexistent/dnslog.txt')
+        >>> journal.log('abc.com')
+        >>> journal.write_pending()  # doctest: +ELLIPSIS
+        QueryJournal: failed to write 1 queries: FileNotFoundError(...)
+        >>> stats = journal.stats()
+        >>> stats['journal_write_errors'], stats['journal_dropped']
+        (1, 1)
+    """
+
+    def __init__(self, filename, binary=False, max_bytes=64*1024*1024,
+            rotate_daily=True, compress=True, flush_interval=1.0,
+            max_pending=100000):
+        super().__init__(name='QueryJournal', daemon=True)
+        self.filename = filename
+        self.binary = binary
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.file = None
+        self.file_day = None
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.rotations = 0
+
+    def log(self, name):
+        """
+            Queue a query name. Called on the resolver thread; never blocks.
+        """
+        if len(self.pending) >= self.max_pending:
+            # Writer can't keep up (or the disk is full); don't grow forever.
+            self.dropped += 1
+            return
+        self.pending.append((time.time(), name))
+        if len(self.pending) >= 1000:
+            self.wakeup.set()
+
+    def run(self):
+        try:
+            while not self.stopping:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                self.write_pending()
+            self.write_pending()
+        finally:
+            self.close_file()
+
+    def write_pending(self):
+        if not self.pending:
+            return
+        batch = [self.pending.popleft() for i in range(len(self.pending))]
+        try:
+            for t, name in batch:
+                self.write_record(t, name)
+            self.file.flush()
+        except OSError as e:
+            self.write_errors += 1
+            self.dropped += len(batch)
+            print("QueryJournal: failed to write %d queries: %r" % (len(batch), e))
+            self.close_file()
+            return
+        self.written += len(batch)
+
+    def close_file(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    def write_record(self, t, name):
+        day = time.gmtime(t)[:3]
+        if self.file is None:
+            self.open_file(day)
+        elif (self.file.tell() >= self.max_bytes or
+                (self.rotate_daily and day != self.file_day)):
+            self.rotate(day)
+        if self.binary:
+            data = name.encode('ascii', 'replace')[:255]
+            secs = int(t)
+            self.file.write(RECORD.pack(secs, int((t - secs) * 1000), len(data)))
+            self.file.write(data)
+        else:
+            self.file.write(name.encode('ascii', 'replace') + b'\n')
+
+    def open_file(self, day):
+        if os.path.exists(self.filename) and os.path.getsize(self.filename):
+            # Appending to an existing segment: it belongs to the day it
+            # was last written.
+            day = time.gmtime(os.path.getmtime(self.filename))[:3]
+        self.file = open(self.filename, 'ab')
+        if self.binary and self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.file_day = day
+
+    def rotate(self, day):
+        self.file.close()
+        self.file = None
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        closed_name = '%s.%s' % (self.filename, stamp)
+        n = 0
+        while os.path.exists(closed_name) or os.path.exists(closed_name + '.gz'):
+            # Several rotations within a second
+            n += 1
+            closed_name = '%s.%s-%d' % (self.filename, stamp, n)
+        os.rename(self.filename, closed_name)
+        self.rotations += 1
+        if self.compress:
+            compress_segment(closed_name)
+        self.open_file(day)
+
+    def close(self):
+        """
+            Write out everything still queued and close the file.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+
+    def stats(self):
+        return {
+            'journal_pending': len(self.pending),
+            'journal_written': self.written,
+            'journal_dropped': self.dropped,
+            'journal_write_errors': self.write_errors,
+            'journal_rotations': self.rotations,
+            }
+
+def compress_segment(filename):
+    with open(filename, 'rb') as src, gzip.open(filename + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(filename)
+
+def open_segment(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def read_segment(f):
+    """
+        Yield (timestamp, name) for each query in an open segment.
+        Text segments have no timestamps, so timestamp is None.
+
+        >>> import io
+        >>> list(read_segment(io.BytesIO(b'ab\\ncd.xyz\\n')))
+        [(None, 'ab'), (None, 'cd.xyz')]
+        >>> list(read_segment(io.BytesIO(MAGIC + RECORD.pack(1, 500, 2) + b'ab')))
+        [(1.5, 'ab')]
+    """
+    # MAGIC is a line of its own
+    head = f.readline()
+    if head != MAGIC:
+        # Text
+        for line in itertools.chain([head], f):
+            if line:
+                yield None, line.rstrip(b'\n').decode('ascii', 'replace')
+        return
+    while True:
+        rec = f.read(RECORD.size)
+        if len(rec) < RECORD.size:
+            return
+        secs, millis, length = RECORD.unpack(rec)
+        name = f.read(length)
+        yield secs + millis / 1000.0, name.decode('ascii', 'replace')
+
+def main():
+    for filename in sys.argv[1:]:
+        with open_segment(filename) as f:
+            for t, name in read_segment(f):
+                if t is None:
+                    print(name)
+                else:
+                    ts = datetime.datetime.utcfromtimestamp(t)
+                    print(ts.isoformat(timespec='milliseconds'), name)
+
+if __name__ == '__main__':
+    main()